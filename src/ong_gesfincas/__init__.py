@@ -1,5 +1,4 @@
 from enum import Enum
-from importlib import resources
 
 
 def get_data_path(filename: str) -> str:
@@ -12,6 +11,8 @@ def get_data_path(filename: str) -> str:
         the full path of the file
 
     """
+    from importlib import resources     # Imported here, as it is slow and seldom needed
+
     return resources.files("ong_gesfincas.data").joinpath(filename).as_posix()
 
 
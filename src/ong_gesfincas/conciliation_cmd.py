@@ -0,0 +1,270 @@
+"""
+Command line (headless) conciliation: reads bank and gesfincas files, buckets them automatically and writes the
+conciliated Excel workbook plus a json summary (and optionally parquet files) for each community.
+Many communities are processed in parallel processes.
+It also compares two versions of a conciliated Excel workbook (see diff_files)
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_model import Conciliation, DATE_WINDOW_DAYS, InvalidFileError
+from ong_gesfincas.conciliation_partition import automatic_bucket_by_finca
+from ong_gesfincas.conciliation_rules import MatchingRules
+from ong_utils.excel import df_to_excel
+
+# Sheets of the diff output file for each part of the result of Conciliation.diff
+_DIFF_SHEETS = {"added": "añadidas", "removed": "borradas", "rebucketed": "cambios"}
+
+
+def output_name(bank_file) -> str:
+    """Name of the output files of a community: the name (without extension) of its (first) bank file"""
+    bank_files = bank_file.split(os.pathsep) if isinstance(bank_file, str) else list(bank_file)
+    return os.path.splitext(os.path.basename(bank_files[0]))[0]
+
+
+def unique_output_names(bank_files: list) -> list:
+    """
+    Names of the output files of each community (see output_name), adding "_2", "_3"... to repeated names (e.g. bank
+    files with the same name in different directories), so communities never overwrite the files of others
+    Args:
+        bank_files: a list of bank files (or lists of bank files, see conciliate)
+
+    Returns:
+        a list with a different name for each bank file
+    """
+    names = [output_name(bank_file) for bank_file in bank_files]
+    used = set(names)
+    seen = set()
+    for position, name in enumerate(names):
+        if name in seen:
+            number = 2
+            while f"{name}_{number}" in used:
+                number += 1
+            names[position] = f"{name}_{number}"
+            used.add(names[position])
+        seen.add(name)
+    return names
+
+
+def conciliate(bank_file: str, gesfincas_file: str, output_dir: str, parquet: bool = False,
+               by_finca: bool = False, date_window_days: int = DATE_WINDOW_DAYS, rules_file: str = None,
+               name: str = None) -> dict:
+    """
+    Conciliates a bank file against a gesfincas file using Conciliation.automatic_bucket_expenses and saves results
+    Args:
+        bank_file: full name of the bank Excel file. For communities with many accounts, a list of files (or their
+        names separated by os.pathsep), one per account, that are conciliated together
+        gesfincas_file: full name of the gesfincas Excel file
+        output_dir: directory where output files will be written. Their names start with name
+        parquet: True to write also a parquet file for each DataType (needs pyarrow)
+        by_finca: True to match bank rows only against the data of their finca (see automatic_bucket_by_finca)
+        date_window_days: maximum difference in days between dates of matched rows. None to ignore dates
+        rules_file: an optional json file with matching rules (see conciliation_rules), applied before other steps
+        name: start of the names of the output files. Defaults to the name of the bank file (see output_name)
+
+    Returns:
+        a dict with the summary of the conciliation, that is also written to a json file
+    """
+    start = time.perf_counter()
+    bank_files = bank_file.split(os.pathsep) if isinstance(bank_file, str) else list(bank_file)
+    name = name or output_name(bank_files)
+    summary = dict(bank_file=bank_file, gesfincas_file=gesfincas_file, name=name)
+    conciliation = Conciliation(date_window_days=date_window_days)
+    if len(bank_files) == 1:
+        df_dict = dict(conciliation.read_bank(bank_files[0]))
+    else:
+        try:
+            # Files are already processed in parallel, so accounts are read in this process
+            df_dict = conciliation.read_banks(bank_files, workers=1)
+        except InvalidFileError as ife:
+            summary["error"] = "Missing bank data: {}".format(", ".join(ife.missing))
+            return summary
+    df_dict.update(conciliation.read_gesfincas(gesfincas_file))
+    missing = [data_type.value for data_type in DataType if data_type not in df_dict]
+    if missing:
+        summary["error"] = "Missing data: {}".format(", ".join(missing))
+        return summary
+    conciliation.set_dfs(df_dict, read_buckets=False)
+    rules = MatchingRules(rules_file) if rules_file else None
+    if by_finca:
+        # Files are already processed in parallel, so fincas are matched in this process
+        automatic_bucket_by_finca(conciliation, workers=1, rules=rules)
+    else:
+        conciliation.automatic_bucket_expenses(rules=rules)
+    totals, _ = conciliation.check_buckets()
+
+    output_file = os.path.join(output_dir, f"{name}_punteado.xlsx")
+    conciliation.save_as(output_file)
+    files = [output_file]
+    if parquet:
+        for data_type, df in conciliation.dfs.items():
+            filename = os.path.join(output_dir, f"{name}_{data_type.value}.parquet")
+            df = df.infer_objects().astype({conciliation.col_bucket: pd.Int64Dtype()})
+            df.to_parquet(filename, index=False)
+            files.append(filename)
+
+    summary["rows"] = {data_type.value: int(df.shape[0]) for data_type, df in conciliation.dfs.items()}
+    summary["bucketed_rows"] = {data_type.value: int(df[conciliation.col_bucket].notna().sum())
+                                for data_type, df in conciliation.dfs.items()}
+    summary["totals"] = {row: totals.loc[row].to_dict() for row in totals.index}
+    if (by_account := conciliation.check_buckets_by_account()) is not None:
+        summary["totals_by_account"] = {account: by_account.loc[account].to_dict() for account in by_account.index}
+    summary["files"] = files
+    summary["seconds"] = time.perf_counter() - start
+    with open(os.path.join(output_dir, f"{name}_resumen.json"), "w") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    return summary
+
+
+def _conciliate_or_error(bank_file: str, gesfincas_file: str, output_dir: str, parquet: bool = False,
+                         by_finca: bool = False, date_window_days: int = DATE_WINDOW_DAYS,
+                         rules_file: str = None, name: str = None) -> dict:
+    """Same as conciliate, but returns the error in the summary instead of raising it, so other files go on"""
+    try:
+        return conciliate(bank_file, gesfincas_file, output_dir, parquet, by_finca, date_window_days, rules_file,
+                          name)
+    except Exception as e:
+        name = name or output_name(bank_file)
+        return dict(bank_file=bank_file, gesfincas_file=gesfincas_file, name=name, error=repr(e))
+
+
+def conciliate_all(bank_files: list, gesfincas_files: list, output_dir: str, parquet: bool = False,
+                   workers: int = None, by_finca: bool = False,
+                   date_window_days: int = DATE_WINDOW_DAYS, rules_file: str = None) -> dict:
+    """
+    Conciliates each bank file against the gesfincas file in the same position of the list, in parallel processes
+    Args:
+        bank_files: a list of bank Excel files
+        gesfincas_files: a list of gesfincas Excel files, the same length as bank_files
+        output_dir: directory for the output files (see conciliate). Files of bank files with the same name get
+        different names (see unique_output_names)
+        parquet: True to write also parquet files (see conciliate)
+        workers: maximum number of processes. Defaults to number of cpus. If 1, files are processed in this process
+        by_finca: True to match each finca separately (see conciliate)
+        date_window_days: maximum difference in days between dates of matched rows (see conciliate)
+        rules_file: an optional json file with matching rules (see conciliate)
+
+    Returns:
+        a dict with the summary of each file (in "results") and the throughput of the whole process
+    """
+    if len(bank_files) != len(gesfincas_files):
+        raise ValueError("There must be a gesfincas file for each bank file")
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    args = (bank_files, gesfincas_files, [output_dir] * len(bank_files), [parquet] * len(bank_files),
+            [by_finca] * len(bank_files), [date_window_days] * len(bank_files), [rules_file] * len(bank_files),
+            unique_output_names(bank_files))
+    if workers == 1 or len(bank_files) < 2:
+        results = list(map(_conciliate_or_error, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_conciliate_or_error, *args))
+    seconds = time.perf_counter() - start
+    rows = sum(sum(result.get("rows", {}).values()) for result in results)
+    retval = dict(results=results, files=len(results), errors=sum("error" in result for result in results),
+                  rows=rows, seconds=seconds,
+                  files_per_second=len(results) / seconds if seconds else None,
+                  rows_per_second=rows / seconds if seconds else None)
+    with open(os.path.join(output_dir, "resumen.json"), "w") as f:
+        json.dump(retval, f, indent=2, ensure_ascii=False)
+    return retval
+
+
+def diff_files(old_file: str, new_file: str, output_file: str = None, workers: int = None) -> dict:
+    """
+    Compares two versions of a conciliated Excel workbook (saved with Conciliation.save_as) with Conciliation.diff
+    Args:
+        old_file: full name of the old version
+        new_file: full name of the new version
+        output_file: optional Excel file to write the result to: a sheet with the totals and a sheet for the added,
+        removed and rebucketed rows of each data type (if any)
+        workers: maximum number of processes. Defaults to 2 (both files are read at the same time, as reading them
+        is the slow part). If 1, files are read in this process
+
+    Returns:
+        the result of Conciliation.diff
+    """
+    if workers == 1:
+        old, new = map(Conciliation, [old_file, new_file])
+    else:
+        with ProcessPoolExecutor(max_workers=workers or 2) as executor:
+            old, new = executor.map(Conciliation, [old_file, new_file])
+    result = old.diff(new)
+    if output_file:
+        with pd.ExcelWriter(output_file) as writer:
+            df_to_excel(result["totals"].rename_axis("datos").reset_index(), writer, "totales")
+            for key, sheet in _DIFF_SHEETS.items():
+                for data_type, df in result[key].items():
+                    if not df.empty:
+                        df_to_excel(df.drop(columns=old.col_cents, errors="ignore"), writer,
+                                    f"{sheet}_{data_type.value}")
+    return result
+
+
+def main_diff(args: list = None):
+    """Entry point of the punteo-diff command"""
+    parser = argparse.ArgumentParser(prog="punteo-diff",
+                                     description="Compara dos versiones de un excel completo de punteo: filas "
+                                                 "añadidas, borradas y con punteo distinto, y cambios en los totales")
+    parser.add_argument("anterior", help="Excel completo de la versión anterior")
+    parser.add_argument("nuevo", help="Excel completo de la versión nueva")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Excel donde guardar las diferencias (totales y filas cambiadas de cada tipo)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Número máximo de procesos en paralelo (por defecto, 2: se lee un excel en cada uno)")
+    parsed = parser.parse_args(args)
+    result = diff_files(parsed.anterior, parsed.nuevo, parsed.output, parsed.workers)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(result["totals"].T.to_string())
+    changes = result["totals"][["añadidas", "borradas", "cambios de punteo"]].to_numpy().sum()
+    print(f"{changes} filas con cambios" if changes else "Sin cambios")
+    return 1 if changes else 0
+
+
+def main(args: list = None):
+    """Entry point of the punteo-batch command"""
+    parser = argparse.ArgumentParser(prog="punteo-batch",
+                                     description="Puntea automáticamente extractos del banco contra ficheros de "
+                                                 "gesfincas, sin interfaz gráfica")
+    parser.add_argument("-b", "--bank", action="append", required=True,
+                        help="Extracto del banco. Se puede indicar varias veces, uno por comunidad. Si la comunidad "
+                             f"tiene varias cuentas, sus extractos separados por '{os.pathsep}'")
+    parser.add_argument("-g", "--gesfincas", action="append", required=True,
+                        help="Fichero de gesfincas, en el mismo orden que los extractos del banco")
+    parser.add_argument("-o", "--output-dir", default=".", help="Directorio de salida")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Número máximo de procesos en paralelo (por defecto, uno por cpu)")
+    parser.add_argument("--parquet", action="store_true", help="Guarda también ficheros parquet (requiere pyarrow)")
+    parser.add_argument("--por-finca", dest="by_finca", action="store_true",
+                        help="Puntea cada movimiento del banco solo contra los datos de su finca, deducida del concepto")
+    parser.add_argument("--ventana-dias", dest="date_window_days", type=int, default=DATE_WINDOW_DAYS,
+                        help="Máxima diferencia en días entre las fechas de los movimientos punteados (por defecto, "
+                             "%(default)s). 0 para no tener en cuenta las fechas")
+    parser.add_argument("--reglas", dest="rules_file", default=None,
+                        help="Fichero json de reglas aprendidas de punteos anteriores (el que guarda la interfaz "
+                             "gráfica, por defecto en ~/.ong_gesfincas/reglas_punteo.json)")
+    parsed = parser.parse_args(args)
+    if len(parsed.bank) != len(parsed.gesfincas):
+        parser.error("Debe indicarse un fichero de gesfincas por cada extracto del banco")
+
+    result = conciliate_all(parsed.bank, parsed.gesfincas, parsed.output_dir, parsed.parquet, parsed.workers,
+                            parsed.by_finca, parsed.date_window_days or None, parsed.rules_file)
+    for summary in result["results"]:
+        if "error" in summary:
+            print(f"{summary['name']}: ERROR {summary['error']}")
+        else:
+            print(f"{summary['name']}: {summary['bucketed_rows']} filas punteadas de {summary['rows']} "
+                  f"en {summary['seconds']:.2f}s")
+    print(f"{result['files']} ficheros ({result['rows']} filas) en {result['seconds']:.2f}s: "
+          f"{result['rows_per_second'] or 0:,.0f} filas/s")
+    return 1 if result["errors"] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
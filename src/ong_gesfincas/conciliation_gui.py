@@ -1,16 +1,22 @@
+import datetime
 import os
 import webbrowser
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from tkinter import *
-from tkinter import messagebox, filedialog
+from tkinter import messagebox, filedialog, simpledialog
 
 import numpy as np
 import pandas as pd
 
 from ong_gesfincas import DataType
-from ong_gesfincas.conciliation_model import Conciliation, InvalidFileError
-from ong_gesfincas.conciliation_pandastable import ConciliationTable
-from pandastable import TableModel
+from ong_gesfincas.conciliation_model import Conciliation, InvalidAmountError, InvalidFileError
+from ong_gesfincas.conciliation_partition import automatic_bucket_by_finca
+from ong_gesfincas.conciliation_rules import DEFAULT_RULES_FILE, MatchingRules
+from ong_gesfincas.conciliation_pandastable import ConciliationTable, ConciliationTableModel
+from ong_gesfincas.conciliation_tasks import BackgroundTask, ProgressDialog
+from ong_gesfincas.liquidaciones_cmd import BUNDLE_EXTENSION
+from ong_gesfincas.profiling import profiler
 
 
 def ask_excel_filename(**kwargs):
@@ -19,14 +25,26 @@ def ask_excel_filename(**kwargs):
     return file_path
 
 
+def ask_gesfincas_filename(**kwargs):
+    """Calls filedialog.askopenfilename for gesfincas files: Excel files or bundles written by the liquidaciones
+    command (see liquidaciones_cmd.write_bundle), that are read much faster"""
+    return filedialog.askopenfilename(defaultextension=".xlsx", filetypes=[
+        ("Excel Files", "*.xlsx"), ("Liquidaciones procesadas", f"*{BUNDLE_EXTENSION}")], **kwargs)
+
+
+def ask_excel_filenames(**kwargs) -> tuple:
+    """Calls filedialog.askopenfilenames for Excel files. Accepts kwargs to pass to askopenfilenames"""
+    return filedialog.askopenfilenames(defaultextension=".xlsx", filetypes=[("Excel Files", "*.xlsx")], **kwargs)
+
+
 def check_missing_data(f):
     """Decorator that checks if all data is available (bank, incomes and expenses) before executing a command.
     If any is missing gives an informative message and cancels execution"""
 
-    def wrapper(*args):
+    def wrapper(*args, **kwargs):
         self = args[0]
         if self.conciliation.has_all_data:
-            return f(*args)
+            return f(*args, **kwargs)
         else:
             messagebox.showinfo(message="Faltan datos para ejecutar la acción")
 
@@ -42,11 +60,17 @@ class ConciliationApp(Frame):
     _show_unassigned = "no asignados"
     # Color of the rows of the bucketed values
     _color_bucketed = "lightgreen"
+    # Number of suggestions shown in the suggestions panel and the columns with their texts
+    _suggest_k = 10
+    _suggest_text_cols = {DataType.BNK: "Concepto", DataType.EXP: "CONCEPTO", DataType.INC: "Inquilino"}
+    # Milliseconds without typing before searching the text of the search box
+    _search_delay_ms = 300
     # Help url shows README.md in GitHub
     _help_url = "https://github.com/Oneirag/ong_gesfincas#readme"
 
     def __init__(self, filename, parent=None):
         self.conciliation = Conciliation(filename)
+        self.rules = MatchingRules(DEFAULT_RULES_FILE)
         # self.conciliation.automatic_bucket_expenses()
         self.parent = parent
         Frame.__init__(self)
@@ -109,6 +133,20 @@ class ConciliationApp(Frame):
         self.chk_bnk_exp = Button(fr_btn, text="Borrar asignacion banco", command=self.handle_del_bucket_bnk)
         self.chk_bnk_exp.grid(row=0, column=b)
         ###################################
+        # Full-text search (combined with the other filters)
+        ###################################
+        b += 1
+        self.lbl_search = Label(fr_btn, text="Buscar:")
+        self.lbl_search.grid(row=0, column=b)
+        b += 1
+        self.var_search = StringVar(value="")
+        self.ent_search = Entry(fr_btn, textvariable=self.var_search, width=30)
+        self.ent_search.grid(row=0, column=b)
+        self.ent_search.bind("<KeyRelease>", self.handle_search)
+        self.ent_search.bind("<Escape>", self.handle_clear_search)
+        self._search_job = None
+        self._search_text = ""
+        ###################################
         # Label for current match summary
         ###################################
         self.lbl_summary = Label(fr_btn, text="<summary>", )
@@ -119,6 +157,28 @@ class ConciliationApp(Frame):
         self.tables = {k: None for k in DataType}
         self.visible_tables = {k: True for k in DataType}
         self.table_frames = {k: None for k in DataType}
+        ###################################
+        # Pending redraws (see schedule_redraw)
+        ###################################
+        self._redraw_job = None
+        self._dirty_tables = set()
+        self._dirty_summary = False
+        # Conciliation and its version when the summary was last computed (see summary_refresh)
+        self._summary_version = None
+        self._resize_cols = False
+        self._view_positions = dict()
+        ###################################
+        # Suggestions panel (hidden until activated in the menu)
+        ###################################
+        self.fr_suggest = Frame(self.main)
+        Label(self.fr_suggest, text="Sugerencias para la selección (doble click para filtrar)").pack(anchor="w")
+        self.lst_suggest = Listbox(self.fr_suggest, width=70, activestyle="none")
+        self.lst_suggest.pack(fill=BOTH, expand=1)
+        self.lst_suggest.bind("<Double-Button-1>", self.handle_suggestion_selected)
+        self._suggest_job = None
+        self._suggest_table = None  # DataType of the table whose selection is the source of suggestions
+        self._suggestions = None
+        self._task = None  # Background task in progress (see read_in_background)
         self.create_tables()
 
         self.summary_refresh()
@@ -162,11 +222,13 @@ class ConciliationApp(Frame):
 
                     table.show()
                     table.clearFormatting()
+                    self.set_table_formats(table, df)
                     table.autoResizeColumns()
                     self.tables[data_type] = table
                     # if add="+", the event handle is added the previous ones, otherwise replaces the previous ones
                     # table.bind("<Button-2>", self.handle_table_right_click, add="+")
                     table.bind("<Button-2>", self.handle_table_right_click)
+                    table.on_selection_change = self.handle_selection_change
                 else:
                     lbl = Label(f, text=f"Por favor, cargue datos de {data_type.value} para mostrar los valores")
                     lbl.pack()
@@ -192,6 +254,8 @@ class ConciliationApp(Frame):
         load_menu.add_command(label="Fichero de gesfincas", command=lambda: self.handle_gesfincas(update=False))
         load_menu.add_command(label="Extracto del banco", command=lambda: self.handle_bank_data(update=False))
         load_menu.add_command(label="Excel completo", command=lambda: self.handle_read_excel(update=False))
+        load_menu.add_command(label="Extracto del banco y fichero de gesfincas",
+                              command=lambda: self.handle_bank_gesfincas(update=False))
         file_menu.add_separator()
 
         update_menu = Menu(file_menu, tearoff=False)
@@ -199,6 +263,9 @@ class ConciliationApp(Frame):
         update_menu.add_command(label="Fichero de gesfincas", command=lambda: self.handle_gesfincas(update=True))
         update_menu.add_command(label="Extracto del banco", command=lambda: self.handle_bank_data(update=True))
         update_menu.add_command(label="Excel completo", command=lambda: self.handle_read_excel(update=True))
+        update_menu.add_command(label="Extracto del banco y fichero de gesfincas",
+                                command=lambda: self.handle_bank_gesfincas(update=True))
+        file_menu.add_command(label="Añadir nuevo periodo...", command=self.handle_append_period)
         file_menu.add_separator()
 
         file_menu.add_command(label="Guardar Excel completo", command=self.handle_save_to_excel)
@@ -212,9 +279,19 @@ class ConciliationApp(Frame):
                                 # tooltip="\tIntenta puntea automáticamente los datos que no estén ya punteados"
                                 )
 
+        bucket_menu.add_command(label="Conciliar automáticamente por finca",
+                                command=lambda: self.handle_auto_conciliation(by_finca=True))
+
+        bucket_menu.add_separator()
+        bucket_menu.add_command(label="Aprender reglas del punteo actual", command=self.handle_learn_rules)
+        bucket_menu.add_command(label="Aprender reglas de ficheros punteados...", command=self.handle_learn_rules_files)
+        bucket_menu.add_command(label="Borrar reglas aprendidas", command=self.handle_clear_rules)
+        bucket_menu.add_separator()
+
         bucket_menu.add_command(label="Borrar punteos huérfanos", command=self.handle_remove_orphan,
                                 # tooltip="\tElimina los punteos que no están en más de una tabla"
                                 )
+        bucket_menu.add_command(label="Ver punteos con problemas", command=self.handle_show_problems)
         main_menu.add_cascade(label="Conciliar", menu=bucket_menu)
 
         view_menu = Menu(main_menu, tearoff=False)
@@ -227,8 +304,21 @@ class ConciliationApp(Frame):
                               command=lambda: self.handle_show_tables(incomes=False))
         view_menu.add_command(label="Mostrar solo banco e ingresos",
                               command=lambda: self.handle_show_tables(expenses=False))
+        view_menu.add_separator()
+        self.var_suggest = BooleanVar(value=False)
+        view_menu.add_checkbutton(label="Panel de sugerencias", variable=self.var_suggest,
+                                  command=self.handle_suggest_panel)
         main_menu.add_cascade(label="Ver", menu=view_menu)
 
+        performance_menu = Menu(main_menu, tearoff=False)
+        self.var_profile = BooleanVar(value=profiler.enabled)
+        performance_menu.add_checkbutton(label="Medir rendimiento", variable=self.var_profile,
+                                         command=self.handle_profile_enable)
+        performance_menu.add_command(label="Ver informe", command=self.handle_profile_report)
+        performance_menu.add_command(label="Guardar informe json", command=self.handle_profile_save)
+        performance_menu.add_command(label="Borrar medidas", command=profiler.clear)
+        main_menu.add_cascade(label="Rendimiento", menu=performance_menu)
+
         help_menu = Menu(main_menu, tearoff=False)
         help_menu.add_command(label="Ayuda", command=self.handle_help)
         main_menu.add_cascade(label="Ayuda", menu=help_menu)
@@ -240,12 +330,87 @@ class ConciliationApp(Frame):
     def handle_help(self):
         webbrowser.open(self._help_url, new=0, autoraise=True)
 
+    def handle_profile_enable(self):
+        if self.var_profile.get():
+            profiler.enable()
+        else:
+            profiler.disable()
+
+    def handle_profile_report(self):
+        """Shows a window with the report of the measures of the profiler"""
+        if not profiler.records:
+            messagebox.showinfo(message="No hay medidas. Active la medición en el menú Rendimiento")
+            return
+        window = Toplevel(self.main)
+        window.title("Rendimiento")
+        text = Text(window, font=("Courier", 12), wrap=NONE, width=120, height=20)
+        text.insert(END, profiler.report_text())
+        text.config(state=DISABLED)
+        text.pack(fill=BOTH, expand=1)
+
+    def handle_profile_save(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("json", "*.json")])
+        if file_path:
+            profiler.dump_json(file_path)
+
+    def handle_suggest_panel(self):
+        """Shows or hides the suggestions panel"""
+        if self.var_suggest.get():
+            frames = [f for f in self.table_frames.values() if f is not None]
+            self.fr_suggest.pack(side=RIGHT, fill=Y, **(dict(before=frames[0]) if frames else dict()))
+            self.refresh_suggestions()
+        else:
+            self.fr_suggest.pack_forget()
+
+    def handle_selection_change(self, table: ConciliationTable):
+        """Schedules a refresh of the suggestions panel for the new selection of a table"""
+        self._suggest_table = next((data_type for data_type, tbl in self.tables.items() if tbl is table), None)
+        if not self.var_suggest.get():
+            return
+        if self._suggest_job is None:
+            # Wait a bit, so dragging the mouse over many rows does not refresh suggestions for every row
+            self._suggest_job = self.after(150, self.refresh_suggestions)
+
+    def refresh_suggestions(self):
+        """Fills suggestions panel with the rows that best match the selected rows (see Conciliation.suggest)"""
+        self._suggest_job = None
+        self.lst_suggest.delete(0, END)
+        self._suggestions = None
+        data_type = self._suggest_table
+        if data_type is None or not self.conciliation.has_all_data or self.tables[data_type] is None:
+            return
+        table = self.tables[data_type]
+        rows = [row for row in table.get_selected_rows() if 0 <= row < table.model.getRowCount()]
+        if not rows:
+            return  # Nothing selected
+        self._suggestions = self.conciliation.suggest(data_type, table.model.source_positions(rows),
+                                                      self._suggest_k)
+        for suggestion in self._suggestions.itertuples():
+            df = self.conciliation.dfs[suggestion.data_type]
+            texts = df[self._suggest_text_cols[suggestion.data_type]].iloc[list(suggestion.positions)]
+            self.lst_suggest.insert(END, "{}: {:,.2f}€ (dif. {:,.2f}€) {}".format(
+                suggestion.data_type.value, suggestion.value_cents / 100, suggestion.cents_diff / 100,
+                " + ".join(str(text) for text in texts)))
+        if self._suggestions.empty:
+            self.lst_suggest.insert(END, "No hay sugerencias")
+
+    def handle_suggestion_selected(self, event=None):
+        """Filters tables to show the selected rows and the rows of the double-clicked suggestion"""
+        selection = self.lst_suggest.curselection()
+        if self._suggestions is None or not selection or selection[0] >= self._suggestions.shape[0]:
+            return
+        suggestion = self._suggestions.iloc[selection[0]]
+        positions = {data_type: np.array([], dtype=np.int64) for data_type in DataType}
+        positions[self._suggest_table] = self.tables[self._suggest_table].get_selected_positions()
+        positions[suggestion.data_type] = np.array(suggestion.positions, dtype=np.int64)
+        self.schedule_redraw(dict_positions=positions, refresh_summary=False)
+
     def handle_show_tables(self, bank: bool = True, expenses: bool = True, incomes: bool = True):
         self.visible_tables[DataType.BNK] = bank
         self.visible_tables[DataType.EXP] = expenses
         self.visible_tables[DataType.INC] = incomes
         self.create_tables()
-        self.redraw_all_tables()
+        self.schedule_redraw(refresh_summary=False)
 
     def handle_zoom_in(self):
         for table in self.tables.values():
@@ -274,94 +439,336 @@ class ConciliationApp(Frame):
         previous_data = any(self.conciliation.dfs.get(key) is not None for key in df_dict.keys())
         previous_data_str = ", ".join(k.value for k in df_dict.keys())
 
-        if update:
-            if previous_data:
-                self.conciliation.update_dfs(df_dict)
+        try:
+            if update:
+                if previous_data:
+                    self.conciliation.update_dfs(df_dict)
+                else:
+                    messagebox.showinfo(message=f"No hay datos de {previous_data_str}, se cargarán nuevos sin "
+                                                f"actualizar")
+                    self.conciliation.set_dfs(df_dict, read_buckets=False)
             else:
-                messagebox.showinfo(message=f"No hay datos de {previous_data_str}, se cargarán nuevos sin actualizar")
+                if previous_data:
+                    if not messagebox.askyesno(message=f"Hay cargados datos de {previous_data_str}. "
+                                                       f"¿Desea sobreescribirlos y perder el punteo previo?"):
+                        print("salir sin hacer nada")
+                        return
                 self.conciliation.set_dfs(df_dict, read_buckets=False)
-        else:
-            if previous_data:
-                if not messagebox.askyesno(message=f"Hay cargados datos de {previous_data_str}. "
-                                                   f"¿Desea sobreescribirlos y perder el punteo previo?"):
-                    print("salir sin hacer nada")
-                    return
-            self.conciliation.set_dfs(df_dict, read_buckets=False)
+        except InvalidAmountError as iae:
+            messagebox.showerror(message=f"Hay importes no válidos o con fracciones de céntimo, no se han cargado "
+                                         f"los datos: {iae}")
+            return
         self.create_tables()
-        self.redraw_all_tables()
+        self.schedule_redraw()
 
-    def handle_bank_data(self, update=False):
-        bank_file = ask_excel_filename()
-        if bank_file:
-            dict_bank = self.conciliation.read_bank(bank_file)
-            if not dict_bank:
-                messagebox.showerror(message="El fichero seleccionado no tiene datos del banco en su primera hoja")
+    def task_in_progress(self) -> bool:
+        """Returns True (and tells the user) if there is a background task in progress"""
+        if self._task is not None and self._task.running:
+            messagebox.showinfo(message="Espere a que termine la operación en curso")
+            return True
+        return False
+
+    def read_in_background(self, calls: list, on_done, message: str = "Leyendo ficheros..."):
+        """
+        Runs functions that read files in parallel processes, so the window does not freeze while big Excel files
+        are parsed, showing a dialog that allows cancelling them
+        Args:
+            calls: a list of tuples (function, arguments...). Functions and arguments must be picklable, e.g. the
+            readers of an empty Conciliation (see reader) and a filename
+            on_done: function called in the main thread with the list of the results of the calls, unless cancelled
+            message: message shown while reading
+
+        Returns:
+            None
+        """
+        if self.task_in_progress():
+            return
+
+        def done(results: list):
+            dialog.close()
+            on_done(results)
+
+        def error(e: Exception):
+            dialog.close()
+            if isinstance(e, InvalidFileError) and e.missing:
+                messagebox.showinfo(message="El fichero indicado no contiene datos completos. Faltan {}".format(
+                    ", ".join(e.missing)))
             else:
+                messagebox.showerror(message=f"Error al abrir el fichero: {e}")
+
+        def cancel():
+            self._task.cancel()
+            dialog.close()
+
+        dialog = ProgressDialog(self.main, "Cargando datos", message, on_cancel=cancel)
+        self._task = BackgroundTask(self, on_done=done, on_error=error)
+        executor = ProcessPoolExecutor(max_workers=len(calls))
+        for function, *args in calls:
+            self._task.add(executor.submit(function, *args))
+        executor.shutdown(wait=False)  # Processes end when their work is done
+        self._task.start()
+
+    @staticmethod
+    def reader() -> Conciliation:
+        """An empty Conciliation whose read methods can be sent to other processes without copying current data"""
+        return Conciliation()
+
+    def join_bank_results(self, results: list, bank_files: list):
+        """Returns the dict of bank data from the results of reading bank_files, or None (after telling the user) if
+        any file has no bank data"""
+        if len(bank_files) == 1:
+            if not results[0]:
+                messagebox.showerror(message="El fichero seleccionado no tiene datos del banco en su primera hoja")
+                return None
+            return results[0]
+        try:
+            return self.conciliation.join_banks(results, list(bank_files))
+        except InvalidFileError as ife:
+            messagebox.showerror(message="Los siguientes ficheros no tienen datos del banco en su primera hoja: "
+                                         + ", ".join(os.path.basename(file) for file in ife.missing))
+            return None
+
+    def handle_bank_data(self, update=False):
+        """Loads one bank extract or many (one per account, read in parallel) in a single bank table"""
+        bank_files = ask_excel_filenames(title="Extractos del banco (uno por cuenta)")
+        if not bank_files:
+            return
+
+        def done(results: list):
+            dict_bank = self.join_bank_results(results, bank_files)
+            if dict_bank:
                 self.load_or_update(dict_bank, update)
-        pass
+
+        self.read_in_background([(self.reader().read_bank, file) for file in bank_files], done,
+                                "Leyendo extractos del banco...")
 
     def handle_gesfincas(self, update: bool):
-        gesfincas_file = ask_excel_filename()
-        if gesfincas_file:
-            dict_gesfincas = self.conciliation.read_gesfincas(gesfincas_file)
+        gesfincas_file = ask_gesfincas_filename()
+        if not gesfincas_file:
+            return
+
+        def done(results: list):
+            dict_gesfincas = results[0]
             if not dict_gesfincas:
                 messagebox.showerror(message="El fichero seleccionado no tiene datos de gesfincas")
                 return
             # Now set both df to current conciliation
             self.load_or_update(dict_gesfincas, update)
 
+        self.read_in_background([(self.reader().read_gesfincas, gesfincas_file)], done,
+                                "Leyendo fichero de gesfincas...")
+
+    def handle_bank_gesfincas(self, update: bool):
+        """Loads bank extracts and a gesfincas file, reading all of them in parallel"""
+        bank_files = ask_excel_filenames(title="Extractos del banco (uno por cuenta)")
+        if not bank_files:
+            return
+        gesfincas_file = ask_gesfincas_filename(title="Fichero de gesfincas")
+        if not gesfincas_file:
+            return
+
+        def done(results: list):
+            dict_bank = self.join_bank_results(results[:-1], bank_files)
+            if not dict_bank:
+                return
+            if not results[-1]:
+                messagebox.showerror(message="El fichero seleccionado no tiene datos de gesfincas")
+                return
+            self.load_or_update({**dict_bank, **results[-1]}, update)
+
+        reader = self.reader()
+        self.read_in_background([(reader.read_bank, file) for file in bank_files] +
+                                [(reader.read_gesfincas, gesfincas_file)], done,
+                                "Leyendo extractos del banco y fichero de gesfincas...")
+
+    @check_missing_data
+    def handle_append_period(self):
+        """Appends the bank extract and gesfincas file of a new period, keeping (and freezing) current buckets"""
+        bank_files = ask_excel_filenames(title="Extractos del banco del nuevo periodo")
+        if not bank_files:
+            return
+        gesfincas_file = ask_gesfincas_filename(title="Fichero de gesfincas del nuevo periodo")
+        if not gesfincas_file:
+            return
+        period = simpledialog.askstring("Nuevo periodo", "Nombre del periodo (p.ej. 2024-03):",
+                                        initialvalue=datetime.date.today().strftime("%Y-%m"), parent=self.main)
+        if not period:
+            return
+
+        def done(results: list):
+            df_dict = self.join_bank_results(results[:-1], bank_files)
+            if not df_dict:
+                return
+            if not results[-1]:
+                messagebox.showerror(message="El fichero seleccionado no tiene datos de gesfincas")
+                return
+            try:
+                appended = self.conciliation.append_period({**df_dict, **results[-1]}, period)
+            except InvalidAmountError as iae:
+                messagebox.showerror(message=f"Hay importes no válidos o con fracciones de céntimo, no se ha añadido "
+                                             f"el periodo: {iae}")
+                return
+            self.create_tables()
+            self.schedule_redraw(auto_resize_cols=True)
+            messagebox.showinfo(message=f"Periodo {period} añadido: " + ", ".join(
+                f"{rows} filas de {key.value}" for key, rows in appended.items()) +
+                                        ". Los punteos de periodos anteriores quedan cerrados")
+
+        reader = self.reader()
+        self.read_in_background([(reader.read_bank, file) for file in bank_files] +
+                                [(reader.read_gesfincas, gesfincas_file)], done,
+                                f"Leyendo datos del periodo {period}...")
+
     @check_missing_data
     def handle_remove_orphan(self):
         orphans = self.conciliation.clear_orphan_buckets()
         messagebox.showinfo(message=f"Se han borrado {len(orphans)} punteos huérfanos")
-        self.redraw_all_tables()
-        self.summary_refresh()
+        self.schedule_redraw()
+
+    @check_missing_data
+    def handle_show_problems(self):
+        """Filters the tables to show the rows of the buckets with problems (see Conciliation.validate_buckets)"""
+        problems = self.conciliation.validate_buckets()
+        if problems.empty:
+            messagebox.showinfo(message="No hay punteos con problemas")
+            return
+        buckets = problems[self.conciliation.col_bucket].unique()
+        self.schedule_redraw(dict_positions={key: self.conciliation.bucket_positions(key, buckets)
+                                             for key in self.conciliation.dfs}, refresh_summary=False)
+        lines = []
+        for problem, group in problems.groupby("problema", sort=False)[self.conciliation.col_bucket]:
+            lines.append(f"{problem} ({len(group)}): " + ", ".join(str(bucket) for bucket in group.iloc[:20]) +
+                         (", ..." if len(group) > 20 else ""))
+        messagebox.showinfo(message=f"Se muestran las filas de {len(buckets)} punteos con problemas:\n" +
+                                    "\n".join(lines))
 
     @check_missing_data
-    def handle_auto_conciliation(self):
+    def handle_auto_conciliation(self, by_finca: bool = False):
+        """Runs automatic conciliation in a background thread, over a copy of the data. Buckets found are assigned
+        to the data shown in batches, so tables and summary are updated while it runs, and it can be stopped keeping
+        the buckets found so far"""
+        if self.task_in_progress():
+            return
         old_conciliation = {key: df[~df[self.conciliation.col_bucket].isna()].shape[0]
                             for key, df in self.conciliation.dfs.items()}
-        self.conciliation.automatic_bucket_expenses()
-        new_conciliation = {key: df[~df[self.conciliation.col_bucket].isna()].shape[0]
-                            for key, df in self.conciliation.dfs.items()}
-        self.redraw_all_tables()
-        self.summary_refresh()
-        message = "\n".join([f"Filas punteadas de {key1.value}: {value1} ({value1 - value2} nuevas)"
-                             for (key1, value1), (key2, value2) in zip(new_conciliation.items(),
-                                                                       old_conciliation.items())])
-        messagebox.showinfo("Nuevo punteo", message)
+        rules = self.rules if len(self.rules) else None
+        work = self.conciliation.subset(dict())  # Copy, so tables can be redrawn while the worker changes it
+
+        def match(task: BackgroundTask):
+            next_bucket = [work.get_next_bucket()]
+
+            def progress(step: str, done: int, total: int) -> bool:
+                # Send the buckets found since last call to the main thread
+                buckets = work.bucket_list(next_bucket[0])
+                next_bucket[0] = work.get_next_bucket()
+                task.report(step, done, total, buckets)
+                return task.stopped
+
+            if by_finca:
+                automatic_bucket_by_finca(work, rules=rules, progress=progress)
+            else:
+                work.automatic_bucket_expenses(rules=rules, progress=progress)
+            progress("Fin", 1, 1)  # Last buckets found
+
+        def show_progress(step: str, done: int, total: int, buckets: list):
+            self.bucket_unassigned(buckets)
+            dialog.update_progress(message=f"{step}: {done} de {total} movimientos", value=done, maximum=total)
+            self.schedule_redraw()
+
+        def done(results: list):
+            dialog.close()
+            new_conciliation = {key: df[~df[self.conciliation.col_bucket].isna()].shape[0]
+                                for key, df in self.conciliation.dfs.items()}
+            self.schedule_redraw()
+            message = "\n".join([f"Filas punteadas de {key1.value}: {value1} ({value1 - value2} nuevas)"
+                                 for (key1, value1), (key2, value2) in zip(new_conciliation.items(),
+                                                                           old_conciliation.items())])
+            if self._task.stopped:
+                message = "Punteo automático detenido\n" + message
+            messagebox.showinfo("Nuevo punteo", message)
+
+        def error(e: Exception):
+            dialog.close()
+            messagebox.showerror(message=f"Error en el punteo automático: {e}")
+
+        dialog = ProgressDialog(self.main, "Punteo automático", "Preparando datos...", cancel_text="Detener",
+                                on_cancel=lambda: self._task.stop())
+        self._task = BackgroundTask(self, on_done=done, on_error=error, on_progress=show_progress)
+        self._task.run_thread(match, self._task)
+        self._task.start()
+
+    def bucket_unassigned(self, buckets: list) -> int:
+        """Assigns the buckets (tuples as for Conciliation.bucket_many) whose rows are all still unassigned (e.g.
+        they were not assigned by hand while they were being found). Returns the number of buckets assigned"""
+        def unassigned(data_type: DataType, idx) -> bool:
+            if idx is None:
+                return True
+            positions = self.conciliation.dfs[data_type].index.get_indexer(np.atleast_1d(idx))
+            return not self.conciliation.bucket_index(data_type).assigned_mask[positions].any()
+
+        buckets = [(idx_bank, idx_exp, idx_inc) for idx_bank, idx_exp, idx_inc in buckets
+                   if unassigned(DataType.BNK, idx_bank) and unassigned(DataType.EXP, idx_exp) and
+                   unassigned(DataType.INC, idx_inc)]
+        self.conciliation.bucket_many(buckets)
+        return len(buckets)
+
+    @check_missing_data
+    def handle_learn_rules(self):
+        """Learns matching rules from the current buckets"""
+        learnt = self.rules.learn(self.conciliation)
+        self.rules.save()
+        messagebox.showinfo("Reglas", f"Se han aprendido {learnt} punteos. Hay {len(self.rules)} reglas")
+
+    def handle_learn_rules_files(self):
+        """Learns matching rules from Excel files saved with 'Guardar Excel completo'"""
+        file_paths = filedialog.askopenfilenames(filetypes=[("Excel files", "*.xlsx")])
+        if not file_paths:
+            return
+        learnt = 0
+        for file_path in file_paths:
+            try:
+                learnt += self.rules.learn_file(file_path)
+            except InvalidFileError as e:
+                messagebox.showerror(message=f"El fichero {file_path} no es válido: {e}")
+        self.rules.save()
+        messagebox.showinfo("Reglas", f"Se han aprendido {learnt} punteos. Hay {len(self.rules)} reglas")
+
+    def handle_clear_rules(self):
+        if messagebox.askyesno(message=f"¿Desea borrar las {len(self.rules)} reglas aprendidas?"):
+            self.rules.clear()
+            self.rules.save()
 
     def handle_read_excel(self, update=False):
         file_path = ask_excel_filename()
+        if not file_path:
+            return
         existing_data = self.conciliation.has_all_data
-        try:
-            if file_path:
-                if update:
-                    if existing_data:
-                        self.conciliation.read(file_path)
-                    else:
-                        self.conciliation.update(file_path)
+        if not update and existing_data:
+            if not messagebox.askyesno(message="Ya hay datos cargados. ¿Desea continuar y perder los cambios?"):
+                return
+
+        def done(results: list):
+            try:
+                # Same as self.conciliation.update(file_path) or self.conciliation.read(file_path)
+                if update and not existing_data:
+                    self.conciliation.update_dfs(results[0])
                 else:
-                    if existing_data:
-                        if not messagebox.askyesno(
-                                message="Ya hay datos cargados. ¿Desea continuar y perder los cambios?"):
-                            return
-                    self.conciliation.read(file_path)
-        except InvalidFileError as ife:
-            messagebox.showinfo(message="El fichero indicado no contiene datos completos. Faltan {}".format(
-                ", ".join(ife.missing)))
-            return
-        except Exception as e:
-            messagebox.showerror(message="Error al abrir el fichero: {e}")
+                    self.conciliation.set_dfs(results[0])
+            except Exception as e:
+                messagebox.showerror(message=f"Error al abrir el fichero: {e}")
+            self.show_loaded_data()
+
+        self.read_in_background([(self.reader().read_dfs, file_path)], done, "Leyendo excel completo...")
 
+    def show_loaded_data(self):
+        """Creates tables again with the data of the model"""
         self.create_tables()
         for key, table in self.tables.items():
             if table is not None:
-                table.updateModel(TableModel(self.conciliation.dfs[key]))
+                table.updateModel(ConciliationTableModel(self.conciliation.dfs[key]))
                 # table.clearFormatting()
                 # table.redraw()
-        self.redraw_all_tables(auto_resize_cols=True)
-        self.summary_refresh()
+        self.schedule_redraw(auto_resize_cols=True)
 
     @check_missing_data
     def handle_save_to_excel(self):
@@ -383,7 +790,13 @@ class ConciliationApp(Frame):
             self.quit()
 
     def summary_refresh(self):
-        """Refreshes summary label with current selection"""
+        """Refreshes summary label with current selection. Totals and problems are only computed again if data or
+        buckets changed since the last time (see Conciliation.version)"""
+        version = (self.conciliation, self.conciliation.version)
+        if self._summary_version is not None and self._summary_version[0] is version[0] and \
+                self._summary_version[1] == version[1]:
+            return
+        self._summary_version = version
 
         def frmt(value):
             return format(value, ",.2f") + "€"
@@ -394,7 +807,12 @@ class ConciliationApp(Frame):
         def sum_cts_str(df) -> str:
             return frmt(sum_cts(df))
 
-        summary_df, summary_dict = self.conciliation.check_buckets()
+        problems = self.conciliation.validate_buckets() if self.conciliation.has_all_data else None
+        if problems is not None and (problems["problema"] == self.conciliation.PROBLEM_MIXED).any():
+            # check_buckets cannot split the bank among expenses and incomes
+            summary_df, summary_dict = None, None
+        else:
+            summary_df, summary_dict = self.conciliation.check_buckets()
         if summary_df is not None:
             txt = "Sin asignar: banco {only_bnk} gastos {only_exp} ingresos {only_inc}".format(
                 only_bnk=sum_cts_str(summary_dict["only_bnk"]), only_exp=sum_cts_str(summary_dict["only_exp"]),
@@ -409,8 +827,17 @@ class ConciliationApp(Frame):
                 bnk_inc=sum_cts_str(summary_dict["bnk_inc"]), dif_bnk_inc=dif_bnk_inc,
                 bnk_exp=sum_cts_str(summary_dict["bnk_exp"]), dif_bnk_exp=dif_bnk_exp
             )
+            by_account = self.conciliation.check_buckets_by_account()
+            if by_account is not None and by_account.shape[0] > 1:
+                txt += "\nSin asignar por cuenta: " + ", ".join(f"{account} {frmt(value)}" for account, value in
+                                                             by_account["banco solo"].items())
+        elif problems is not None:
+            txt = "No se pueden calcular los totales"
         else:
             txt = "No hay datos"
+        if problems is not None and not problems.empty:
+            txt += "\nPunteos con problemas (Conciliar->Ver punteos con problemas): " + ", ".join(
+                f"{count} {problem}" for problem, count in problems["problema"].value_counts(sort=False).items())
         self.lbl_summary.config(text=txt)
 
     @check_missing_data
@@ -419,10 +846,11 @@ class ConciliationApp(Frame):
         tbl_bnk = self.tables[DataType.BNK]
         buckets = tbl_bnk.getSelectedRowData()[self.conciliation.col_bucket].dropna()
         if not buckets.empty:
+            if buckets.astype(int).isin(self.conciliation.frozen_buckets).any():
+                messagebox.showinfo(message="Las asignaciones de periodos cerrados no se borrarán")
             if messagebox.askyesno(message="¿Desea borrar las asignaciones marcadas?"):
                 self.conciliation.unbucket(buckets.values)
-                self.summary_refresh()
-                self.redraw_all_tables()
+                self.schedule_redraw()
         else:
             messagebox.showinfo(message="No se han marcado filas asignadas en el banco")
 
@@ -457,10 +885,9 @@ class ConciliationApp(Frame):
                 return
 
         self.conciliation.bucket(bnk.index, **{f"idx_{other_name}": other.index})
-        self.summary_refresh()
         table_bnk.selectNone()
         table_other.selectNone()
-        self.redraw_all_tables()
+        self.schedule_redraw(data_types=(DataType.BNK, datatype_other))
         self.tables[DataType.BNK].focus()
         self.var_filter_by.set("")
 
@@ -476,47 +903,110 @@ class ConciliationApp(Frame):
         self._bucket_bnk_df(DataType.EXP, "expenses")
         return
 
+    def handle_search(self, event=None):
+        """Filters the tables with the text of the search box, once the user stops typing"""
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(self._search_delay_ms, self.apply_search)
+
+    def handle_clear_search(self, event=None):
+        self.var_search.set("")
+        self.handle_search()
+
+    def apply_search(self):
+        self._search_job = None
+        text = self.var_search.get().strip()
+        if text != self._search_text:
+            self._search_text = text
+            # Keep the other filters
+            self.schedule_redraw(dict_positions=self._view_positions, refresh_summary=False)
+
     @check_missing_data
     def handle_filter_unassigned(self):
-        self.redraw_all_tables()
+        self.schedule_redraw(refresh_summary=False)
 
-    def redraw_all_tables(self, dict_dfs=None, auto_resize_cols=False):
+    def schedule_redraw(self, data_types=None, dict_positions: dict = None, auto_resize_cols: bool = False,
+                        refresh_summary: bool = True):
         """
-        Redraw all tables. Checks the status of self.filter_df to display all rows or just unassigned ones
+        Marks tables as dirty and schedules a single redraw of all the dirty tables (and the summary) when tk is
+        idle, so several changes in a row are drawn just once
         Args:
-            dict_dfs: a dict of dfs to assign to the tables (for applying filters), indexed by DataType
+            data_types: an iterable of the DataTypes of the tables whose data changed. None (default) for all tables
+            dict_positions: a dict of numpy arrays with the row positions of each df to show in the tables (for
+            applying filters), indexed by DataType. None (default) to remove filters. If filters change, all tables
+            are redrawn
             auto_resize_cols: if true, force autoresize columns (only when reading/updating data)
+            refresh_summary: if true (default), refresh also the summary label
         Returns:
             None
         """
-        dict_dfs = dict_dfs or {}
-        for data_type in DataType:
-            df = dict_dfs.get(data_type, self.conciliation.dfs.get(data_type, None))
+        dict_positions = dict_positions or dict()
+        if dict_positions or self._view_positions:
+            data_types = None   # Filter changed: all tables must be redrawn
+        self._view_positions = dict_positions
+        self._dirty_tables.update(DataType if data_types is None else data_types)
+        self._dirty_summary |= refresh_summary
+        self._resize_cols |= auto_resize_cols
+        if self._redraw_job is None:
+            self._redraw_job = self.after_idle(self._flush_redraw)
+
+    def _flush_redraw(self):
+        """Redraws the tables marked as dirty by schedule_redraw"""
+        self._redraw_job = None
+        data_types, self._dirty_tables = self._dirty_tables, set()
+        self.redraw_all_tables(self._view_positions, auto_resize_cols=self._resize_cols, data_types=data_types)
+        self._resize_cols = False
+        if self._dirty_summary:
+            self._dirty_summary = False
+            self.summary_refresh()
+
+    def set_table_formats(self, tbl: ConciliationTable, df: pd.DataFrame):
+        """Sets column formats of a table for the columns of the given df"""
+        # Align left ("e") numeric dtypes and also bucket column
+        for col in df.columns:
+            if pd.api.types.is_numeric_dtype(df[col].dtype):
+                tbl.columnformats['alignment'][col] = "e"
+            # elif df[col].apply(lambda x: isinstance(x, str)).all():     # All column is text...
+            #     tbl.columnwidths[col] = max(tbl.columnwidths[col], df[col].str.len().max())
+        # colbucket is not found as numeric as might have None values
+        tbl.columnformats['alignment'][self.conciliation.col_bucket] = "e"
+
+    def redraw_all_tables(self, dict_positions=None, auto_resize_cols=False, data_types=None):
+        """
+        Redraw all tables. Checks the status of self.filter_df to display all rows or just unassigned ones, and
+        the text of the search box.
+        Use schedule_redraw instead to avoid redrawing several times in a row
+        Args:
+            dict_positions: a dict of numpy arrays with the row positions of each df to show in the tables (for
+            applying filters), indexed by DataType
+            auto_resize_cols: if true, force autoresize columns (only when reading/updating data)
+            data_types: an iterable of the DataTypes of the tables to redraw. None (default) for all tables
+        Returns:
+            None
+        """
+        dict_positions = dict_positions or {}
+        for data_type in DataType if data_types is None else data_types:
+            df = self.conciliation.dfs.get(data_type, None)
             tbl = self.tables.get(data_type, None)
             if df is not None and tbl is not None:
+                positions = dict_positions.get(data_type, None)
+                if self._search_text:
+                    found = self.conciliation.search(data_type, self._search_text)
+                    positions = found if positions is None else np.intersect1d(positions, found)
                 var_show = self.var_show.get()
-                if var_show == self._show_unassigned:
-                    df_paint = df[df[self.conciliation.col_bucket].isna()]
-                elif var_show == self._show_assigned:
-                    df_paint = df[~df[self.conciliation.col_bucket].isna()]
-                else:
-                    df_paint = df
-                # Align left ("e") numeric dtypes and also bucket column
-                for col in df.columns:
-                    if pd.api.types.is_numeric_dtype(df[col].dtype):
-                        tbl.columnformats['alignment'][col] = "e"
-                    # elif df[col].apply(lambda x: isinstance(x, str)).all():     # All column is text...
-                    #     tbl.columnwidths[col] = max(tbl.columnwidths[col], df[col].str.len().max())
-                # colbucket is not found as numeric as might have None values
-                tbl.columnformats['alignment'][self.conciliation.col_bucket] = "e"
+                index = self.conciliation.bucket_index(data_type)
+                if var_show in (self._show_assigned, self._show_unassigned):
+                    assigned = var_show == self._show_assigned
+                    if positions is None:
+                        positions = index.assigned if assigned else index.unassigned
+                    else:
+                        show = index.assigned_mask[positions]
+                        positions = positions[show if assigned else ~show]
                 if auto_resize_cols:
                     tbl.autoResizeColumns()
-                tbl.set_df_redraw(df_paint)
-                # Change color of the lines bucketed and reset color for the rest
-                colored = np.argwhere(~df_paint[self.conciliation.col_bucket].isna()).flatten().tolist()
-                not_colored = np.argwhere(df_paint[self.conciliation.col_bucket].isna()).flatten().tolist()
-                tbl.setRowColors(colored, clr=self._color_bucketed, cols="all")
-                tbl.setRowColors(not_colored, clr="", cols="all")  # Clear colors
+                # Color the lines bucketed. The table only reads the mask for the visible rows
+                tbl.set_highlight(index.assigned_mask, self._color_bucketed)
+                tbl.set_view_redraw(df, positions)
 
     def filter_sum_df(self, data_type: DataType):
         """
@@ -527,25 +1017,21 @@ class ConciliationApp(Frame):
             None
         """
         if data_type is None:
-            self.redraw_all_tables()
+            self.schedule_redraw(refresh_summary=False)
             return
-        selected_rows = self.tables[data_type].getSelectedRowData()
-        sum_tbl = selected_rows[self.conciliation.col_cents].sum()
+        selected_positions = self.tables[data_type].get_selected_positions()
+        sum_tbl = self.conciliation.dfs[data_type][self.conciliation.col_cents].values[selected_positions].sum()
         # filter rows to match sum of selected rows of given data_type
         offset = 2
-        dfs = dict()
-        for key, df in self.conciliation.dfs.items():
-            # For the other tables, find those having a sum close to the sum of the selected rows
-            if key != data_type:
-                dfs[key] = df[df[self.conciliation.col_cents].between(sum_tbl - offset, sum_tbl + offset)]
-            else:
-                # For the current table, if more than 1 row is selected, keep current selection
-                if selected_rows.shape[0] > 1:
-                    dfs[key] = self.tables[data_type].getSelectedRowData()
-                else:
-                    # Otherwise, select all the rest that have exactly the same value
-                    dfs[key] = df[df[self.conciliation.col_cents] == sum_tbl]
-        self.redraw_all_tables(dict_dfs=dfs)
+        # For the other tables, find those having a sum close to the sum of the selected rows
+        positions = self.conciliation.find_amount(sum_tbl, offset)
+        # For the current table, if more than 1 row is selected, keep current selection
+        if len(selected_positions) > 1:
+            positions[data_type] = selected_positions
+        else:
+            # Otherwise, select all the rest that have exactly the same value
+            positions[data_type] = self.conciliation.find_amount(sum_tbl, data_types=[data_type])[data_type]
+        self.schedule_redraw(dict_positions=positions, refresh_summary=False)
 
     @check_missing_data
     def handle_filter_by(self):
@@ -566,11 +1052,11 @@ class ConciliationApp(Frame):
                     return
                 else:
                     # Only assigned -> filter rows to match the assigned bank selected rows
-                    dfs = {key: df[df[self.conciliation.col_bucket].isin(buckets.values)]
-                           for key, df in self.conciliation.dfs.items()}
-                    self.redraw_all_tables(dict_dfs=dfs)
+                    positions = {key: self.conciliation.bucket_positions(key, buckets.unique())
+                                 for key in self.conciliation.dfs}
+                    self.schedule_redraw(dict_positions=positions, refresh_summary=False)
         else:
-            self.redraw_all_tables()
+            self.schedule_redraw(refresh_summary=False)
 
 
 def main(initial_filename=None):
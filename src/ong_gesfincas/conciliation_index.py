@@ -0,0 +1,420 @@
+"""
+Indexes over conciliation data, used to find matching candidates without scanning whole DataFrames
+"""
+import math
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+# Words of the names of the fincas that don't help to tell a finca from another
+_GENERIC_WORDS = {"C", "CL", "CALLE", "AV", "AVD", "AVDA", "AVENIDA", "PASEO", "PS", "PZ", "PZA", "PLAZA", "CTRA",
+                  "CARRETERA", "DE", "DEL", "LA", "LAS", "EL", "LOS", "Y", "N", "NO", "NUM", "S", "SN"}
+
+
+def normalize_text(text) -> str:
+    """Returns text in uppercase, without accents and with any non-alphanumeric character changed to a space"""
+    if not isinstance(text, str):
+        return ""
+    text = unicodedata.normalize("NFKD", text.upper()).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^A-Z0-9]+", " ", text).strip()
+
+
+def tokenize(text) -> list:
+    """Returns the list of words of the normalized text"""
+    return normalize_text(text).split()
+
+
+class FincaIndex:
+    """
+    Inverted index of the words of texts that refer to fincas (their names, the names of their tenants...), to infer
+    the fincas that another text (e.g. a bank concept) refers to
+    """
+
+    def __init__(self, fincas=()):
+        """
+        Creates index
+        Args:
+            fincas: an iterable of the names of the fincas (repeated names and non-string values are ignored)
+        """
+        self.fincas = []  # Finca of each text added
+        self.words = dict()  # Word -> list of positions of the texts in self.fincas
+        self.n_words = []  # Number of words of each text
+        for finca in dict.fromkeys(fincas):
+            self.add(finca, finca)
+
+    def add(self, text, finca):
+        """Adds a text that refers to a finca. Non-string texts or fincas are ignored"""
+        if not isinstance(finca, str):
+            return
+        words = set(tokenize(text)) - _GENERIC_WORDS
+        if not words:
+            return
+        position = len(self.fincas)
+        self.fincas.append(finca)
+        self.n_words.append(len(words))
+        for word in words:
+            self.words.setdefault(word, []).append(position)
+
+    def candidates(self, text) -> list:
+        """
+        Returns the fincas that text most likely refers to: those of the texts with the highest ratio of their words
+        found in the text. At least a word that is not a number must be found
+        Args:
+            text: any text (e.g. a bank concept)
+
+        Returns:
+            a list of names of fincas. Empty if none was found, more than one if there is a tie
+        """
+        found = dict()
+        has_name = set()
+        for word in set(tokenize(text)):
+            for position in self.words.get(word, ()):
+                found[position] = found.get(position, 0) + 1
+                if not word.isdigit():
+                    has_name.add(position)
+        scores = {position: count / self.n_words[position] for position, count in found.items()
+                  if position in has_name}
+        if not scores:
+            return []
+        best = max(scores.values())
+        return list(dict.fromkeys(self.fincas[position] for position, score in scores.items() if score == best))
+
+
+def to_days(dates) -> np.ndarray:
+    """Converts an iterable of dates (or strings with ISO dates or dates with the day first) to a float array of days
+    since 1970-01-01, with nan for missing or invalid dates"""
+    dates = pd.Series(dates)
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = dates.astype(object)
+        iso = pd.to_datetime(dates, errors="coerce", format="ISO8601")
+        dates = iso.fillna(pd.to_datetime(dates[iso.isna()], errors="coerce", format="mixed", dayfirst=True))
+    return ((dates - pd.Timestamp(0)) / pd.Timedelta(days=1)).to_numpy(dtype=float, na_value=np.nan)
+
+
+def _group_positions(keys: list, mask: np.ndarray) -> dict:
+    """Returns a dict of the positions (where mask is True) of the rows with each value of the keys"""
+    positions = np.flatnonzero(mask)
+    if not len(positions):
+        return dict()
+    keys = [key[positions] for key in keys]
+    groups = pd.Series(positions).groupby(keys if len(keys) > 1 else keys[0]).indices
+    return {key: positions[idx] for key, idx in groups.items()}
+
+
+class AmountDateIndex:
+    """
+    Blocking index of the rows of a DataFrame by amount (in cents) and date, to find the rows with a given amount
+    and a date within window_days of a given date without scanning the whole DataFrame. Dates are grouped in blocks
+    of window_days days, so only three blocks are checked for each query.
+    Rows without date are candidates for any date, and any row with the amount is a candidate for a missing date.
+    Rows are identified by their position, or by the given positions if the index is built just for some rows of a
+    bigger DataFrame (e.g. the rows not assigned yet). Rows assigned later must be removed from the index with remove
+    """
+
+    _EMPTY = np.array([], dtype=np.int64)
+
+    def __init__(self, cents, dates=None, window_days: int = None, positions=None):
+        """
+        Creates index
+        Args:
+            cents: an iterable of integer amounts in cents
+            dates: an optional iterable of dates (same length as cents)
+            window_days: maximum difference in days between dates of candidates. If None, dates are ignored
+            positions: optional positions (in ascending order) that identify the rows instead of 0, 1, 2...
+        """
+        cents = np.asarray(cents, dtype=np.int64)
+        self.positions = None if positions is None else np.asarray(positions, dtype=np.int64)
+        self.window_days = window_days or None
+        if dates is None or self.window_days is None:
+            self.days = np.full(len(cents), np.nan)
+        else:
+            self.days = to_days(dates)
+        self.removed = np.zeros(len(cents), dtype=bool)
+        dated = ~np.isnan(self.days)
+        self.by_cents = _group_positions([cents], np.ones(len(cents), dtype=bool))
+        self.amounts = np.array(sorted(self.by_cents), dtype=np.int64)  # Amounts found, sorted
+        self.undated = _group_positions([cents], ~dated)
+        self.by_block = _group_positions([cents, np.floor(self.days / (self.window_days or 1))], dated)
+
+    def remove(self, positions):
+        """Removes rows (e.g. because they have been assigned) so they are not candidates anymore"""
+        if self.positions is not None:
+            positions = np.searchsorted(self.positions, positions)
+        self.removed[positions] = True
+
+    def candidates(self, cents: int, day: float = np.nan) -> np.ndarray:
+        """
+        Returns the positions (sorted) of the rows not removed with the given amount and a date within the window
+        Args:
+            cents: amount in cents
+            day: date, as days since 1970-01-01 (see to_days). If nan, dates are not checked
+
+        Returns:
+            a numpy array of positions
+        """
+        if self.window_days is None or np.isnan(day):
+            found = self.by_cents.get(cents, self._EMPTY)
+        else:
+            block = np.floor(day / self.window_days)
+            dated = np.concatenate([self.by_block.get((cents, b), self._EMPTY) for b in (block - 1, block, block + 1)])
+            dated = dated[np.abs(self.days[dated] - day) <= self.window_days]
+            found = np.sort(np.concatenate([dated, self.undated.get(cents, self._EMPTY)]))
+        found = found[~self.removed[found]]
+        return found if self.positions is None else self.positions[found]
+
+    def candidates_between(self, min_cents: float, max_cents: float, day: float = np.nan) -> np.ndarray:
+        """Same as candidates, but for any amount between min_cents and max_cents (both included)"""
+        # Only the amounts found in the range are checked
+        start = np.searchsorted(self.amounts, np.ceil(min_cents), side="left")
+        end = np.searchsorted(self.amounts, np.floor(max_cents), side="right")
+        found = [self.candidates(int(cents), day) for cents in self.amounts[start:end]]
+        return np.sort(np.concatenate(found)) if found else self._EMPTY
+
+
+class AmountIndex:
+    """
+    Sorted index of the amounts (in cents) of the rows of a DataFrame, to find the rows with a given amount or with an
+    amount in a range with a binary search instead of scanning the whole DataFrame
+    """
+
+    def __init__(self, cents):
+        """
+        Creates index
+        Args:
+            cents: an iterable of integer amounts in cents. Rows are identified by position
+        """
+        cents = np.asarray(cents, dtype=np.int64)
+        self.positions = np.argsort(cents, kind="stable")
+        self.cents = cents[self.positions]
+
+    def __len__(self):
+        return len(self.cents)
+
+    def between(self, min_cents: float, max_cents: float) -> np.ndarray:
+        """Returns the positions (sorted) of the rows with an amount between min_cents and max_cents (both
+        included)"""
+        start = np.searchsorted(self.cents, np.ceil(min_cents), side="left")
+        end = np.searchsorted(self.cents, np.floor(max_cents), side="right")
+        return np.sort(self.positions[start:end])
+
+    def equal(self, cents: float) -> np.ndarray:
+        """Returns the positions (sorted) of the rows with the given amount"""
+        return self.between(cents, cents)
+
+
+class TextIndex:
+    """
+    Inverted index of the words of a list of texts, to find the texts most similar to a given one. Similarity is the
+    weighted Jaccard index of their words, each word weighted by its idf (so very common words count less)
+    """
+
+    _EMPTY = np.array([], dtype=np.int64)
+
+    def __init__(self, texts):
+        """
+        Creates index
+        Args:
+            texts: an iterable of texts (non-string values are taken as empty texts). They are identified by position
+        """
+        self.texts = [text if isinstance(text, str) else "" for text in texts]
+        self.tokens = [frozenset(tokenize(text)) for text in self.texts]
+        positions = dict()
+        for position, tokens in enumerate(self.tokens):
+            for word in tokens:
+                positions.setdefault(word, []).append(position)
+        self.words = {word: np.array(value, dtype=np.int64) for word, value in positions.items()}
+        n_texts = len(self.tokens)
+        self.idf = {word: float(np.log((1 + n_texts) / (1 + len(value)))) + 1 for word, value in self.words.items()}
+
+    def _weight(self, words) -> float:
+        # Unknown words weight as the rarest ones. fsum does not depend on the (hash based) order of the words
+        return math.fsum(self.idf.get(word, np.log(1 + len(self.tokens)) + 1) for word in words)
+
+    def similarity(self, text: str, positions) -> np.ndarray:
+        """Returns the similarity (0 to 1) of text with the texts at the given positions"""
+        tokens = frozenset(tokenize(text))
+        return np.array([self._weight(tokens & self.tokens[position]) / (self._weight(tokens | self.tokens[position])
+                                                                        or 1)
+                         for position in positions], dtype=float)
+
+    def search(self, text: str, limit: int = 100) -> np.ndarray:
+        """Returns the positions of up to limit texts sharing words with text, most similar first"""
+        tokens = [word for word in frozenset(tokenize(text)) if word in self.words]
+        if not tokens:
+            return self._EMPTY
+        positions = np.concatenate([self.words[word] for word in tokens])
+        weights = np.concatenate([np.full(len(self.words[word]), self.idf[word]) for word in tokens])
+        shared = np.bincount(positions, weights=weights, minlength=len(self.tokens))
+        found = np.flatnonzero(shared)
+        # Weight of shared words is a good estimate of similarity, so only the best ones are fully compared
+        found = found[np.argsort(-shared[found], kind="stable")[:limit * 4]]
+        similarity = self.similarity(text, found)
+        return found[np.argsort(-similarity, kind="stable")[:limit]]
+
+
+class BucketIndex:
+    """
+    Index of the rows of a DataFrame by bucket: the positions of the rows of each bucket and of the assigned and
+    unassigned rows, so filtering by buckets or by status does not scan the DataFrame. If the amounts of the rows are
+    given, it also keeps the total amount of each bucket. It is built with a single pass over the bucket column and
+    then updated when rows are assigned or unassigned
+    """
+
+    _EMPTY = np.array([], dtype=np.int64)
+
+    def __init__(self, buckets, cents=None):
+        """
+        Creates index
+        Args:
+            buckets: an iterable with the bucket of each row (None or nan for unassigned rows)
+            cents: an optional iterable with the amount of each row, in cents, to keep the totals of each bucket
+        """
+        self.buckets = pd.to_numeric(pd.Series(buckets, dtype=object), errors="coerce").to_numpy(
+            dtype=float, na_value=np.nan, copy=True)
+        self.assigned_mask = ~np.isnan(self.buckets)
+        self.by_bucket = {int(bucket): positions for bucket, positions in
+                          _group_positions([self.buckets], self.assigned_mask).items()}
+        self.cents = None if cents is None else np.asarray(cents, dtype=np.int64)
+        # Cents of each bucket
+        self.totals = None if cents is None else {bucket: int(self.cents[positions].sum())
+                                                  for bucket, positions in self.by_bucket.items()}
+        self._assigned = None
+        self._unassigned = None
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def assign(self, positions, buckets):
+        """Assigns rows to buckets
+        Args:
+            positions: positions of the rows
+            buckets: the bucket of each row (or a single bucket for all of them)
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        buckets = np.broadcast_to(np.asarray(buckets, dtype=float), positions.shape)
+        # Rows that were in other buckets are removed from them
+        old = self.buckets[positions]
+        for bucket in np.unique(old[~np.isnan(old)]):
+            remaining = np.setdiff1d(self.by_bucket.pop(int(bucket)), positions, assume_unique=True)
+            if len(remaining):
+                self.by_bucket[int(bucket)] = remaining
+            if self.totals is not None:
+                total = self.totals.pop(int(bucket)) - int(self.cents[positions[old == bucket]].sum())
+                if len(remaining):
+                    self.totals[int(bucket)] = total
+        self.buckets[positions] = buckets
+        self.assigned_mask[positions] = True
+        for bucket, new_positions in _group_positions([buckets], np.ones(len(positions), dtype=bool)).items():
+            new_positions = positions[new_positions]
+            old_positions = self.by_bucket.get(int(bucket))
+            self.by_bucket[int(bucket)] = (np.sort(new_positions) if old_positions is None
+                                           else np.union1d(old_positions, new_positions))
+            if self.totals is not None:
+                self.totals[int(bucket)] = self.totals.get(int(bucket), 0) + int(self.cents[new_positions].sum())
+        self._assigned = self._unassigned = None
+
+    def unassign(self, buckets) -> np.ndarray:
+        """Unassigns all rows of the given buckets. Returns their positions"""
+        positions = self.positions(buckets)
+        for bucket in buckets:
+            self.by_bucket.pop(int(bucket), None)
+            if self.totals is not None:
+                self.totals.pop(int(bucket), None)
+        self.buckets[positions] = np.nan
+        self.assigned_mask[positions] = False
+        self._assigned = self._unassigned = None
+        return positions
+
+    def positions(self, buckets) -> np.ndarray:
+        """Returns the positions (sorted) of the rows of the given buckets"""
+        found = [self.by_bucket.get(int(bucket), self._EMPTY) for bucket in buckets if not pd.isna(bucket)]
+        return np.sort(np.concatenate(found)) if found else self._EMPTY
+
+    @property
+    def assigned(self) -> np.ndarray:
+        """Positions of the rows assigned to any bucket"""
+        if self._assigned is None:
+            self._assigned = np.flatnonzero(self.assigned_mask)
+        return self._assigned
+
+    @property
+    def unassigned(self) -> np.ndarray:
+        """Positions of the rows not assigned to any bucket"""
+        if self._unassigned is None:
+            self._unassigned = np.flatnonzero(~self.assigned_mask)
+        return self._unassigned
+
+
+class SearchIndex:
+    """
+    Inverted index for full-text search over the texts of the rows of a DataFrame. Rows are indexed by their words,
+    and the words by their n-grams, so a query finds the rows having, for every word of the query, a word that
+    contains it (e.g. "iberd mayo" finds "IBERDROLA CLIENTES CALLE MAYOR 1") without scanning the rows.
+    Rows are identified by position and can be added at the end with add
+    """
+
+    _N = 3  # Length of the n-grams. Shorter words of the query are looked for in the whole vocabulary
+    _EMPTY = np.array([], dtype=np.int64)
+
+    def __init__(self, texts=()):
+        """
+        Creates index
+        Args:
+            texts: an iterable with the text of each row (non-string values are taken as empty texts)
+        """
+        self.n_rows = 0
+        self.vocabulary = []  # Words, by id
+        self.word_ids = dict()  # Word -> id
+        self.rows = []  # Positions of the rows having each word, by word id
+        self.ngrams = dict()  # N-gram -> set of ids of the words that contain it
+        self._arrays = dict()  # Cache of self.rows as numpy arrays
+        self.add(texts)
+
+    def __len__(self):
+        return self.n_rows
+
+    def add(self, texts):
+        """Adds rows at the end of the index, with the given texts"""
+        for text in texts:
+            for word in set(tokenize(text)):
+                word_id = self.word_ids.get(word)
+                if word_id is None:
+                    word_id = self.word_ids[word] = len(self.vocabulary)
+                    self.vocabulary.append(word)
+                    self.rows.append([])
+                    for i in range(len(word) - self._N + 1):
+                        self.ngrams.setdefault(word[i:i + self._N], set()).add(word_id)
+                self.rows[word_id].append(self.n_rows)
+            self.n_rows += 1
+        self._arrays.clear()
+
+    def _word_ids(self, word: str) -> list:
+        """Returns the ids of the words of the vocabulary that contain word"""
+        if len(word) < self._N:
+            return [word_id for word_id, other in enumerate(self.vocabulary) if word in other]
+        ngrams = sorted((self.ngrams.get(word[i:i + self._N], set()) for i in range(len(word) - self._N + 1)), key=len)
+        # Having all the n-grams of the word does not mean containing it (e.g. "ABCAB" has "ABC" and "CAB"...)
+        return [word_id for word_id in ngrams[0].intersection(*ngrams[1:]) if word in self.vocabulary[word_id]]
+
+    def _positions(self, word_id: int) -> np.ndarray:
+        positions = self._arrays.get(word_id)
+        if positions is None:
+            positions = self._arrays[word_id] = np.array(self.rows[word_id], dtype=np.int64)
+        return positions
+
+    def search(self, text: str) -> np.ndarray:
+        """Returns the positions (sorted) of the rows that have a word containing each word of text. All rows are
+        returned if text has no words"""
+        found = None
+        # Longest words first, as they usually are the most selective ones
+        for word in sorted(set(tokenize(text)), key=len, reverse=True):
+            word_ids = self._word_ids(word)
+            if not word_ids:
+                return self._EMPTY
+            positions = np.unique(np.concatenate([self._positions(word_id) for word_id in word_ids]))
+            found = positions if found is None else np.intersect1d(found, positions, assume_unique=True)
+            if not len(found):
+                break
+        return np.arange(self.n_rows) if found is None else found
@@ -2,15 +2,29 @@
 Functions to provide conciliation model. The process of matching a column is called "bucketing"
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
 from difflib import SequenceMatcher
 
+import numpy as np
 import pandas as pd
 
 from ong_gesfincas import DataType
-from ong_gesfincas.liquidaciones_cmd import read_gesfincas
+from ong_gesfincas.conciliation_index import (AmountDateIndex, AmountIndex, BucketIndex, SearchIndex, TextIndex,
+                                             to_days)
+from ong_gesfincas.liquidaciones_cmd import PROVENANCE_DTYPES, add_provenance, file_id, read_gesfincas
+from ong_gesfincas.profiling import profiler
 from ong_utils.excel import df_to_excel
 
 
+# Maximum difference in days between dates of rows matched automatically (if dates are available)
+DATE_WINDOW_DAYS = 31
+# Maximum difference (in cents) between a float amount and its cents to be taken as an exact amount. Floats read from
+# Excel are not exact (e.g. 0.29 * 100 is 28.999999999999996), but a true fraction of cent is always much bigger
+_SUB_CENT_TOLERANCE = 1e-4
+
+
 class InvalidFileError(ValueError):
     """Exception raised when file is invalid"""
 
@@ -21,6 +35,90 @@ class InvalidFileError(ValueError):
     pass
 
 
+class InvalidAmountError(InvalidFileError):
+    """Exception raised when amounts are not numbers or have fractions of cent"""
+    pass
+
+
+def _decimal_cents(value):
+    """Returns an amount in euros (a number or a string, with comma or dot as decimal separator) as integer cents, or
+    None if it is not a number or it has fractions of cent"""
+    if isinstance(value, float):
+        cents = round(value * 100)
+        return cents if abs(value * 100 - cents) <= _SUB_CENT_TOLERANCE else None
+    text = str(value).replace("€", "").replace(" ", "").replace("\xa0", "")
+    if "," in text:
+        # The last separator is the decimal one: "1.234,56" or "1,234.56"
+        thousands = "." if text.rfind(",") > text.rfind(".") else ","
+        text = text.replace(thousands, "").replace(",", ".")
+    try:
+        cents = Decimal(text) * 100
+    except InvalidOperation:
+        return None
+    return int(cents) if cents.is_finite() and cents == cents.to_integral_value() else None
+
+
+def to_cents(values) -> np.ndarray:
+    """
+    Converts amounts in euros to exact integer cents, with no float arithmetic for integers, strings or Decimals.
+    Floats (as Excel stores numbers) are taken as the nearest cent. Missing values are taken as 0
+    Args:
+        values: a Series (or iterable) of amounts
+
+    Returns:
+        a numpy int64 array with the amounts in cents
+
+    Raises:
+        InvalidAmountError if any amount is not a number or has fractions of cent
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_integer_dtype(values.dtype) and not values.hasnans:
+        return values.to_numpy(dtype=np.int64) * 100
+    if pd.api.types.is_float_dtype(values.dtype):
+        euros = values.to_numpy(dtype=float, na_value=0)
+        cents = np.rint(euros * 100)
+        with np.errstate(invalid="ignore"):
+            invalid = ~(np.abs(euros * 100 - cents) <= _SUB_CENT_TOLERANCE)  # inf is invalid too
+    else:
+        # Strings, Decimals or mixed types: each different value is converted exactly
+        converted = {value: _decimal_cents(value) for value in values.dropna().unique()}
+        cents = values.map(converted).where(values.notna(), 0)
+        invalid = cents.isna().to_numpy()
+        cents = cents.fillna(0).to_numpy(dtype=np.int64)
+    if invalid.any():
+        wrong = values[invalid]
+        raise InvalidAmountError("Amounts not valid or with fractions of cent in {}: {}".format(
+            values.name or "data", ", ".join(f"{idx}: {value!r}" for idx, value in wrong.head(10).items())),
+            missing=wrong.index.tolist())
+    return cents.astype(np.int64)
+
+
+def _count_rows(result, self, *args, **kwargs) -> int:
+    """Number of rows processed by a Conciliation method: the rows of the returned dict of dfs or else of the model"""
+    dfs = result if isinstance(result, dict) else self.dfs
+    return sum(df.shape[0] for df in dfs.values() if df is not None)
+
+
+def _fingerprints(df: pd.DataFrame, columns: list, numeric: set) -> np.ndarray:
+    """Returns a 64 bit hash of the values of the given columns of each row of df. Numeric columns are hashed as
+    floats and the rest as strings (missing values as empty strings), so dtypes of different files do not matter"""
+    if not columns:
+        return np.zeros(df.shape[0], dtype=np.uint64)
+    values = pd.DataFrame({col: df[col].astype(float) if col in numeric else
+                           df[col].astype(object).where(df[col].notna(), "").astype(str) for col in columns})
+    return pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+
+
+def _provenance_keys(df: pd.DataFrame) -> pd.Series:
+    """Packs the provenance columns (file id, sheet and row, see liquidaciones_cmd.add_provenance) of each row of df
+    into a single 64 bit integer key. Rows without provenance are left out"""
+    cols = list(PROVENANCE_DTYPES)
+    df = df[cols].dropna()
+    # 32 bits for the file id, 11 for the sheet and 21 for the row (Excel has 2 ** 20 rows)
+    file, sheet, row = (df[col].to_numpy(dtype=np.uint64) for col in cols)
+    return pd.Series((file << np.uint64(32)) | (sheet << np.uint64(21)) | row, index=df.index)
+
+
 class Conciliation:
     _COL_CASH_BANK = "Importe"
     _COL_CASH_INCOME = "Cobrado"
@@ -31,11 +129,36 @@ class Conciliation:
     _SHEET_BNK = "banco"
     _SHEET_INC = "ingresos"
     _SHEET_EXP = "gastos"
+    _SHEET_ACCOUNTS = "cuentas"  # Totals by bank account (only written, see check_buckets_by_account)
+    _SHEET_BALANCES = "saldos_punteos"  # Balance of each bucket (only written, see bucket_balances)
+    # Problems of buckets found by validate_buckets
+    PROBLEM_ORPHAN = "huérfano"  # Rows of just one df
+    PROBLEM_MIXED = "gastos e ingresos"  # Rows of both expenses and incomes
+    PROBLEM_UNBALANCED = "descuadrado"  # Bank amount different from expenses/incomes amount
     # Columns of the sheets to read data from
     # _COLS_BNK = ['Concepto', 'Importe', 'CALLE']
     _COLS_BNK = ['Concepto', 'Importe']
     _COLS_INC = ['Piso/Local', 'Inquilino', 'Fecha', 'Cobrado', 'Pendiente', 'finca']
     _COLS_EXP = ['CONCEPTO', 'Pagos', 'Abonos', 'finca']
+    # Optional date column of bank and expenses. The first column found of the possible names is renamed to _COL_DATE
+    _COL_DATE = "Fecha"
+    _COLS_DATE_BNK = ['Fecha', 'F. Operación', 'Fecha Operación', 'Fecha operación', 'F. Valor', 'Fecha Valor',
+                      'Fecha valor']
+    _COLS_DATE_EXP = ['Fecha', 'FECHA']
+    # Optional column with the period (e.g. month) of each row, for conciliations of many periods (see append_period)
+    _COL_PERIOD = "Periodo"
+    # Optional column with the bank account of each bank row, for conciliations of many accounts (see read_banks)
+    _COL_ACCOUNT = "Cuenta"
+    # Optional columns with the file, sheet and row each row was read from (see liquidaciones_cmd.add_provenance)
+    _COLS_PROVENANCE = list(PROVENANCE_DTYPES)
+    # Columns with the texts used to suggest matching rows
+    _COLS_TEXT = {DataType.BNK: ['Concepto'], DataType.EXP: ['CONCEPTO', 'finca'], DataType.INC: ['Inquilino', 'finca']}
+    # Rows whose amount differs less than this are suggested as if they had the same amount
+    _SUGGEST_TOLERANCE_CENTS = 2
+    # Maximum number of rows with similar texts (but not amounts) considered for suggestions
+    _SUGGEST_TEXT_CANDIDATES = 50
+    # Bank rows processed by a step of automatic_bucket_expenses between calls to its progress function
+    _PROGRESS_ROWS = 500
 
     @classmethod
     @property
@@ -47,11 +170,28 @@ class Conciliation:
     def col_cents(cls):
         return cls._COL_CENTS
 
-    def __init__(self, filename: str = None):
+    @classmethod
+    @property
+    def col_date(cls):
+        return cls._COL_DATE
+
+    @classmethod
+    @property
+    def col_period(cls):
+        return cls._COL_PERIOD
+
+    @classmethod
+    @property
+    def col_account(cls):
+        return cls._COL_ACCOUNT
+
+    def __init__(self, filename: str = None, date_window_days: int = DATE_WINDOW_DAYS):
         """
         Reads a filename and returns a tuple of pandas dataframes with bank data, expenses data and income data
         Args:
             filename: full name of an Excel input file
+            date_window_days: maximum difference in days between the dates of the rows matched automatically. None
+            to match rows no matter their dates
 
         Returns:
             None
@@ -60,46 +200,78 @@ class Conciliation:
         self.df_bank = None
         self.df_incomes = None
         self.dfs = dict()
+        self.date_window_days = date_window_days
+        self._suggest_indexes = dict()  # Indexes for suggest, built when needed, indexed by DataType
+        self._bucket_indexes = dict()  # BucketIndex of each df, built when needed (see bucket_index)
+        self._search_indexes = dict()  # SearchIndex of each df, built when needed (see search)
+        self._amount_indexes = dict()  # AmountIndex of each df, built when needed (see find_amount)
+        self._indexed_frames = dict()  # Each df and its index when its indexes were built (see __check_frame)
+        self.frozen_buckets = set()  # Buckets of closed periods, that cannot be unassigned (see append_period)
+        self.version = 0  # Increased each time data or buckets change, so views can cache what they compute from them
         if filename:
             self.read(filename)
 
     def __create_cents(self, df, col_cash_orig) -> pd.DataFrame:
-        """Creates a new column with the original_data cash orig converted to cents instead of euros"""
-        # df.loc[:, self._COL_CENTS] = (df[col_cash_orig] * 100).round(0).astype(int)
+        """Creates a new column with the original_data cash orig converted to cents instead of euros (see to_cents).
+        If the amounts are not numbers (e.g. strings as "1.234,56"), they are replaced by their value in euros.
+        Raises InvalidAmountError if any amount is not valid"""
         if self.col_cents not in df.columns:  # Don't try to replicate column
-            df.insert(len(df.columns), self.col_cents,
-                      (df[col_cash_orig].fillna(0).astype(float) * 100).round(0).astype(int))
+            cents = to_cents(df[col_cash_orig])
+            if not pd.api.types.is_numeric_dtype(df[col_cash_orig].dtype):
+                df = df.assign(**{col_cash_orig: cents / 100})
+            df.insert(len(df.columns), self.col_cents, cents)
         return df
 
+    def __select_cols(self, df: pd.DataFrame, cols: list, date_cols: list) -> pd.DataFrame:
+        """Returns the given columns of df plus its date column (the first of date_cols found, if any) renamed to
+        _COL_DATE, and its account, period and provenance columns (if any). Provenance columns are converted to their
+        small integer dtypes"""
+        cols = [col for col in (self._COL_ACCOUNT,) if col in df.columns] + cols + \
+            [col for col in [self._COL_PERIOD] + self._COLS_PROVENANCE if col in df.columns]
+        date_col = next((col for col in date_cols if col in df.columns), None)
+        if date_col is not None:
+            df = df[[date_col] + cols].rename(columns={date_col: self._COL_DATE})
+        else:
+            df = df[cols]
+        return df.astype({col: dtype for col, dtype in PROVENANCE_DTYPES.items() if col in df.columns})
+
     def __unassigned_df(self, df):
         idx = df[self._COL_BUCKET].isna()
         return df.loc[idx]
 
+    @profiler.timed(rows=_count_rows)
     def set_dfs(self, df_dict: dict, read_buckets=True):
-        """Set data from a dictionary of dfs indexed by data type"""
+        """Set data from a dictionary of dfs indexed by data type. Raises InvalidAmountError (and nothing is changed)
+        if any amount is not valid"""
+        new_dfs = dict()
         if DataType.EXP in df_dict:
-            self.df_expenses = df_dict[DataType.EXP][self._COLS_EXP]
+            df_expenses = self.__select_cols(df_dict[DataType.EXP], self._COLS_EXP, self._COLS_DATE_EXP)
+            # Add cents column
+            df_expenses = self.__create_cents(df_expenses, self._COL_CASH_EXPENSES)
             # If expenses sum a positive value: change sign, otherwise it won't match bank criterion
-            if self.df_expenses[self._COL_CASH_EXPENSES].sum() > 0:
-                self.df_expenses.loc[:, self._COL_CASH_EXPENSES] = - self.df_expenses[self._COL_CASH_EXPENSES]
-            self.dfs[DataType.EXP] = self.df_expenses
+            if df_expenses[self._COL_CENTS].sum() > 0:
+                for col in self._COL_CASH_EXPENSES, self._COL_CENTS:
+                    df_expenses.loc[:, col] = - df_expenses[col]
+            new_dfs[DataType.EXP] = df_expenses
 
         if DataType.BNK in df_dict:
-            self.df_bank = df_dict[DataType.BNK][self._COLS_BNK]
-            self.df_bank = self.df_bank[~self.df_bank[self._COL_CASH_BANK].isna()]  # Remove not needed nans
-            self.dfs[DataType.BNK] = self.df_bank
+            df_bank = self.__select_cols(df_dict[DataType.BNK], self._COLS_BNK, self._COLS_DATE_BNK)
+            df_bank = df_bank[~df_bank[self._COL_CASH_BANK].isna()]  # Remove not needed nans
+            new_dfs[DataType.BNK] = self.__create_cents(df_bank, self._COL_CASH_BANK)
 
         if DataType.INC in df_dict:
-            self.df_incomes = df_dict[DataType.INC][self._COLS_INC]
-            self.dfs[DataType.INC] = self.df_incomes
+            df_incomes = self.__select_cols(df_dict[DataType.INC], self._COLS_INC, [])
+            new_dfs[DataType.INC] = self.__create_cents(df_incomes, self._COL_CASH_INCOME)
 
-        # Add cents column
-        if DataType.BNK in self.dfs:
-            self.df_bank = self.__create_cents(self.df_bank, self._COL_CASH_BANK)
-        if DataType.EXP in self.dfs:
-            self.df_expenses = self.__create_cents(self.df_expenses, self._COL_CASH_EXPENSES)
-        if DataType.INC in self.dfs:
-            self.df_incomes = self.__create_cents(self.df_incomes, self._COL_CASH_INCOME)
+        # All amounts are valid, so data can be changed
+        self.dfs.update(new_dfs)
+        self.df_bank = self.dfs.get(DataType.BNK)
+        self.df_expenses = self.dfs.get(DataType.EXP)
+        self.df_incomes = self.dfs.get(DataType.INC)
+        self._suggest_indexes = dict()
+        self._bucket_indexes = dict()
+        self._search_indexes = dict()
+        self._amount_indexes = dict()
 
         # Treat buckets. If read_buckets and all buckets found, re-read buckets, else create empty buckets
         buckets_found = (self.has_all_data and read_buckets and
@@ -111,12 +283,112 @@ class Conciliation:
             else:
                 df.insert(len(df.columns), self._COL_BUCKET,
                           df_dict[key][self._COL_BUCKET].astype(dtype=pd.Int64Dtype()) if buckets_found else None)
+        self.frozen_buckets = self.__frozen_by_period() if buckets_found else set()
+        self.version += 1
         return
 
+    def __frozen_by_period(self) -> set:
+        """Buckets whose rows all belong to periods before the last one, as they are assumed to have been closed in a
+        previous period (buckets of old rows made in the last period are frozen too, as that is not saved)"""
+        if self.df_bank is None or self._COL_PERIOD not in self.df_bank.columns:
+            return set()
+        buckets = pd.concat([df[[self._COL_BUCKET, self._COL_PERIOD]] for df in self.dfs.values()
+                             if self._COL_PERIOD in df.columns]).dropna(subset=[self._COL_BUCKET])
+        periods = buckets[self._COL_PERIOD].fillna("").astype(str)
+        last_period = self.df_bank[self._COL_PERIOD].fillna("").astype(str).max()
+        closed = periods.groupby(buckets[self._COL_BUCKET].astype(int).values).max()
+        return set(closed.index[closed < last_period].tolist())
+
+    def freeze_buckets(self):
+        """Freezes all current buckets: they cannot be unassigned anymore (e.g. because their period is closed)"""
+        self.frozen_buckets.update(int(bucket) for bucket in self.df_bank[self._COL_BUCKET].dropna().unique())
+
+    def __new_rows(self, df_old: pd.DataFrame, df_new: pd.DataFrame) -> np.ndarray:
+        """Returns a boolean mask of the rows of df_new that are not in df_old, comparing their common columns
+        (except buckets and periods). Repeated rows are counted, so if a row is twice in df_new and once in df_old,
+        it is kept once"""
+        cols = [col for col in df_new.columns if col in df_old.columns and
+                col not in [self._COL_BUCKET, self._COL_PERIOD] + self._COLS_PROVENANCE]
+
+        def keys(df: pd.DataFrame) -> pd.DataFrame:
+            df = df[cols].astype(str)
+            return df.assign(_occurrence=df.groupby(cols).cumcount().values)
+
+        merged = keys(df_new).merge(keys(df_old), how="left", on=cols + ["_occurrence"], indicator=True)
+        return (merged["_merge"] == "left_only").values
+
+    @profiler.timed(rows=_count_rows)
+    def append_period(self, df_dict: dict, period: str, skip_duplicates: bool = True) -> dict:
+        """
+        Appends the data of a new period (e.g. next month's bank extract and gesfincas file) to the current data, so
+        rows left unassigned in previous periods can be matched with the new ones. Current buckets are frozen (see
+        freeze_buckets), and as automatic matching only indexes unassigned rows its cost does not grow with the
+        history. Rows are tagged with their period in the _COL_PERIOD column
+        Args:
+            df_dict: a dict of DataFrames indexed by DataType, as for set_dfs
+            period: name of the new period (e.g. "2024-03"). Names of periods should sort in chronological order
+            skip_duplicates: if True (default), rows equal to rows already loaded (e.g. pending incomes that appear
+            again in the new gesfincas file, or overlapping bank extracts) are not appended
+
+        Returns:
+            a dict with the number of rows appended, indexed by DataType
+        """
+        new = type(self)(date_window_days=self.date_window_days)
+        new.set_dfs(df_dict, read_buckets=False)
+        if self.df_bank is not None:
+            self.freeze_buckets()
+        appended = dict()
+        for key, df_new in new.dfs.items():
+            df_new = df_new.drop(columns=self._COL_PERIOD, errors="ignore")
+            df_old = self.dfs.get(key)
+            if df_old is not None:
+                if skip_duplicates:
+                    df_new = df_new[self.__new_rows(df_old, df_new)]
+                start = df_old.index.max() + 1 if df_old.shape[0] else 0
+                df_new.index = range(start, start + df_new.shape[0])
+            df_new.insert(df_new.columns.get_loc(self._COL_CENTS), self._COL_PERIOD, period)
+            appended[key] = df_new.shape[0]
+            if df_old is not None:
+                if self._COL_PERIOD not in df_old.columns:
+                    df_old.insert(df_old.columns.get_loc(self._COL_CENTS), self._COL_PERIOD, None)
+                df_new = pd.concat([df_old, df_new])
+            self.dfs[key] = df_new
+        self.df_bank = self.dfs.get(DataType.BNK)
+        self.df_expenses = self.dfs.get(DataType.EXP)
+        self.df_incomes = self.dfs.get(DataType.INC)
+        self._suggest_indexes = dict()
+        self._bucket_indexes = dict()
+        self._amount_indexes = dict()
+        # Rows are appended at the end, so the search indexes are just extended
+        for key, rows in appended.items():
+            if (index := self._search_indexes.get(key)) is not None and rows:
+                index.add(self.__search_texts(self.dfs[key].iloc[-rows:]))
+            self._indexed_frames[key] = (self.dfs[key], self.dfs[key].index)
+        self.version += 1
+        return appended
+
     def backup_dfs(self) -> dict:
         """Returns a copy of the dict of dfs. Useful for update and tests"""
         return {k: df.copy(deep=True) for k, df in self.dfs.items()}
 
+    def subset(self, idx: dict):
+        """
+        Returns a new Conciliation with a copy of just some rows of the data, keeping their index, cents and buckets
+        Args:
+            idx: a dict indexed by DataType with the index of the rows to keep. DataTypes not in idx are fully kept
+
+        Returns:
+            a new Conciliation
+        """
+        retval = type(self)(date_window_days=self.date_window_days)
+        retval.frozen_buckets = set(self.frozen_buckets)
+        retval.dfs = {key: (df.loc[idx[key]] if key in idx else df).copy() for key, df in self.dfs.items()}
+        retval.df_bank = retval.dfs.get(DataType.BNK)
+        retval.df_expenses = retval.dfs.get(DataType.EXP)
+        retval.df_incomes = retval.dfs.get(DataType.INC)
+        return retval
+
+    @profiler.timed(rows=_count_rows)
     def read_dfs(self, filename: str) -> dict:
         """Reads dfs and return a dict of DataFrames indexed by DataType. Raises Inv"""
 
@@ -149,16 +421,21 @@ class Conciliation:
         read_dfs = self.read_dfs(filename)
         self.set_dfs(read_dfs, read_buckets)
 
+    @profiler.timed(rows=_count_rows)
     def read_gesfincas(self, gesfincas_filename: str) -> dict:
-        df_expenses, df_incomes = read_gesfincas(gesfincas_filename)
+        """Reads expenses and incomes, with their provenance columns, from a gesfincas file (or a bundle, see
+        liquidaciones_cmd.read_gesfincas) and returns them as a dict that can be feed to set_dfs or update_dfs.
+        Returns empty dict if file is invalid"""
+        df_expenses, df_incomes = read_gesfincas(gesfincas_filename, provenance=True)
         if df_expenses is None or df_incomes is None:
             return dict()
         else:
             return {DataType.INC: df_incomes, DataType.EXP: df_expenses}
 
+    @profiler.timed(rows=_count_rows)
     def read_bank(self, bank_filename: str) -> dict:
         """Reads bank data as returns as a df that can be feed to update_dfs from the first sheet of the given Excel
-        file. Returns empty dict if file is invalid"""
+        file, with its provenance columns. Returns empty dict if file is invalid"""
         df = pd.read_excel(bank_filename, header=None)
         header_rows = (0, 7)  # Potential rows containing header data
         for header_row in header_rows:
@@ -167,18 +444,81 @@ class Conciliation:
                 df_bank = df.iloc[header_row + 1:, :]
                 df_bank.columns = df.iloc[header_row, :]
                 df_bank = df_bank[~df_bank[self._COL_CASH_BANK].isna()]  # Remove nan values
+                # Index is still the position in the sheet, that starts in its first row
+                df_bank = add_provenance(df_bank, file_id(bank_filename), 1, 1)
                 df_bank.index = range(df_bank.shape[0])
-                df_bank = df_bank[self._COLS_BNK]
+                df_bank = self.__select_cols(df_bank, self._COLS_BNK, self._COLS_DATE_BNK)
                 return {DataType.BNK: df_bank}
         return dict()
 
+    @profiler.timed(rows=_count_rows)
+    def read_banks(self, bank_filenames: list, accounts: list = None, workers: int = None) -> dict:
+        """
+        Reads the extracts of many bank accounts (in parallel processes) into a single bank df, with the account of
+        each row in the _COL_ACCOUNT column, that can be feed to set_dfs or update_dfs as read_bank
+        Args:
+            bank_filenames: a list of bank Excel files (see read_bank)
+            accounts: the names of the accounts, in the same order as bank_filenames. Defaults to the names of the
+            files without extension
+            workers: maximum number of processes. Defaults to number of cpus. If 1, files are read in this process
+
+        Returns:
+            a dict with the bank df indexed by DataType.BNK
+        Raises:
+            InvalidFileError: if any file has no bank data (missing attribute has the list of those files)
+        """
+        if workers == 1 or len(bank_filenames) < 2:
+            results = [self.read_bank(filename) for filename in bank_filenames]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_read_bank_file, bank_filenames))
+        return self.join_banks(results, bank_filenames, accounts)
+
+    def join_banks(self, results: list, bank_filenames: list, accounts: list = None) -> dict:
+        """
+        Joins the results of read_bank for the extracts of many accounts (see read_banks). Useful when files are read
+        elsewhere (e.g. in background processes)
+        Args:
+            results: a list with the dict returned by read_bank for each file
+            bank_filenames: the names of the files read
+            accounts: the names of the accounts (see read_banks)
+
+        Returns:
+            a dict with the bank df indexed by DataType.BNK
+        Raises:
+            InvalidFileError: if any file has no bank data (missing attribute has the list of those files)
+        """
+        accounts = accounts or [os.path.splitext(os.path.basename(filename))[0] for filename in bank_filenames]
+        if len(accounts) != len(bank_filenames):
+            raise ValueError("There must be an account for each bank file")
+        invalid = [filename for filename, result in zip(bank_filenames, results) if not result]
+        if invalid:
+            raise InvalidFileError("Files without bank data: {}".format(", ".join(invalid)), missing=invalid)
+        dfs = []
+        for account, result in zip(accounts, results):
+            df = result[DataType.BNK].drop(columns=self._COL_ACCOUNT, errors="ignore")
+            df.insert(0, self._COL_ACCOUNT, account)
+            dfs.append(df)
+        return {DataType.BNK: pd.concat(dfs, ignore_index=True)}
+
+    @property
+    def accounts(self) -> list:
+        """Names of the bank accounts of the data (empty if bank data has no account column)"""
+        if self.df_bank is None or self._COL_ACCOUNT not in self.df_bank.columns:
+            return []
+        return self.df_bank[self._COL_ACCOUNT].dropna().unique().tolist()
+
+    @profiler.timed(rows=_count_rows)
     def update_dfs(self, df_dict: dict):
         # TODO: Fix the case when two (or more) rows EXACTLY EQUAL in bank and expenses, as it cannot reassign
+        #  them unless they are read again from the same file (and so they have the same provenance)
         old_dfs = self.backup_dfs()
+        old_frozen = self.frozen_buckets
         self.set_dfs(df_dict, read_buckets=False)
         # Delete all buckets (needed if update of just some dfs and not all)
         for df in self.dfs.values():
             df.loc[:, self.col_bucket] = None
+        self._bucket_indexes = dict()
         # First step: merge dfs from old_dfs with the new dfs from self.dfs
         merged_dict = dict()
         for (key, df_old), (key_new, df_new) in zip(old_dfs.items(), self.dfs.items()):
@@ -187,13 +527,21 @@ class Conciliation:
             df_old = df_old[~df_old[self.col_bucket].isna()]
             # Remove bucket column from new dfs (not needed as bucket from old_df will be used)
             df_new = df_new.drop(self.col_bucket, axis=1)
-            # merge on the common columns (those available both in new and old dfs)
-            common_cols = df_old.columns.intersection(df_new.columns).to_list()
+            # merge on the common columns (those available both in new and old dfs), except provenance columns, that
+            # are different if the file has changed
+            common_cols = [col for col in df_old.columns.intersection(df_new.columns)
+                           if col not in self._COLS_PROVENANCE]
             # Add indexes to columns "index_old" for df_old and "index_new" for df_new
             df_old.insert(len(df_old.columns), 'index_old', df_old.index)
             df_new.loc[:, 'index_new'] = df_new.index
-            # merge on the common_cols
-            merged = pd.merge(df_old, df_new, left_on=common_cols, right_on=common_cols, how="left")
+            # Rows read from the same file, sheet and row are found with a single join of their provenance keys, and
+            # the rest are merged on the common_cols
+            same_source = self.__same_source(df_old, df_new)
+            merged = pd.merge(df_old.drop(index=same_source.index), df_new.drop(index=same_source.values),
+                              left_on=common_cols, right_on=common_cols, how="left")
+            if not same_source.empty:
+                by_source = df_old.loc[same_source.index].assign(index_new=same_source.values)
+                merged = pd.concat([by_source, merged]) if not merged.empty else by_source
             merged_dict[key] = merged
         # Now check old buckets to see if they can be applied to the new dfs. The bank is used as the master for buckets
         for bucket in old_dfs[DataType.BNK][self.col_bucket].dropna().unique():
@@ -220,9 +568,26 @@ class Conciliation:
                     kwargs[arg_name] = bucket_merged['index_new'].values
             if kwargs:
                 if not (kwargs["idx_expenses"] is None and kwargs["idx_incomes"] is None):
+                    new_bucket = self.get_next_bucket()
                     self.bucket(**kwargs)
+                    if bucket in old_frozen:
+                        self.frozen_buckets.add(int(new_bucket))
                 else:
                     pass        # There is a bucket found in bank that does not appear neither in expenses nor incomes
+        self.version += 1
+
+    def __same_source(self, df_old: pd.DataFrame, df_new: pd.DataFrame) -> pd.Series:
+        """Returns a Series with the index of the rows of df_old that have the same provenance (file, sheet and row)
+        as a row of df_new, and the index of that row as values. Rows read from another version of a file (or without
+        provenance) are not in it"""
+        if not all(col in df.columns for col in self._COLS_PROVENANCE for df in (df_old, df_new)):
+            return pd.Series(df_new.index[:0], index=df_old.index[:0])
+        # Repeated keys (e.g. the same file loaded twice) are left to the merge
+        keys_new, keys_old = (keys[~keys.duplicated(keep=False)] for keys in (_provenance_keys(df_new),
+                                                                               _provenance_keys(df_old)))
+        positions = pd.Index(keys_new.values).get_indexer(keys_old.values)
+        found = positions >= 0
+        return pd.Series(keys_new.index[positions[found]], index=keys_old.index[found])
 
     def update(self, filename: str):
         """
@@ -239,7 +604,99 @@ class Conciliation:
         self.update_dfs(df_dict)
 
     def unassigned(self, df_type: DataType):
-        return self.__unassigned_df(self.dfs[df_type])
+        return self.dfs[df_type].take(self.unassigned_positions(df_type))
+
+    def __check_frame(self, data_type: DataType):
+        """Drops the indexes of a df (bucket, search, amount and suggest indexes) if the df has been replaced by another
+        DataFrame (even of the same length) or reordered (which gives it a new index object) since they were built, as
+        they hold row positions"""
+        df = self.dfs[data_type]
+        frame = self._indexed_frames.get(data_type)
+        if frame is None or frame[0] is not df or frame[1] is not df.index:
+            for indexes in self._bucket_indexes, self._search_indexes, self._amount_indexes, self._suggest_indexes:
+                indexes.pop(data_type, None)
+            self._indexed_frames[data_type] = (df, df.index)
+
+    def bucket_index(self, data_type: DataType) -> BucketIndex:
+        """Returns the index by bucket of the rows of a df. It is built when first needed and then kept up to date by
+        bucket, bucket_many and unbucket (so buckets must not be changed directly in the dfs)"""
+        self.__check_frame(data_type)
+        index = self._bucket_indexes.get(data_type)
+        if index is None or len(index) != self.dfs[data_type].shape[0]:
+            df = self.dfs[data_type]
+            index = self._bucket_indexes[data_type] = BucketIndex(df[self._COL_BUCKET], df[self._COL_CENTS])
+        return index
+
+    def bucket_positions(self, data_type: DataType, buckets) -> np.ndarray:
+        """Returns the positions (sorted) of the rows of a df assigned to any of the given buckets"""
+        return self.bucket_index(data_type).positions(buckets)
+
+    def assigned_positions(self, data_type: DataType) -> np.ndarray:
+        """Returns the positions of the rows of a df assigned to any bucket"""
+        return self.bucket_index(data_type).assigned
+
+    def unassigned_positions(self, data_type: DataType) -> np.ndarray:
+        """Returns the positions of the rows of a df not assigned to any bucket"""
+        return self.bucket_index(data_type).unassigned
+
+    def __search_texts(self, df: pd.DataFrame) -> list:
+        """Returns the text of each row of df for the search index: all its text columns joined"""
+        columns = [col for col in df.columns if col != self._COL_BUCKET and
+                   (pd.api.types.is_object_dtype(df[col].dtype) or pd.api.types.is_string_dtype(df[col].dtype))]
+        texts = [df[col].map(lambda value: value if isinstance(value, str) else "").tolist() for col in columns]
+        return [" ".join(values) for values in zip(*texts)] if texts else [""] * df.shape[0]
+
+    def search_index(self, data_type: DataType) -> SearchIndex:
+        """Returns the full-text index of the rows of a df, built when first needed (and again if data changes)"""
+        self.__check_frame(data_type)
+        index = self._search_indexes.get(data_type)
+        if index is None or len(index) != self.dfs[data_type].shape[0]:
+            index = self._search_indexes[data_type] = SearchIndex(self.__search_texts(self.dfs[data_type]))
+        return index
+
+    def search(self, data_type: DataType, text: str) -> np.ndarray:
+        """
+        Full-text search over the text columns (Concepto, CONCEPTO, Inquilino, finca...) of a df
+        Args:
+            data_type: the DataType of the df
+            text: words to look for, in any order. Case, accents and punctuation are ignored, and words of the
+            rows just need to contain them (e.g. "iberd" finds "IBERDROLA")
+
+        Returns:
+            the positions (sorted) of the rows having all the words. All rows if text has no words
+        """
+        return self.search_index(data_type).search(text)
+
+    def amount_index(self, data_type: DataType) -> AmountIndex:
+        """Returns the sorted index of the amounts of a df, built when first needed (and again if data changes)"""
+        self.__check_frame(data_type)
+        index = self._amount_indexes.get(data_type)
+        if index is None or len(index) != self.dfs[data_type].shape[0]:
+            index = self._amount_indexes[data_type] = AmountIndex(self.dfs[data_type][self._COL_CENTS].values)
+        return index
+
+    def find_amount(self, cents: float, offset: float = 0, data_types=None) -> dict:
+        """
+        Finds the rows with an amount close to a given one
+        Args:
+            cents: the amount, in cents
+            offset: maximum difference in cents (0, the default, for the exact amount)
+            data_types: an iterable of the DataTypes of the dfs to look in. None (default) for all of them
+
+        Returns:
+            a dict indexed by DataType with the positions (sorted) of the rows with an amount between cents - offset
+            and cents + offset
+        """
+        return {data_type: self.amount_index(data_type).between(cents - offset, cents + offset)
+                for data_type in (self.dfs if data_types is None else data_types) if data_type in self.dfs}
+
+    def __index_buckets(self, data_type: DataType, labels, buckets):
+        """Updates the bucket index of a df (if it was built) with new buckets of the rows with the given labels, and
+        increases version"""
+        self.version += 1
+        self.__check_frame(data_type)
+        if (index := self._bucket_indexes.get(data_type)) is not None:
+            index.assign(self.dfs[data_type].index.get_indexer(np.atleast_1d(labels)), buckets)
 
     @property
     def unassigned_exp(self):
@@ -261,11 +718,16 @@ class Conciliation:
             return last_bucket + 1
 
     def unbucket(self, idx):
-        """Unassigns a list of idx"""
+        """Unassigns a list of idx. Frozen buckets are kept"""
         if isinstance(idx, int):
             idx = [idx]
-        for df in self.df_bank, self.df_expenses, self.df_incomes:
+        idx = [bucket for bucket in idx if int(bucket) not in self.frozen_buckets]
+        self.version += 1
+        for data_type, df in self.dfs.items():
             df.loc[df[self._COL_BUCKET].isin(idx), self._COL_BUCKET] = None
+            self.__check_frame(data_type)
+            if (index := self._bucket_indexes.get(data_type)) is not None:
+                index.unassign(idx)
 
     def bucket(self, idx_bank, idx_expenses=None, idx_incomes=None):
         """Assigns to a bucket a list of rows in either expenses or income"""
@@ -274,10 +736,62 @@ class Conciliation:
             raise ValueError("Either idx_expenses or idx_income should be provided")
         id = self.get_next_bucket()
         self.df_bank.loc[idx_bank, self._COL_BUCKET] = id
+        self.__index_buckets(DataType.BNK, idx_bank, id)
         if idx_expenses is not None:
             self.df_expenses.loc[idx_expenses, self._COL_BUCKET] = id
+            self.__index_buckets(DataType.EXP, idx_expenses, id)
         elif idx_incomes is not None:
             self.df_incomes.loc[idx_incomes, self._COL_BUCKET] = id
+            self.__index_buckets(DataType.INC, idx_incomes, id)
+
+    def bucket_many(self, buckets: list) -> list:
+        """
+        Assigns many buckets at once, with consecutive ids. Faster than calling bucket for each one
+        Args:
+            buckets: a list of tuples (idx_bank, idx_expenses, idx_incomes), as the arguments of bucket
+
+        Returns:
+            the list of the ids of the new buckets
+        """
+        first = self.get_next_bucket()
+        labels = {key: [] for key in DataType}
+        ids = {key: [] for key in DataType}
+        for number, (idx_bank, idx_expenses, idx_incomes) in enumerate(buckets):
+            if idx_expenses is None and idx_incomes is None:
+                raise ValueError("Either idx_expenses or idx_income should be provided")
+            idx_other = (DataType.EXP, idx_expenses) if idx_expenses is not None else (DataType.INC, idx_incomes)
+            for key, idx in (DataType.BNK, idx_bank), idx_other:
+                idx = np.atleast_1d(idx).tolist()
+                labels[key].extend(idx)
+                ids[key].extend([first + number] * len(idx))
+        for key, df in self.dfs.items():
+            if labels[key]:
+                df.loc[labels[key], self._COL_BUCKET] = ids[key]
+                self.__index_buckets(key, labels[key], ids[key])
+        return list(range(first, first + len(buckets)))
+
+    def bucket_list(self, first_bucket: int = 0) -> list:
+        """
+        Returns buckets as a list of tuples, as bucket_many takes them (e.g. to copy them to another Conciliation)
+        Args:
+            first_bucket: only buckets with this id or greater are returned (e.g. those found after a given moment)
+
+        Returns:
+            a list of tuples (idx_bank, idx_expenses, idx_incomes)
+        """
+        bank = self.df_bank[self.col_bucket].dropna()
+        bank = bank[bank >= first_bucket]
+        idx_bank = bank.groupby(bank).groups
+        buckets = []
+        for data_type in DataType.EXP, DataType.INC:
+            other = self.dfs[data_type][self.col_bucket].dropna()
+            other = other[other >= first_bucket]
+            for bucket, idx_other in other.groupby(other).groups.items():
+                if bucket in idx_bank:
+                    idx_other = list(idx_other)
+                    buckets.append((list(idx_bank[bucket]), idx_other if data_type == DataType.EXP else None,
+                                    idx_other if data_type == DataType.INC else None))
+        return buckets
 
     def clear_orphan_buckets(self) -> list:
         """
@@ -285,91 +799,172 @@ class Conciliation:
         Returns:
         The list of the orphan buckets found
         """
-        orphan_buckets = []
-        for df0 in self.dfs.values():
-            if df0 is None:
-                continue
-            buckets0 = set(df0[self.col_bucket].dropna().unique())
-            if not buckets0:
-                continue
-            for df1 in self.dfs.values():
-                if df1 is None or df1 is df0:
-                    continue
-                buckets1 = set(df1[self.col_bucket].dropna().unique())
-                # Remove buckets present in buckets0 and buckets1
-                buckets0 = buckets0.difference(buckets1)
-            if buckets0:
-                for b in buckets0:
-                    orphan_buckets.append(int(b))
-                    self.unbucket(int(b))
+        problems = self.validate_buckets()
+        orphan_buckets = [int(bucket) for bucket in
+                          problems.loc[problems["problema"] == self.PROBLEM_ORPHAN, self._COL_BUCKET]
+                          if int(bucket) not in self.frozen_buckets]
+        if orphan_buckets:
+            self.unbucket(orphan_buckets)
         return orphan_buckets
 
-    def automatic_bucket_expenses(self, delta_cents: float = 1):
+    @profiler.timed(rows=_count_rows)
+    def automatic_bucket_expenses(self, delta_cents: float = 1, rules=None, progress=None) -> bool:
         """
         Buckets (assigns) automatically rows in the bank to rows in expenses, doing these steps:
+            Optional previous step: assigns rows using rules learnt from previous conciliations
             First step: assigns those rows that perfectly match (same amount)
             Second step: assigns those rows that almost perfectly match (+- delta_cents)
             Third step: to a given row in bank, assigns two consecutive rows in expenses if the sum matches
         Args:
             delta_cents: in case there is no exact match, find approximate match with this different to actual value
             in cents
+            rules: an optional conciliation_rules.MatchingRules
+            progress: an optional function called as progress(step, done, total) while matching, where step is the
+            name of the current step and done and total count its bank rows. Buckets found are assigned before each
+            call, so they can be shown progressively. If it returns True, matching stops keeping the buckets found
         Returns:
-            None
+            True if matching was stopped by progress
+        """
+        if rules is not None:
+            self.bucket_by_rules(rules)
+            if progress is not None and progress("Reglas aprendidas", 1, 1):
+                return True
+        return (self.bucket_exact_match(progress) or self.bucket_approximate_match(delta_cents, progress) or
+                self.bucket_consecutive_expenses(progress))
+
+    def __step_progress(self, progress, step: str, number: int, total: int, buckets: list) -> bool:
+        """Called by the steps of automatic_bucket_expenses before each bank row and at the end (when number is
+        total). At the end, and every _PROGRESS_ROWS rows if there is a progress function, assigns the buckets found
+        so far (emptying the list) and calls progress. Returns True if progress asks to stop"""
+        if number != total and (progress is None or number % self._PROGRESS_ROWS):
+            return False
+        self.bucket_many(buckets)
+        buckets.clear()
+        return progress is not None and bool(progress(step, number, total))
+
+    @profiler.timed(rows=_count_rows)
+    def bucket_by_rules(self, rules) -> int:
         """
-        ###############################
-        # Fist step: find exact match
-        ###############################
+        Optional first step of automatic_bucket_expenses: assigns rows using rules learnt from previous conciliations
+        Args:
+            rules: a conciliation_rules.MatchingRules
+
+        Returns:
+            the number of new buckets
+        """
+        return rules.apply(self)
+
+    def candidate_index(self, df_type: DataType) -> AmountDateIndex:
+        """Returns an index of the unassigned rows of a df by amount and date, to find candidates for bank rows.
+        Only unassigned rows are indexed, so its cost does not depend on the rows already matched (e.g. in previous
+        periods)"""
+        df = self.dfs[df_type]
+        positions = self.unassigned_positions(df_type)
+        dates = df[self._COL_DATE].values[positions] if self._COL_DATE in df.columns else None
+        return AmountDateIndex(df[self._COL_CENTS].values[positions], dates, self.date_window_days, positions)
+
+    def __bank_days(self) -> np.ndarray:
+        """Dates of bank rows as days (see conciliation_index.to_days), nan if there are no dates"""
+        if self.date_window_days is None or self._COL_DATE not in self.df_bank.columns:
+            return np.full(self.df_bank.shape[0], np.nan)
+        return to_days(self.df_bank[self._COL_DATE])
+
+    @profiler.timed(rows=_count_rows)
+    def bucket_exact_match(self, progress=None) -> bool:
+        """
+        First step of automatic_bucket_expenses: assigns those rows that perfectly match (same amount and dates within
+        date_window_days). If many expenses match, the one with the most similar concept is used. If many incomes
+        match, nothing is assigned
+        Args:
+            progress: optional progress function (see automatic_bucket_expenses)
+
+        Returns:
+            True if stopped by progress
+        """
+        bank_days = self.__bank_days()
+        bank_cents = self.df_bank[self._COL_CENTS].values
+        bank_concepts = self.df_bank['Concepto'].values
         for df_type in (t for t in DataType if t != DataType.BNK):
-            for idx_bnk, row in self.df_bank.iterrows():
-                if not pd.isna(row[self._COL_BUCKET]):
-                    continue
-                target = row[self._COL_CENTS]
-                found = self.unassigned(df_type)[self.unassigned(df_type)[self._COL_CENTS] == target]
-                idx = None
-                if found.shape[0] == 1:
-                    idx = found.index.values
+            df = self.dfs[df_type]
+            index = self.candidate_index(df_type)
+            buckets = []
+            step = f"Importe exacto con {df_type.value}"
+            positions_bnk = np.flatnonzero(self.df_bank[self._COL_BUCKET].isna().values)
+            for number, pos_bnk in enumerate(positions_bnk):
+                if self.__step_progress(progress, step, number, len(positions_bnk), buckets):
+                    return True
+                found = index.candidates(bank_cents[pos_bnk], bank_days[pos_bnk])
+                if len(found) == 1:
+                    pos = found[0]
                 # If there are more than 1 posible rows, only find the best one in the case of expenses.
-                elif found.shape[0] > 1:
+                elif len(found) > 1:
                     # For incomes there are too many possibilities (e.g. many tenants with the same amount)
                     if df_type == DataType.INC:
-                        # print(found)
                         continue
-                    elif df_type == DataType.EXP:
-                        # If more than one is matched, match with the most similar one using "Concepto" column
-                        matches = found['CONCEPTO'].apply(lambda x: SequenceMatcher(None, row['Concepto'].upper(),
-                                                                                    x.upper()).ratio())
-                        idx = matches.idxmax()
-                if idx is not None:
-                    if df_type == DataType.EXP:
-                        self.bucket(idx_bnk, idx_expenses=idx)
-                    elif df_type == DataType.INC:
-                        self.bucket(idx_bnk, idx_incomes=idx)
-
-        ########################################################
-        # Second step: find approximate match (within +- delta)
-        ########################################################
-        for idx_bnk, row in self.df_bank.iterrows():
-            if not pd.isna(row[self._COL_BUCKET]):
-                continue
-            target = row[self._COL_CENTS]
+                    # If more than one is matched, match with the most similar one using "Concepto" column
+                    concept = bank_concepts[pos_bnk].upper()
+                    matches = [SequenceMatcher(None, concept, x.upper()).ratio() for x in df['CONCEPTO'].values[found]]
+                    pos = found[int(np.argmax(matches))]
+                else:
+                    continue
+                index.remove(pos)
+                idx = [df.index[pos]]
+                buckets.append((self.df_bank.index[pos_bnk], idx if df_type == DataType.EXP else None,
+                                idx if df_type == DataType.INC else None))
+            if self.__step_progress(progress, step, len(positions_bnk), len(positions_bnk), buckets):
+                return True
+        return False
+
+    @profiler.timed(rows=_count_rows)
+    def bucket_approximate_match(self, delta_cents: float = 1, progress=None) -> bool:
+        """
+        Second step of automatic_bucket_expenses: assigns those rows of bank and expenses that almost perfectly match
+        (and with dates within date_window_days)
+        Args:
+            delta_cents: maximum difference in cents between bank and expenses amounts
+            progress: optional progress function (see automatic_bucket_expenses)
+
+        Returns:
+            True if stopped by progress
+        """
+        bank_days = self.__bank_days()
+        bank_cents = self.df_bank[self._COL_CENTS].values
+        index = self.candidate_index(DataType.EXP)
+        buckets = []
+        step = "Importe aproximado con gastos"
+        positions_bnk = np.flatnonzero(self.df_bank[self._COL_BUCKET].isna().values)
+        for number, pos_bnk in enumerate(positions_bnk):
+            if self.__step_progress(progress, step, number, len(positions_bnk), buckets):
+                return True
+            target = bank_cents[pos_bnk]
             # try to find those with +-delta
-            max_value = target + delta_cents
-            min_value = target - delta_cents
-            found = self.unassigned_exp[self.unassigned_exp[self._COL_CENTS].between(min_value, max_value)]
-            # print(found.shape)
-            if found.shape[0] == 1:
-                # print(idx_bnk, found, self.df_bank[idx_bnk, self.col_cents], self.df_expenses[idx_bnk, self.col_cents])
-                self.bucket(idx_bnk, idx_expenses=found.index.values)
-                continue
+            found = index.candidates_between(target - delta_cents, target + delta_cents, bank_days[pos_bnk])
+            if len(found) == 1:
+                index.remove(found)
+                buckets.append((self.df_bank.index[pos_bnk], self.df_expenses.index[found], None))
+        return self.__step_progress(progress, step, len(positions_bnk), len(positions_bnk), buckets)
 
-        ##################################################################
-        # Third step: find match within two consecutive rows in expenses
-        ##################################################################
+    @profiler.timed(rows=_count_rows)
+    def bucket_consecutive_expenses(self, progress=None) -> bool:
+        """
+        Third step of automatic_bucket_expenses: to a given row in bank, assigns two consecutive rows in expenses of
+        the same finca if the sum matches
+        Args:
+            progress: optional progress function (see automatic_bucket_expenses)
+
+        Returns:
+            True if stopped by progress
+        """
         expenses = self.unassigned_exp
-        idx_consecutive_exp = expenses.index[:-1][expenses.index.values[1:] - expenses.index.values[:-1] == 1]
-        consecutive_exp = list([expenses.loc[[idx, idx + 1], self._COL_CENTS].sum().round(2)
-                                for idx in idx_consecutive_exp])
-        for idx_bnk, row in self.unassigned_bnk.iterrows():
+        consecutive = expenses.index.values[1:] - expenses.index.values[:-1] == 1
+        idx_consecutive_exp = expenses.index[:-1][consecutive]
+        cents = expenses[self._COL_CENTS].to_numpy(dtype=np.int64)
+        consecutive_exp = (cents[:-1] + cents[1:])[consecutive].tolist()
+        step = "Dos gastos consecutivos"
+        unassigned_bnk = self.unassigned_bnk
+        for number, (idx_bnk, row) in enumerate(unassigned_bnk.iterrows()):
+            if self.__step_progress(progress, step, number, unassigned_bnk.shape[0], []):
+                return True
             target = row[self._COL_CENTS]
             for idx_exp, value_exp in zip(idx_consecutive_exp, consecutive_exp):
                 if pd.isna(self.df_expenses.loc[idx_exp, self._COL_BUCKET]):
@@ -378,8 +973,134 @@ class Conciliation:
                     if expenses.loc[idx_bucket[0], col_finca] == expenses.loc[idx_bucket[1], col_finca]:
                         if target == value_exp:
                             self.bucket(idx_bnk, idx_expenses=idx_bucket)
+        return self.__step_progress(progress, step, unassigned_bnk.shape[0], unassigned_bnk.shape[0], [])
 
-        return
+    def __suggest_index(self, data_type: DataType) -> dict:
+        """Returns (building them if needed) the indexes of a df by amount, by sum of pairs of consecutive rows of the
+        same finca and by text, plus its dates as days (nan if there are no dates)"""
+        self.__check_frame(data_type)
+        if data_type not in self._suggest_indexes:
+            df = self.dfs[data_type]
+            cents = df[self._COL_CENTS].to_numpy(dtype=np.int64)
+            texts = df[self._COLS_TEXT[data_type]].fillna("").astype(str).agg(" ".join, axis=1)
+            if 'finca' in df.columns:
+                finca = df['finca'].values
+                pairs = np.flatnonzero(finca[:-1] == finca[1:])
+            else:
+                pairs = np.array([], dtype=np.int64)
+            col_date = self._COL_DATE if self._COL_DATE in df.columns else None
+            days = to_days(df[col_date]) if col_date else np.full(df.shape[0], np.nan)
+            self._suggest_indexes[data_type] = dict(amount=AmountDateIndex(cents), pairs=pairs, days=days,
+                                                    pairs_amount=AmountDateIndex(cents[pairs] + cents[pairs + 1]),
+                                                    text=TextIndex(texts))
+        return self._suggest_indexes[data_type]
+
+    def suggest(self, data_type: DataType, row_positions, k: int = 5) -> pd.DataFrame:
+        """
+        Suggests the unassigned rows of the other dfs (bank for expenses and incomes, expenses and incomes for bank)
+        that best match the given rows: rows or pairs of consecutive rows of the same finca with the same amount,
+        and rows with similar texts. Among similar ones, those with closer dates (if available) go first
+        Args:
+            data_type: the DataType of the given rows
+            row_positions: positions of the rows in the df of data_type (e.g. the selected rows of a table)
+            k: maximum number of suggestions
+
+        Returns:
+            a DataFrame with up to k suggestions, best first, with columns data_type (DataType of the suggested rows),
+            positions (tuple of their positions in its df), index (tuple of their index), value_cents (their sum),
+            cents_diff (difference with the sum of the given rows), text_score (text similarity, 0 to 1) and score
+        """
+        row_positions = np.atleast_1d(np.asarray(row_positions, dtype=np.int64))
+        target = int(self.dfs[data_type][self._COL_CENTS].to_numpy(dtype=np.int64)[row_positions].sum())
+        indexes = self.__suggest_index(data_type)
+        text = " ".join(indexes["text"].texts[position] for position in row_positions)
+        days = indexes["days"][row_positions]
+        day = days[~np.isnan(days)].mean() if not np.isnan(days).all() else np.nan
+        min_cents, max_cents = target - self._SUGGEST_TOLERANCE_CENTS, target + self._SUGGEST_TOLERANCE_CENTS
+        rows = []
+        for other in [DataType.BNK] if data_type != DataType.BNK else [DataType.EXP, DataType.INC]:
+            df = self.dfs.get(other)
+            if df is None:
+                continue
+            indexes = self.__suggest_index(other)
+            unassigned = df[self._COL_BUCKET].isna().values
+            cents = df[self._COL_CENTS].to_numpy(dtype=np.int64)
+            found = np.union1d(indexes["amount"].candidates_between(min_cents, max_cents),
+                               indexes["text"].search(text, self._SUGGEST_TEXT_CANDIDATES))
+            found = found[unassigned[found]]
+            for position, text_score in zip(found.tolist(), indexes["text"].similarity(text, found)):
+                rows.append((other, (position,), df.index[position], cents[position], text_score,
+                             indexes["days"][position]))
+            pairs = indexes["pairs"][indexes["pairs_amount"].candidates_between(min_cents, max_cents)]
+            pairs = pairs[unassigned[pairs] & unassigned[pairs + 1]]
+            for position in pairs.tolist():
+                text_score = indexes["text"].similarity(text, [position, position + 1]).max()
+                rows.append((other, (position, position + 1), tuple(df.index[[position, position + 1]]),
+                             cents[position] + cents[position + 1], text_score, indexes["days"][position]))
+        result = pd.DataFrame(rows, columns=["data_type", "positions", "index", self._COL_CENTS, "text_score",
+                                             "days"])
+        result["index"] = [index if isinstance(index, tuple) else (index,) for index in result["index"]]
+        result.insert(4, "cents_diff", result[self._COL_CENTS] - target)
+        diff = result["cents_diff"].abs().to_numpy(dtype=float)
+        # Same amount counts as much as same text. Other amounts count less the more they differ
+        amount_score = np.where(diff <= self._SUGGEST_TOLERANCE_CENTS, 1 - diff / 10,
+                                0.5 * np.clip(1 - diff / max(abs(target), 100), 0, 1))
+        # Dates just break ties: up to 0.2 for the same date, nothing for a month or more (or missing dates)
+        date_score = 0.2 * np.clip(1 - np.abs(result.pop("days").to_numpy(dtype=float) - day) / 31, 0, 1)
+        result["score"] = (amount_score + result["text_score"] + np.nan_to_num(date_score) -
+                           0.05 * (result["positions"].str.len() - 1))
+        return result.sort_values("score", ascending=False, kind="stable").head(k).reset_index(drop=True)
+
+    def bucket_balances(self) -> pd.DataFrame:
+        """
+        Balance of each bucket, taken from the totals that the bucket indexes keep up to date as rows are assigned and
+        unassigned, so dfs are not scanned
+        Returns:
+            a DataFrame indexed by Bucket (sorted) with the number of rows ("filas banco", "filas gastos", "filas
+            ingresos") and cents ("céntimos banco"...) of each data type in the bucket, and "diferencia" (cents of bank
+            minus cents of expenses and incomes)
+        """
+        indexes = {data_type: self.bucket_index(data_type) for data_type in DataType if data_type in self.dfs}
+        columns = dict()
+        for data_type in DataType:
+            index = indexes.get(data_type)
+            columns[f"filas {data_type.value}"] = pd.Series(
+                {bucket: len(positions) for bucket, positions in index.by_bucket.items()} if index else {},
+                dtype=np.int64)
+        for data_type in DataType:
+            index = indexes.get(data_type)
+            columns[f"céntimos {data_type.value}"] = pd.Series(index.totals if index else {}, dtype=np.int64)
+        balances = pd.DataFrame(columns).fillna(0).astype(np.int64).sort_index().rename_axis(self._COL_BUCKET)
+        balances["diferencia"] = (balances[f"céntimos {DataType.BNK.value}"] -
+                                  balances[f"céntimos {DataType.EXP.value}"] -
+                                  balances[f"céntimos {DataType.INC.value}"])
+        return balances
+
+    @profiler.timed(rows=_count_rows)
+    def validate_buckets(self, tolerance_cents: int = 0) -> pd.DataFrame:
+        """
+        Checks all buckets at once, using their balances (see bucket_balances)
+        Args:
+            tolerance_cents: maximum difference in cents between bank and expenses/incomes of a balanced bucket (note
+            that automatic_bucket_expenses matches amounts that differ up to 1 cent)
+
+        Returns:
+            a DataFrame with a row for each problem found, sorted by bucket, with columns Bucket, "problema" (one of
+            PROBLEM_ORPHAN, PROBLEM_MIXED or PROBLEM_UNBALANCED) and the columns of bucket_balances. Empty if there
+            are no problems
+        """
+        balances = self.bucket_balances()
+        rows = {data_type: balances[f"filas {data_type.value}"].to_numpy() > 0 for data_type in DataType}
+        n_types = sum(has_rows.astype(int) for has_rows in rows.values())
+        masks = {
+            self.PROBLEM_ORPHAN: n_types == 1,
+            self.PROBLEM_MIXED: rows[DataType.EXP] & rows[DataType.INC],
+            self.PROBLEM_UNBALANCED: (n_types > 1) & rows[DataType.BNK] &
+                                     (np.abs(balances["diferencia"].to_numpy()) > tolerance_cents),
+        }
+        problems = pd.concat([balances[mask].assign(problema=problem) for problem, mask in masks.items()])
+        problems = problems.reset_index().sort_values(self._COL_BUCKET, kind="stable")
+        return problems[[self._COL_BUCKET, "problema"] + balances.columns.tolist()].reset_index(drop=True)
 
     def _check_vs_bnk(self, other_df: pd.DataFrame):
         """
@@ -409,6 +1130,7 @@ class Conciliation:
         else:
             return False
 
+    @profiler.timed(rows=_count_rows)
     def check_buckets(self):
         # Check matching buckets from df1 and df2
         if not self.has_all_data:
@@ -435,6 +1157,138 @@ class Conciliation:
                        )
         return retval, retdict
 
+    def check_buckets_by_account(self):
+        """
+        Totals of check_buckets for each bank account (see read_banks). Expenses and incomes are assigned to the
+        account of the bank rows of their bucket
+        Returns:
+            a DataFrame indexed by account with the amounts in euros of the bank rows not assigned ("banco solo"),
+            assigned to expenses ("banco gastos") and incomes ("banco ingresos"), and of the expenses ("gastos") and
+            incomes ("ingresos") assigned to them. None if there is no data or bank data has no accounts
+        """
+        if not self.has_all_data or not self.accounts:
+            return None
+        bank = self.df_bank
+        account_of_bucket = bank.dropna(subset=[self.col_bucket]).drop_duplicates(self.col_bucket).set_index(
+            self.col_bucket)[self._COL_ACCOUNT]
+        bnk_exp, exp_bnk, _, _ = self._check_vs_bnk(self.df_expenses)
+        bnk_inc, inc_bnk, _, _ = self._check_vs_bnk(self.df_incomes)
+        matched = bank[self.col_bucket].notna() & (bank.index.isin(bnk_exp.index) | bank.index.isin(bnk_inc.index))
+
+        def totals(df: pd.DataFrame, account: pd.Series) -> pd.Series:
+            return df[self.col_cents].groupby(account.values).sum() / 100
+
+        retval = pd.DataFrame({
+            "banco solo": totals(bank[~matched], bank.loc[~matched, self._COL_ACCOUNT]),
+            "banco gastos": totals(bnk_exp, bnk_exp[self._COL_ACCOUNT]),
+            "gastos": totals(exp_bnk, exp_bnk[self.col_bucket].map(account_of_bucket)),
+            "banco ingresos": totals(bnk_inc, bnk_inc[self._COL_ACCOUNT]),
+            "ingresos": totals(inc_bnk, inc_bnk[self.col_bucket].map(account_of_bucket)),
+        }, index=pd.Index(self.accounts, name=self._COL_ACCOUNT))
+        return retval.fillna(0)
+
+    def __row_keys(self, data_type: DataType, columns: list, numeric: set) -> pd.DataFrame:
+        """Returns a DataFrame with the fingerprint, occurrence (to tell equal rows apart), position and bucket of each
+        row of a df"""
+        df = self.dfs.get(data_type)
+        if df is None:
+            return pd.DataFrame({"fingerprint": np.array([], dtype=np.uint64), "occurrence": 0, "position": 0,
+                                 "bucket": np.array([], dtype=float)})
+        keys = pd.DataFrame({"fingerprint": _fingerprints(df, columns, numeric), "position": np.arange(df.shape[0]),
+                             "bucket": pd.to_numeric(df[self._COL_BUCKET], errors="coerce").to_numpy(dtype=float)})
+        keys.insert(1, "occurrence", keys.groupby("fingerprint").cumcount())
+        return keys
+
+    @staticmethod
+    def __bucket_signatures(keys: dict) -> dict:
+        """Adds to the row keys of each DataType a "signature" column: an order independent hash of the members of
+        the bucket of the row (0 for unassigned rows), so buckets of different files can be compared"""
+        members = pd.concat([keys_type.assign(data_type=number) for number, keys_type in enumerate(keys.values())],
+                            ignore_index=True)
+        hashes = pd.util.hash_pandas_object(members[["data_type", "fingerprint", "occurrence"]], index=False)
+        assigned = members["bucket"].notna().to_numpy()
+        codes, buckets = pd.factorize(members["bucket"][assigned])
+        signatures = np.zeros(len(buckets), dtype=np.uint64)
+        np.add.at(signatures, codes, hashes.to_numpy(dtype=np.uint64)[assigned])  # Sum wraps around
+        signature = np.zeros(members.shape[0], dtype=np.uint64)
+        signature[assigned] = signatures[codes]
+        start = 0
+        for data_type, keys_type in keys.items():
+            keys[data_type] = keys_type.assign(signature=signature[start:start + keys_type.shape[0]])
+            start += keys_type.shape[0]
+        return keys
+
+    @profiler.timed(rows=lambda result, self, other: _count_rows(None, self) + _count_rows(None, other))
+    def diff(self, other) -> dict:
+        """
+        Compares this conciliation (the old version) with another version of the same data (e.g. two saved Excel
+        files). Rows are compared by a 64 bit fingerprint of the values of their common columns, and buckets by
+        their members (bucket numbers of different versions are not related), so just hashes are compared and kept
+        Args:
+            other: the new version, another Conciliation
+
+        Returns:
+            a dict with:
+            - "totals": a DataFrame indexed by data type with the rows, assigned rows, amounts and assigned amounts (in
+            euros) of both versions, and the number of rows added, removed and rebucketed
+            - "added": a dict indexed by DataType with the rows of other that are not in this conciliation
+            - "removed": a dict indexed by DataType with the rows of this conciliation that are not in other
+            - "rebucketed": a dict indexed by DataType with the rows (of other) found in both versions whose bucket
+            changed (assigned, unassigned or matched with other rows), with their previous bucket and the change
+        """
+        keys = {version: dict() for version in ("old", "new")}
+        for data_type in DataType:
+            old, new = self.dfs.get(data_type), other.dfs.get(data_type)
+            if old is None and new is None:
+                continue
+            common = old.columns.intersection(new.columns) if old is not None and new is not None else \
+                (old if new is None else new).columns
+            excluded = [self._COL_BUCKET, self._COL_CENTS] + self._COLS_PROVENANCE
+            columns = [col for col in common if col not in excluded]
+            numeric = {col for col in columns if all(pd.api.types.is_numeric_dtype(df[col].dtype) and
+                                                     not pd.api.types.is_bool_dtype(df[col].dtype)
+                                                     for df in (old, new) if df is not None)}
+            keys["old"][data_type] = self.__row_keys(data_type, columns, numeric)
+            keys["new"][data_type] = other.__row_keys(data_type, columns, numeric)
+        keys = {version: self.__bucket_signatures(keys_version) for version, keys_version in keys.items()}
+
+        retval = dict(added=dict(), removed=dict(), rebucketed=dict())
+        totals = dict()
+        for data_type in keys["old"]:
+            merged = keys["old"][data_type].merge(keys["new"][data_type], on=["fingerprint", "occurrence"],
+                                                  how="outer", suffixes=("_old", "_new"), indicator=True)
+            old_positions = merged.loc[merged["_merge"] == "left_only", "position_old"].astype(np.int64)
+            new_positions = merged.loc[merged["_merge"] == "right_only", "position_new"].astype(np.int64)
+            both = merged[(merged["_merge"] == "both") & (merged["signature_old"] != merged["signature_new"])]
+            both = both.sort_values("position_new")
+            empty = pd.DataFrame(columns=[self._COL_BUCKET])
+            old_df, new_df = self.dfs.get(data_type, empty), other.dfs.get(data_type, empty)
+            retval["removed"][data_type] = old_df.take(np.sort(old_positions.to_numpy()))
+            retval["added"][data_type] = new_df.take(np.sort(new_positions.to_numpy()))
+            rebucketed = new_df.take(both["position_new"].astype(np.int64).to_numpy())
+            rebucketed.insert(len(rebucketed.columns), "Bucket anterior", both["bucket_old"].to_numpy())
+            rebucketed.insert(len(rebucketed.columns), "Cambio", np.select(
+                [both["bucket_old"].isna().to_numpy(), both["bucket_new"].isna().to_numpy()],
+                ["punteada", "despunteada"], "cambio de punteo"))
+            retval["rebucketed"][data_type] = rebucketed
+
+            row = dict()
+            for version, conciliation in ("antes", self), ("después", other):
+                df = conciliation.dfs.get(data_type)
+                cents = df[self._COL_CENTS] if df is not None else pd.Series(dtype=np.int64)
+                assigned = df[self._COL_BUCKET].notna() if df is not None else pd.Series(dtype=bool)
+                row[f"filas {version}"] = cents.shape[0]
+                row[f"punteadas {version}"] = int(assigned.sum())
+                row[f"importe {version}"] = cents.sum() / 100
+                row[f"importe punteado {version}"] = cents[assigned].sum() / 100
+            row["añadidas"] = len(new_positions)
+            row["borradas"] = len(old_positions)
+            row["cambios de punteo"] = both.shape[0]
+            totals[data_type.value] = row
+        retval["totals"] = pd.DataFrame.from_dict(totals, orient="index")
+        return retval
+
+    @profiler.timed(rows=_count_rows)
     def save_as(self, filename):
         """Saves model to an Excel filename so it can be used later. Overwrites file, does not check anything"""
 
@@ -482,6 +1336,17 @@ class Conciliation:
                 if self.col_cents in df.columns:
                     df = df.drop(self.col_cents, axis=1)
                 df_to_excel(df, writer, sheet_name)
+            if (by_account := self.check_buckets_by_account()) is not None:
+                df_to_excel(by_account.reset_index(), writer, self._SHEET_ACCOUNTS)
+            df_to_excel(self.__balances_sheet(), writer, self._SHEET_BALANCES)
+
+    def __balances_sheet(self) -> pd.DataFrame:
+        """Returns bucket_balances with amounts in euros, for save_as"""
+        balances = self.bucket_balances()
+        for col in balances.columns:
+            if col.startswith("céntimos") or col == "diferencia":
+                balances[col] = balances[col] / 100
+        return balances.rename(columns=lambda col: col.replace("céntimos", "importe")).reset_index()
 
     def main(self):
         self.automatic_bucket_expenses()
@@ -491,6 +1356,11 @@ class Conciliation:
         return match
 
 
+def _read_bank_file(bank_filename: str) -> dict:
+    """Reads a bank file with Conciliation.read_bank, in a function that can be run in another process"""
+    return Conciliation().read_bank(bank_filename)
+
+
 if __name__ == '__main__':
     from tests.test_conciliation_model import TestConciliationUpdate
 
@@ -3,18 +3,180 @@ Extends pandas table to have a custom toolbar (that sum selected value in cents)
 """
 from tkinter import Label
 
+import numpy as np
 import pandas as pd
 
 from ong_gesfincas.conciliation_model import Conciliation
-from pandastable import Table
+from pandastable import Table, TableModel
+
+
+class ConciliationTableModel(TableModel):
+    """
+    TableModel that shows the rows of a source DataFrame given by an array of row positions (None for all rows), so
+    filtered views (e.g. "asignados" or "no asignados") don't copy the source DataFrame.
+    ConciliationTable only reads the visible rows of the source to draw the table, and its headers only read the
+    columns and index names (see header_df). The filtered DataFrame (model.df) is only materialized (and cached) when
+    other pandastable features need it, e.g. its menus. It is always a copy, so pandastable never changes the source
+    (that is a DataFrame of the Conciliation). Sorting reorders the positions (see sort)
+    """
+
+    def __init__(self, dataframe=None, positions=None):
+        self.source = None
+        self.positions = None
+        self._df = None
+        self._header_df = None
+        self._cumsum_cents = None
+        TableModel.__init__(self, dataframe)
+        self.set_positions(positions)
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._df is None:
+            self._df = self.source.copy() if self.positions is None else self.source.take(self.positions)
+        return self._df
+
+    @df.setter
+    def df(self, value: pd.DataFrame):
+        # pandastable sets df directly (e.g. when sorting), so the new DataFrame becomes the source with all rows
+        self.source = value
+        self.positions = None
+        self._df = value
+        self._header_df = None
+        self._cumsum_cents = None
+
+    def set_view(self, source: pd.DataFrame, positions=None):
+        """Sets a new source DataFrame and the row positions of the source to be shown (None for all)"""
+        self.source = source
+        self._header_df = None
+        self.set_positions(positions)
+
+    def set_positions(self, positions=None):
+        """Changes the row positions of the source to be shown (None for all)"""
+        self.positions = None if positions is None else np.asarray(positions, dtype=np.int64)
+        self._df = None
+        self._cumsum_cents = None
+
+    def sort(self, columns: list = None, ascending=True, index: bool = False):
+        """
+        Sorts the rows shown (stable sort) by reordering the positions, so the source is not changed
+        Args:
+            columns: names of the columns to sort by
+            ascending: True, False or a list with a value for each column
+            index: True to sort by the index of the source instead of by columns
+
+        Returns:
+            None
+        """
+        positions = self.source_positions(np.arange(self.getRowCount()))
+        if index:
+            order = self.source.index[positions].argsort(kind="stable")
+        else:
+            ascending = [bool(value) for value in ascending] if isinstance(ascending, (list, tuple)) \
+                else bool(ascending)
+            values = self.source[columns].take(positions).reset_index(drop=True)
+            order = values.sort_values(by=columns, ascending=ascending, kind="stable").index.to_numpy()
+        self.set_positions(positions[order])
+
+    @property
+    def header_df(self) -> pd.DataFrame:
+        """A DataFrame with the columns and index names of the source but no rows, enough for the table headers"""
+        if self._header_df is None:
+            self._header_df = self.source.iloc[:0]
+        return self._header_df
+
+    def getRowCount(self):
+        return self.source.shape[0] if self.positions is None else len(self.positions)
+
+    def getColumnCount(self):
+        return len(self.source.columns)
+
+    def getColumnName(self, columnIndex):
+        return str(self.source.columns[columnIndex])
+
+    def getlongestEntry(self, colindex, n=500):
+        """Same as TableModel.getlongestEntry (just uses the first n rows), but without materializing df"""
+        column = self.get_rows(range(min(n, self.getRowCount()))).iloc[:, colindex]
+        try:
+            if column.dtype in ['float32', 'float64']:
+                column = column.round(3)
+            longest = column.astype('object').astype('str').str.len().max()
+        except Exception:
+            return 1
+        return 1 if pd.isna(longest) else longest
+
+    def source_positions(self, rows) -> np.ndarray:
+        """Converts row numbers of the table into row positions of the source DataFrame"""
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows if self.positions is None else self.positions[rows]
+
+    def get_rows(self, rows) -> pd.DataFrame:
+        """Returns a DataFrame with just the given row numbers of the table"""
+        return self.source.take(self.source_positions(rows))
+
+    def get_index(self, rows=None) -> pd.Index:
+        """Returns the index of the source DataFrame for the given row numbers of the table (None for all)"""
+        if rows is None:
+            return self.source.index if self.positions is None else self.source.index[self.positions]
+        return self.source.index[self.source_positions(rows)]
+
+    @property
+    def cumsum_cents(self) -> np.ndarray:
+        """Prefix sums of the value in cents of the rows in the order they are shown (starting with a 0)"""
+        if self._cumsum_cents is None:
+            if Conciliation.col_cents in self.source.columns:
+                cents = self.source[Conciliation.col_cents].to_numpy(dtype=np.int64)
+                if self.positions is not None:
+                    cents = cents[self.positions]
+            else:
+                cents = np.zeros(self.getRowCount(), dtype=np.int64)
+            self._cumsum_cents = np.concatenate(([0], np.cumsum(cents)))
+        return self._cumsum_cents
+
+    def sum_cents(self, start: int, end: int) -> int:
+        """Sum of the value in cents of the rows of the table from start to end (not included), in constant time"""
+        return int(self.cumsum_cents[end] - self.cumsum_cents[start])
+
+    def sum_cents_rows(self, rows) -> int:
+        """Sum of the value in cents of the given rows of the table"""
+        rows = np.asarray(rows, dtype=np.int64)
+        return int((self.cumsum_cents[rows + 1] - self.cumsum_cents[rows]).sum())
+
+
+class _HeaderModel:
+    """
+    Model given to the headers of a ConciliationTable: its df is the header_df of the ConciliationTableModel (columns
+    and index names, no rows), anything else is read from the ConciliationTableModel
+    """
+
+    def __init__(self, model: ConciliationTableModel):
+        self.model = model
+
+    @property
+    def df(self) -> pd.DataFrame:
+        return self.model.header_df
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
 
 
 class ConciliationTable(Table):
     def __init__(self, parent=None, **kwargs):
         # Force not to show status bar
         kwargs['showstatusbar'] = False
+        # Use always a ConciliationTableModel
+        if (dataframe := kwargs.pop('dataframe', None)) is not None:
+            kwargs['model'] = ConciliationTableModel(dataframe)
         Table.__init__(self, parent, **kwargs)
         self.statusbar = None
+        # Sum in cents of the selected rows (None if nothing is selected), updated on each mouse event
+        self._selection_cents = None
+        # Set of the selected rows, only kept while selecting with ctrl-click (None otherwise)
+        self._selection_rows = None
+        # Boolean mask (one value per row of the source DataFrame) of the rows to be colored with highlight_color
+        self.highlight_mask = None
+        self.highlight_color = None
+        # Function called (with this table as argument) each time the selection is changed with the mouse
+        self.on_selection_change = None
 
     def show(self, callback=None):
         """Adds a status bar for summarizing"""
@@ -25,27 +187,162 @@ class ConciliationTable(Table):
 
     def __redraw_statusbar(self):
         if hasattr(self, "statusbar"):
-            try:
-                rows = self.getSelectedRowData()
-                # print(rows)
-            except:
-                rows = pd.DataFrame()
-            if not rows.empty:
-                total = rows[Conciliation.col_cents].sum() / 100
+            if self._selection_cents is not None:
+                total = self._selection_cents / 100
                 text = f"Suma de la selección: {total:,.2f}€"
             else:
                 text = "Nada seleccionado"
             self.statusbar.config(text=text)
 
+    def __selection_changed(self):
+        self.__redraw_statusbar()
+        if self.on_selection_change is not None:
+            self.on_selection_change(self)
+
+    def __sum_selection(self):
+        """Sums the selected rows from scratch (needed if selection was not changed with the mouse)"""
+        self._selection_rows = None
+        try:
+            self._selection_cents = self.model.sum_cents_rows(self.get_selected_rows())
+        except (IndexError, TypeError):
+            self._selection_cents = None  # Empty table or no valid row selected
+
+    def __sum_range(self, start: int, end: int):
+        """Sets the sum of the selection for a range of rows from start to end (both included, in any order)"""
+        self._selection_rows = None
+        start, end = min(start, end), max(start, end)
+        if 0 <= start and end < self.model.getRowCount():
+            self._selection_cents = self.model.sum_cents(start, end + 1)
+        else:
+            self._selection_cents = None
+
     def redraw(self, event=None, callback=None):
         self.columnwidths[Conciliation.col_cents] = 0       # Hide value cents column
         Table.redraw(self, event=event, callback=callback)
+        self.__sum_selection()
         self.__redraw_statusbar()
 
+    def redrawVisible(self, event=None, callback=None):
+        """
+        Same as Table.redrawVisible, but only the visible rows are read from the model (see ConciliationTableModel),
+        so rows out of the viewport are neither materialized nor formatted
+        """
+        if not hasattr(self, 'colheader'):
+            return
+        model = self.model
+        is_conciliation_model = isinstance(model, ConciliationTableModel)
+        # Headers only need the column names (and the index of the visible rows if the index is shown)
+        header_model = _HeaderModel(model) if is_conciliation_model else model
+        self.colheader.model = self.rowindexheader.model = header_model
+        self.rowheader.model = model if self.showindex else header_model
+        if not is_conciliation_model or model.getRowCount() == 0 or model.getColumnCount() == 0:
+            return Table.redrawVisible(self, event=event, callback=callback)
+        self.rows = model.getRowCount()
+        self.cols = model.getColumnCount()
+        self.tablewidth = self.cellwidth * self.cols
+        self.configure(bg=self.cellbackgr)
+        self.setColPositions()
+        if self.filtered:
+            self.delete('colrect')
+        self.rowrange = list(range(0, self.rows))
+        self.configure(scrollregion=(0, 0, self.tablewidth + self.x_start, self.rowheight * self.rows + 10))
+
+        x1, y1, x2, y2 = self.getVisibleRegion()
+        startvisiblerow, endvisiblerow = self.getVisibleRows(y1, y2)
+        self.visiblerows = list(range(startvisiblerow, endvisiblerow))
+        startvisiblecol, endvisiblecol = self.getVisibleCols(x1, x2)
+        self.visiblecols = list(range(startvisiblecol, endvisiblecol))
+
+        self.drawGrid(startvisiblerow, endvisiblerow)
+        self.delete('fillrect')
+        viewport = model.get_rows(self.visiblerows)
+        alignments = self.columnformats['alignment']
+        for col in self.visiblecols:
+            coldata = viewport.iloc[:, col]
+            align = alignments.get(viewport.columns[col], self.align)
+            if coldata.dtype in ['float64', 'float32', 'int']:
+                coldata = coldata.apply(lambda x: self.setPrecision(x, self.floatprecision))
+            if pd.api.types.is_datetime64_any_dtype(coldata):
+                coldata = coldata.dt.strftime(self.timeformat)
+            coldata = coldata.infer_objects(copy=False).fillna('')
+            for row, text in zip(self.visiblerows, coldata):
+                self.drawText(row, col, text, align=align)
+
+        self.colorColumns()
+        self.colorRows()
+        self.colheader.redraw(align=self.align)
+        self.rowheader.redraw()
+        self.rowindexheader.redraw()
+        self.drawSelectedRow()
+        self.drawSelectedRect(self.currentrow, self.currentcol)
+        if len(self.multiplerowlist) > 1:
+            self.rowheader.drawSelectedRows(self.multiplerowlist)
+            self.drawMultipleRows(self.multiplerowlist)
+            self.drawMultipleCells()
+        self.drawHighlighted()
+
+    def setColPositions(self):
+        """Same as Table.setColPositions, but reading the column names with model.getColumnName instead of model.df"""
+        self.col_positions = [self.x_start]
+        for col in range(self.cols):
+            width = self.columnwidths.get(self.model.getColumnName(col), self.cellwidth)
+            self.col_positions.append(self.col_positions[-1] + width)
+        self.tablewidth = self.col_positions[-1]
+
+    def colorColumns(self, cols=None, color='gray'):
+        """Same as Table.colorColumns, but reading the column names with model.getColumnName instead of model.df"""
+        if cols is None:
+            cols = self.visiblecols
+        self.delete('colorrect')
+        for col in cols:
+            if (name := self.model.getColumnName(col)) in self.columncolors:
+                self.drawSelectedCol(col, delete=0, color=self.columncolors[name], tag='colorrect')
+
+    def sortTable(self, columnIndex=None, ascending=1, index=False):
+        """Same as Table.sortTable, but sorting the rows shown by the ConciliationTableModel (see its sort method)
+        instead of sorting model.df in place"""
+        if not isinstance(self.model, ConciliationTableModel):
+            return Table.sortTable(self, columnIndex, ascending, index)
+        if columnIndex is None:
+            columnIndex = self.multiplecollist
+        if isinstance(columnIndex, int):
+            columnIndex = [columnIndex]
+        columns = list(self.model.source.columns[columnIndex])
+        try:
+            self.model.sort(columns, ascending, index)
+        except TypeError as e:
+            print('could not sort')     # Same as pandastable (e.g. columns mixing numbers and texts)
+            print(e)
+        self.redraw()
+
+    def set_highlight(self, mask, color: str):
+        """
+        Sets the rows to be colored. Only the visible rows are read from the mask when the table is redrawn
+        Args:
+            mask: a boolean numpy array with a value for each row of the source DataFrame, or None to color nothing
+            color: the color for the rows where mask is True
+        Returns:
+            None
+        """
+        self.highlight_mask = mask
+        self.highlight_color = color
+
+    def colorRows(self):
+        """Colors the visible rows where highlight_mask is True, then the rows colored using pandastable menus"""
+        if (self.highlight_mask is not None and isinstance(self.model, ConciliationTableModel) and
+                len(self.highlight_mask) == self.model.source.shape[0]):
+            rows = np.asarray(self.visiblerows)
+            for row in rows[self.highlight_mask[self.model.source_positions(rows)]]:
+                for col in self.visiblecols:
+                    self.drawRect(row, col, color=self.highlight_color, tag='colorrect', delete=0)
+        if len(self.rowcolors.columns) > 0:
+            Table.colorRows(self)
+
     def handle_left_click(self, event):
         """Example - override left click"""
         Table.handle_left_click(self, event)
-        self.__redraw_statusbar()
+        self.__sum_range(self.startrow, self.startrow)
+        self.__selection_changed()
         return
 
     def handle_left_release(self, event):
@@ -54,15 +351,33 @@ class ConciliationTable(Table):
 
     def handle_mouse_drag(self, event):
         super().handle_mouse_drag(event)
-        self.__redraw_statusbar()
+        # Selection is either a range from startrow to endrow or just the current row
+        if len(self.multiplerowlist) > 1:
+            self.__sum_range(self.startrow, self.endrow)
+        else:
+            self.__sum_range(self.currentrow, self.currentrow)
+        self.__selection_changed()
 
     def handle_left_ctrl_click(self, event):
+        row = self.get_row_clicked(event)
+        if self._selection_rows is None:
+            self._selection_rows = set(self.multiplerowlist)
+            self._selection_cents = self.model.sum_cents_rows(self.multiplerowlist) if self._selection_rows else 0
         Table.handle_left_ctrl_click(self, event)
-        self.__redraw_statusbar()
+        # Table.handle_left_ctrl_click toggles the selection of the clicked row
+        if row is not None and 0 <= row < self.rows:
+            row_cents = self.model.sum_cents(row, row + 1)
+            if row in self._selection_rows:
+                self._selection_rows.remove(row)
+                self._selection_cents -= row_cents
+            else:
+                self._selection_rows.add(row)
+                self._selection_cents += row_cents
+        self.__selection_changed()
 
     def handle_left_shift_click(self, event):
         Table.handle_left_shift_click(self, event)
-        self.__redraw_statusbar()
+        self.__selection_changed()
 
     # def mouse_wheel(self, event):
     #     """Handle mouse wheel scroll for windows and mac (darwin)"""
@@ -78,44 +393,65 @@ class ConciliationTable(Table):
     #     self.redrawVisible()
     #     return
 
+    def get_selected_rows(self) -> list:
+        """Returns the list of the selected row numbers of the table"""
+        return self.multiplerowlist if len(self.multiplerowlist) > 0 else [self.currentrow]
+
+    def get_selected_positions(self) -> np.ndarray:
+        """Returns the row positions in the source DataFrame of the selected rows"""
+        return self.model.source_positions(self.get_selected_rows())
+
     def get_selected_or_all(self):
         """Gets selected rows if any row is selected, else get all rows"""
-        if self.model.df.empty:
+        if self.model.getRowCount() == 0:
             return self.model.df  # If nothing to select...return emtpy dataframe
         try:
-            selected = self.getSelectedRowData()
+            selected = self.model.get_rows(self.get_selected_rows())
             return selected
         except Exception as e:
             return self.model.df
 
-    def set_df_redraw(self, new_df: pd.DataFrame):
+    def set_view_redraw(self, source: pd.DataFrame, positions=None):
         """
-        Sets a new DataFrame for current table. Changes model accordingly and tries to fix selected rows
-        to match previous selection
+        Sets a new view for current table: a source DataFrame and the row positions of the source to be shown. Changes
+        model accordingly and tries to fix selected rows to match previous selection
         Args:
-            new_df: A pandas dataframe
+            source: A pandas dataframe
+            positions: a numpy array with the row positions of the source to show, None to show all rows
         Returns:
             None
         """
-        if new_df.empty:
-            self.selectNone()
-            self.model.df = new_df
-        else:
-            old_selection = self.get_selected_or_all()
-            self.model.df = new_df
-            new_selection = new_df.index.intersection(old_selection.index)
-            if new_selection.empty:
-                self.selectNone()
-            else:
-                # Turn indexes into row positions
-                row_positions = [new_df.index.get_loc(idx) for idx in new_selection]
-                # print(old_selection.index, "->", new_selection, "->", row_positions)
-                self.selectNone()
-                self.redraw()
-                self.movetoSelection(row_positions[0])
+        if not isinstance(self.model, ConciliationTableModel):
+            self.updateModel(ConciliationTableModel(source, positions))
+        try:
+            old_selection = self.model.get_index(self.get_selected_rows())
+        except IndexError:
+            old_selection = None  # Empty table or selection out of the current view
+        self.model.set_view(source, positions)
+        self.selectNone()
+        if old_selection is not None and self.model.getRowCount() > 0:
+            row_positions = np.flatnonzero(self.model.get_index().isin(old_selection)).tolist()
+            if row_positions:
+                self.__scroll_to_row(row_positions[0])
+                self.currentrow = row_positions[0]
                 self.setSelectedRows(row_positions)
         self.redraw()
 
+    def __scroll_to_row(self, row: int):
+        """Scrolls to make visible the given row. Same as movetoSelection, but without redrawing the table"""
+        self.rows = self.model.getRowCount()
+        self.cols = self.model.getColumnCount()
+        self.setColPositions()
+        x, y = self.getCanvasPos(row, 0)
+        self.xview('moveto', x)
+        self.yview('moveto', y)
+        self.colheader.xview('moveto', x)
+        self.rowheader.yview('moveto', y)
+
+    def set_df_redraw(self, new_df: pd.DataFrame):
+        """Sets a new DataFrame (showing all its rows) for current table. See set_view_redraw"""
+        self.set_view_redraw(new_df)
+
     def set_defaults(self):
         """Modified to make maxcellwidth wider"""
         Table.set_defaults(self)
@@ -0,0 +1,116 @@
+"""
+Automatic bucketing partitioned by finca. Each bank row is assigned to the finca its concept refers to (using a
+FincaIndex of the names of the fincas), and then the bank rows of each finca are matched (as in
+Conciliation.automatic_bucket_expenses) only against the expenses and incomes of the same finca, in parallel processes.
+Bank rows that could not be assigned to a single finca are matched at the end against all expenses and incomes left
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_index import FincaIndex
+from ong_gesfincas.conciliation_model import Conciliation
+from ong_gesfincas.profiling import profiler
+
+_COL_FINCA = "finca"
+_COL_CONCEPT_BNK = "Concepto"
+_COL_TENANT = "Inquilino"
+
+
+def bank_fincas(conciliation: Conciliation) -> pd.Series:
+    """
+    Infers the finca of each bank row from its concept, that may contain the name of the finca or of a tenant
+    Args:
+        conciliation: a Conciliation with all data
+
+    Returns:
+        a Series with the same index as the bank, with the name of the finca or None if not found or ambiguous
+    """
+    index = FincaIndex(pd.concat([conciliation.df_expenses[_COL_FINCA], conciliation.df_incomes[_COL_FINCA]]))
+    # Tenants are usually found in the concept of the incomes
+    tenants = conciliation.df_incomes[[_COL_TENANT, _COL_FINCA]].drop_duplicates()
+    for tenant, finca in zip(tenants[_COL_TENANT], tenants[_COL_FINCA]):
+        index.add(tenant, finca)
+    concepts = conciliation.df_bank[_COL_CONCEPT_BNK]
+    fincas = dict()
+    for concept in concepts.unique():
+        candidates = index.candidates(concept)
+        fincas[concept] = candidates[0] if len(candidates) == 1 else None
+    return concepts.map(fincas)
+
+
+def match_partition(conciliation: Conciliation, delta_cents: float = 1) -> list:
+    """
+    Runs Conciliation.automatic_bucket_expenses over a (partial) conciliation
+    Args:
+        conciliation: a Conciliation, usually a subset of a bigger one
+        delta_cents: see Conciliation.automatic_bucket_expenses
+
+    Returns:
+        the new buckets found, as a list of tuples (idx_bank, idx_expenses, idx_incomes) to feed
+        Conciliation.bucket_many
+    """
+    conciliation.automatic_bucket_expenses(delta_cents)
+    return conciliation.bucket_list()
+
+
+@profiler.timed(rows=lambda result, conciliation, *args, **kwargs: conciliation.df_bank.shape[0])
+def automatic_bucket_by_finca(conciliation: Conciliation, delta_cents: float = 1, workers: int = None,
+                              rules=None, progress=None) -> dict:
+    """
+    Buckets automatically unassigned rows, matching bank rows only against expenses and incomes of their finca
+    Args:
+        conciliation: a Conciliation with all data. It is updated with the new buckets
+        delta_cents: see Conciliation.automatic_bucket_expenses
+        workers: maximum number of processes. Defaults to number of cpus. If 1, everything runs in this process
+        rules: optional conciliation_rules.MatchingRules, applied to all data before partitioning
+        progress: an optional function called as progress(step, done, total) after the buckets of each finca are
+        assigned (see Conciliation.automatic_bucket_expenses). If it returns True, matching stops
+
+    Returns:
+        a dict with the number of new buckets of each finca (None is the key for the rows without finca)
+    """
+    if rules is not None:
+        conciliation.bucket_by_rules(rules)
+        if progress is not None and progress("Reglas aprendidas", 1, 1):
+            return dict()
+    fincas = bank_fincas(conciliation)
+    unassigned = {data_type: conciliation.unassigned(data_type) for data_type in DataType}
+    bank = unassigned[DataType.BNK]
+    bank_finca = fincas.loc[bank.index]
+    names = []
+    partitions = []
+    for finca, idx_bank in bank.groupby(bank_finca).groups.items():
+        names.append(finca)
+        partitions.append(conciliation.subset({
+            DataType.BNK: idx_bank,
+            DataType.EXP: unassigned[DataType.EXP].index[unassigned[DataType.EXP][_COL_FINCA] == finca],
+            DataType.INC: unassigned[DataType.INC].index[unassigned[DataType.INC][_COL_FINCA] == finca],
+        }))
+    executor = None if workers == 1 or len(partitions) < 2 else ProcessPoolExecutor(max_workers=workers)
+    retval = dict()
+    try:
+        # Results are assigned as soon as each finca is done
+        results = (executor.map(match_partition, partitions, [delta_cents] * len(partitions)) if executor
+                   else (match_partition(partition, delta_cents) for partition in partitions))
+        for number, (finca, buckets) in enumerate(zip(names, results)):
+            conciliation.bucket_many(buckets)
+            retval[finca] = len(buckets)
+            if progress is not None and progress("Fincas", number + 1, len(partitions)):
+                return retval
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    # Bank rows without a single finca are matched against everything left
+    idx_bank = bank.index[bank_finca.isna().values]
+    remainder = conciliation.subset({DataType.BNK: idx_bank,
+                                     DataType.EXP: conciliation.unassigned(DataType.EXP).index,
+                                     DataType.INC: conciliation.unassigned(DataType.INC).index})
+    buckets = match_partition(remainder, delta_cents)
+    conciliation.bucket_many(buckets)
+    retval[None] = len(buckets)
+    if progress is not None:
+        progress("Movimientos sin finca", 1, 1)
+    return retval
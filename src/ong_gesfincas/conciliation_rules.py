@@ -0,0 +1,180 @@
+"""
+Matching rules learnt from previous conciliations. Most bank rows are recurring payments (utilities, insurance,
+cleaning...) matched every month with the same expense of the same finca, so a rule maps the pattern of a bank concept
+(its normalized words without numbers) to the patterns of the texts and the fincas of the expenses (or incomes) it
+was matched with, so invoice numbers or dates of the texts don't prevent matching rows of other periods.
+Rules are applied in a single pass over the bank, before the generic matching steps: a bank row is matched with an
+unassigned row of one of the targets of its pattern with the same amount (and the closest date, if there are many).
+
+Rules are saved to a json file, by default ~/.ong_gesfincas/reglas_punteo.json (it can be changed with the
+ONG_GESFINCAS_RULES environment variable)
+"""
+import json
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_index import normalize_text, to_days
+from ong_gesfincas.conciliation_model import Conciliation
+
+DEFAULT_RULES_FILE = os.environ.get("ONG_GESFINCAS_RULES") or os.path.join(os.path.expanduser("~"), ".ong_gesfincas",
+                                                                            "reglas_punteo.json")
+_COL_CONCEPT_BNK = "Concepto"
+_COL_FINCA = "finca"
+# Column with the text of the targets of the rules
+_COLS_TEXT = {DataType.EXP: "CONCEPTO", DataType.INC: "Inquilino"}
+
+logger = logging.getLogger(__name__)
+
+
+def concept_pattern(text) -> str:
+    """Returns the pattern of a bank concept: its normalized words, without those having numbers (dates,
+    references...)"""
+    return " ".join(word for word in normalize_text(text).split() if not any(char.isdigit() for char in word))
+
+
+def target_pattern(text) -> str:
+    """Returns the pattern of the text of a target of a rule (see concept_pattern), or its normalized text if all
+    its words have numbers"""
+    return concept_pattern(text) or normalize_text(text)
+
+
+class MatchingRules:
+    """
+    Rules mapping the pattern of a bank concept to the expenses and incomes it was matched with. They are stored in a
+    json file (DEFAULT_RULES_FILE, in ~/.ong_gesfincas, unless another one is given) as
+    {"version": 1, "rules": {pattern: [[data type, pattern of text, finca, times matched], ...]}}
+    """
+
+    def __init__(self, filename: str = None):
+        """
+        Creates an empty set of rules, or reads them from filename if it exists. If the file cannot be read (e.g. it
+        is not valid json or has another format), a warning is logged and rules are left empty
+        Args:
+            filename: a json file with rules (see save). It is also the default file for save
+        """
+        self.filename = filename
+        # pattern of bank concept -> Counter of times matched with each target: a tuple (data type value, pattern of
+        # text (see target_pattern), finca)
+        self.rules = dict()
+        if filename and os.path.isfile(filename):
+            try:
+                self.load(filename)
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                # json.JSONDecodeError is a ValueError, and the rest are raised by files with wrong format
+                logger.warning("Ignoring rules file %s, as it could not be read: %r", filename, e)
+                self.clear()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def learn(self, conciliation: Conciliation) -> int:
+        """
+        Learns rules from the buckets of a conciliation that have a single bank row and a single expense or income
+        Args:
+            conciliation: a Conciliation with all data
+
+        Returns:
+            the number of pairs of rows learnt
+        """
+        col_bucket = conciliation.col_bucket
+        bank = conciliation.df_bank[[_COL_CONCEPT_BNK, col_bucket]].dropna(subset=[col_bucket])
+        bank = bank[~bank[col_bucket].duplicated(keep=False)]
+        learnt = 0
+        for data_type, col_text in _COLS_TEXT.items():
+            other = conciliation.dfs[data_type][[col_text, _COL_FINCA, col_bucket]].dropna(subset=[col_bucket])
+            other = other[~other[col_bucket].duplicated(keep=False)]
+            pairs = bank.astype({col_bucket: "Int64"}).merge(other.astype({col_bucket: "Int64"}), on=col_bucket)
+            for concept, text, finca in zip(pairs[_COL_CONCEPT_BNK], pairs[col_text], pairs[_COL_FINCA]):
+                pattern = concept_pattern(concept)
+                if pattern:
+                    self.rules.setdefault(pattern, Counter())[(data_type.value, target_pattern(text), str(finca))] += 1
+                    learnt += 1
+        return learnt
+
+    def learn_file(self, filename: str) -> int:
+        """Learns rules from an Excel file saved with Conciliation.save_as. Returns the number of pairs learnt"""
+        return self.learn(Conciliation(filename))
+
+    def clear(self):
+        self.rules.clear()
+
+    def save(self, filename: str = None):
+        """Saves rules to a json file (defaults to the file they were read from), creating its folder if needed"""
+        filename = filename or self.filename
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        rules = {pattern: [list(target) + [count] for target, count in counter.items()]
+                 for pattern, counter in self.rules.items()}
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(dict(version=1, rules=rules), f, ensure_ascii=False, separators=(",", ":"))
+
+    def load(self, filename: str):
+        """Reads rules from a json file (see save), adding them to the current ones"""
+        with open(filename, encoding="utf-8") as f:
+            data = json.load(f)
+        for pattern, targets in data["rules"].items():
+            counter = self.rules.setdefault(pattern, Counter())
+            for data_type, text, finca, count in targets:
+                counter[(data_type, text, finca)] += count
+
+    def apply(self, conciliation: Conciliation) -> int:
+        """
+        Buckets the unassigned bank rows whose concept matches a rule with an unassigned row of one of the targets of
+        the rule with the same amount. If there are many, the one with the closest date within the
+        date_window_days of the conciliation is used (nothing is done if dates are not available)
+        Args:
+            conciliation: a Conciliation with all data. It is updated with the new buckets
+
+        Returns:
+            the number of new buckets
+        """
+        if not self.rules:
+            return 0
+        col_bucket, col_cents = conciliation.col_bucket, conciliation.col_cents
+        window = conciliation.date_window_days
+        # Unassigned rows of every target of the rules, by target and amount
+        targets = {target for counter in self.rules.values() for target in counter}
+        candidates = dict()
+        days = dict()
+        for data_type, col_text in _COLS_TEXT.items():
+            df = conciliation.dfs[data_type]
+            days[data_type.value] = (to_days(df[conciliation.col_date]) if conciliation.col_date in df.columns
+                                     else np.full(df.shape[0], np.nan))
+            texts, fincas, cents = df[col_text].values, df[_COL_FINCA].values, df[col_cents].values
+            for position in np.flatnonzero(df[col_bucket].isna().values):
+                target = (data_type.value, target_pattern(texts[position]), str(fincas[position]))
+                if target in targets:
+                    candidates.setdefault(target + (int(cents[position]),), []).append(position)
+
+        bank = conciliation.df_bank
+        bank_days = (to_days(bank[conciliation.col_date]) if conciliation.col_date in bank.columns
+                     else np.full(bank.shape[0], np.nan))
+        bank_concepts, bank_cents = bank[_COL_CONCEPT_BNK].values, bank[col_cents].values
+        buckets = []
+        for position_bnk in np.flatnonzero(bank[col_bucket].isna().values):
+            counter = self.rules.get(concept_pattern(bank_concepts[position_bnk]))
+            if not counter:
+                continue
+            cents = int(bank_cents[position_bnk])
+            found = [(target + (cents,), position) for target in counter
+                     for position in candidates.get(target + (cents,), ())]
+            if len(found) > 1:
+                if window is None or np.isnan(bank_days[position_bnk]):
+                    continue
+                distance = np.array([abs(days[key[0]][position] - bank_days[position_bnk]) for key, position in found])
+                best = np.flatnonzero(distance == np.nanmin(distance)) if not np.isnan(distance).all() else []
+                if len(best) != 1 or distance[best[0]] > window:
+                    continue
+                found = [found[best[0]]]
+            if len(found) == 1:
+                key, position = found[0]
+                candidates[key].remove(position)
+                data_type = key[0]
+                idx = [conciliation.dfs[DataType(data_type)].index[position]]
+                buckets.append((bank.index[position_bnk], idx if data_type == DataType.EXP.value else None,
+                                idx if data_type == DataType.INC.value else None))
+        conciliation.bucket_many(buckets)
+        return len(buckets)
@@ -0,0 +1,186 @@
+"""
+Background tasks for the GUI. Long operations (parsing big Excel files, automatic conciliation...) run in worker
+threads or processes while the tk main loop goes on. Tk widgets must only be used from the main thread, so workers
+never touch them: they report progress to a queue, and progress and results are collected from the main thread by
+polling with after()
+"""
+import queue
+import threading
+from concurrent.futures import CancelledError, Future
+from tkinter import Toplevel, Label, Button, X, HORIZONTAL
+from tkinter import ttk
+
+
+class TaskCancelled(Exception):
+    """Raised by BackgroundTask.check_cancelled in a worker, to stop it when the task has been cancelled or stopped"""
+    pass
+
+
+class BackgroundTask:
+    """
+    Waits for futures (of worker threads started with run_thread or of a process pool, added with add) and then
+    calls back in the main thread. Workers can report progress with report, and check if they should stop with
+    stopped or check_cancelled.
+    A task can be cancelled (results are discarded) or stopped (workers are asked to finish early, but what they
+    return is kept)
+    """
+
+    def __init__(self, widget, on_done=None, on_error=None, on_progress=None, poll_ms: int = 100):
+        """
+        Creates task. Call start after adding its futures
+        Args:
+            widget: any tk widget, used to call after
+            on_done: function called in the main thread with the list of the results of the futures, in the order
+            they were added, when all of them are done. It is not called if the task is cancelled
+            on_error: function called in the main thread with the exception raised by any future. If None, the
+            exception is raised in the main thread
+            on_progress: function called in the main thread with the arguments of each call to report
+            poll_ms: milliseconds between checks of the futures
+        """
+        self.widget = widget
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.poll_ms = poll_ms
+        self.futures = []
+        self.cancelled = False
+        self._stop = threading.Event()
+        self._progress = queue.Queue()
+        self._job = None
+
+    def run_thread(self, function, *args, **kwargs) -> Future:
+        """Runs function(*args, **kwargs) in a new daemon thread and returns a Future with its result"""
+        future = Future()
+
+        def worker():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=worker, daemon=True).start()
+        return self.add(future)
+
+    def add(self, future: Future) -> Future:
+        """Adds a future (e.g. returned by the submit of a ProcessPoolExecutor) to the ones the task waits for"""
+        self.futures.append(future)
+        return future
+
+    def start(self):
+        """Starts polling the futures. Returns the task"""
+        self._job = self.widget.after(self.poll_ms, self._poll)
+        return self
+
+    @property
+    def running(self) -> bool:
+        return self._job is not None
+
+    def report(self, *args):
+        """Reports progress from a worker: on_progress is called with args in the main thread"""
+        self._progress.put(args)
+
+    @property
+    def stopped(self) -> bool:
+        """True if workers should finish as soon as possible (task has been stopped or cancelled)"""
+        return self._stop.is_set()
+
+    def check_cancelled(self):
+        """Raises TaskCancelled if workers should finish (see stopped)"""
+        if self.stopped:
+            raise TaskCancelled()
+
+    def stop(self):
+        """Asks workers to finish early. Futures not started yet are cancelled, and on_done is called with what
+        the others return (None for the cancelled ones)"""
+        self._stop.set()
+        for future in self.futures:
+            future.cancel()
+
+    def cancel(self):
+        """Cancels task: same as stop, but on_done is not called. Workers that do not check stopped go on, but
+        their results are discarded"""
+        self.cancelled = True
+        self.stop()
+        if self._job is not None:
+            self.widget.after_cancel(self._job)
+            self._job = None
+
+    def _poll(self):
+        self._job = None
+        while not self._progress.empty():
+            args = self._progress.get_nowait()
+            if self.on_progress is not None and not self.cancelled:
+                self.on_progress(*args)
+        if self.cancelled:
+            return
+        if not all(future.done() for future in self.futures):
+            self._job = self.widget.after(self.poll_ms, self._poll)
+            return
+        results = []
+        for future in self.futures:
+            try:
+                results.append(future.result())
+            except (CancelledError, TaskCancelled):
+                results.append(None)
+            except Exception as e:
+                if self.on_error is None:
+                    raise
+                self.on_error(e)
+                return
+        if self.on_done is not None:
+            self.on_done(results)
+
+
+class ProgressDialog(Toplevel):
+    """Small window with a message, a progress bar and a button to cancel (or stop) the task in progress"""
+
+    def __init__(self, parent, title: str, message: str = "", on_cancel=None, cancel_text: str = "Cancelar",
+                 maximum: float = None):
+        """
+        Creates and shows dialog
+        Args:
+            parent: parent window
+            title: title of the window
+            message: initial message
+            on_cancel: function called when the button is clicked or the window is closed
+            cancel_text: text of the button
+            maximum: maximum value of the progress bar. If None, an indeterminate progress bar is shown
+        """
+        super().__init__(parent)
+        self.title(title)
+        self.transient(parent)
+        self.resizable(False, False)
+        self.on_cancel = on_cancel
+        self.lbl_message = Label(self, text=message, width=60, anchor="w")
+        self.lbl_message.pack(fill=X, padx=10, pady=(10, 5))
+        self.progress = ttk.Progressbar(self, orient=HORIZONTAL, length=400,
+                                        mode="indeterminate" if maximum is None else "determinate")
+        self.progress.pack(fill=X, padx=10, pady=5)
+        if maximum is None:
+            self.progress.start(20)
+        else:
+            self.progress.config(maximum=maximum)
+        self.btn_cancel = Button(self, text=cancel_text, command=self.handle_cancel)
+        self.btn_cancel.pack(pady=(5, 10))
+        self.protocol("WM_DELETE_WINDOW", self.handle_cancel)
+
+    def handle_cancel(self):
+        self.btn_cancel.config(state="disabled")
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    def update_progress(self, message: str = None, value: float = None, maximum: float = None):
+        """Changes the message and/or the value (and maximum) of the progress bar"""
+        if message is not None:
+            self.lbl_message.config(text=message)
+        if maximum is not None:
+            self.progress.stop()
+            self.progress.config(mode="determinate", maximum=maximum)
+        if value is not None:
+            self.progress.config(value=value)
+
+    def close(self):
+        self.progress.stop()
+        self.destroy()
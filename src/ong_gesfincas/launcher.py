@@ -0,0 +1,31 @@
+"""
+Light entry points of the graphical applications. Importing pandas, numpy and pandastable takes seconds on slow
+computers, so this module just imports tkinter: the window is shown at once, with a message, and the application
+(that loads the heavy modules) is imported and created afterwards in the same window
+"""
+from tkinter import Tk, Label
+
+
+def _loading_window(title: str) -> tuple:
+    """Creates and shows the main window with a loading message. Returns the window and the label of the message"""
+    root = Tk()
+    root.title(title)
+    label = Label(root, text="Cargando...", padx=60, pady=30)
+    label.pack()
+    root.update()
+    return root, label
+
+
+def punteo(initial_filename=None):
+    """Entry point of the punteo command"""
+    root, label = _loading_window("Punteo de banco y datos de gesfincas")
+    from ong_gesfincas.conciliation_gui import ConciliationApp
+
+    label.destroy()
+    # The app uses the window already shown (the default root of tkinter)
+    app = ConciliationApp(initial_filename)
+    app.mainloop()
+
+
+if __name__ == '__main__':
+    punteo()
@@ -1,7 +1,25 @@
+import hashlib
+import json
 import os
 
 import pandas as pd
 
+# Rows at the top of each sheet of a gesfincas file that are not read
+_SKIP_ROWS = 7
+# Provenance columns (see add_provenance): id of the file (see file_id), number of the sheet (1 for the first one) and
+# number of the row (as shown in Excel) of each row, as small integers
+COL_FILE = "fichero"
+COL_SHEET = "hoja"
+COL_ROW = "fila"
+PROVENANCE_DTYPES = {COL_FILE: pd.UInt32Dtype(), COL_SHEET: pd.Int16Dtype(), COL_ROW: pd.Int32Dtype()}
+# Bundles (see write_bundle) are parquet files. The kind of data of each row is in _COL_DATA, and the columns of each
+# kind and the source file are in the metadata of the file, under _BUNDLE_KEY
+BUNDLE_EXTENSION = ".parquet"
+_BUNDLE_KEY = b"ong_gesfincas"
+_COL_DATA = "datos"
+_DATA_EXPENSES = "gastos"
+_DATA_INCOMES = "ingresos"
+
 
 def process_df(df, start_idx, end_idx, finca):
     df_res = df.iloc[slice(start_idx, end_idx), :].dropna(axis=1, how="all").dropna(axis=0, how="all")
@@ -14,21 +32,56 @@ def process_df(df, start_idx, end_idx, finca):
     return res, tipo
 
 
-def read_gesfincas(gesfincas_file: str) -> tuple:
+def file_hash(filename: str) -> str:
+    """Returns the sha256 of the contents of a file, as a hex string"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_id(filename: str) -> int:
+    """Returns a 32 bit id of the contents of a file (the first bytes of its sha256), the same for copies of the file"""
+    return int(file_hash(filename)[:8], 16)
+
+
+def add_provenance(df: pd.DataFrame, id_file: int, sheet: int, first_row: int) -> pd.DataFrame:
+    """
+    Adds the provenance columns (COL_FILE, COL_SHEET and COL_ROW) to a df read from an Excel sheet
+    Args:
+        df: the df, whose index must still be the position of each row in the df read from the sheet
+        id_file: id of the Excel file (see file_id)
+        sheet: number of the sheet (1 for the first one)
+        first_row: Excel row number of the first row of the df read from the sheet
+
+    Returns:
+        a copy of df with the provenance columns
+    """
+    return df.assign(**{COL_FILE: id_file, COL_SHEET: sheet, COL_ROW: df.index + first_row}).astype(PROVENANCE_DTYPES)
+
+
+def read_gesfincas(gesfincas_file: str, provenance: bool = False) -> tuple:
     """
     Process a gesfincas file and returns a tuple with two dataframes: one for expenses and other for incomes
     Args:
-        gesfincas_file: full name of the gesfincas file
+        gesfincas_file: full name of the gesfincas file. It can also be a bundle written by write_bundle, that is
+        read without parsing the Excel file again
+        provenance: True to add the provenance columns (see add_provenance), with the file, sheet and row of each
+        row in the gesfincas file
 
     Returns:
         a tuple with df_expenses, df_incomes
     """
+    if is_bundle(gesfincas_file):
+        return read_bundle(gesfincas_file, provenance)
     incomes = []
     expenses = []
+    id_file = file_id(gesfincas_file) if provenance else None
     xls = pd.ExcelFile(gesfincas_file)
-    for sheet_name in xls.sheet_names[:-1]:     # Last one is just a summary
+    for sheet, sheet_name in enumerate(xls.sheet_names[:-1], 1):     # Last one is just a summary
         # print(sheet_name)
-        df = pd.read_excel(xls, sheet_name=sheet_name, skiprows=7, header=None)
+        df = pd.read_excel(xls, sheet_name=sheet_name, skiprows=_SKIP_ROWS, header=None)
         finca = df.iat[0, 0]
         try:
             empty_row = df[df.isna().all(axis=1)].index[0]
@@ -41,6 +94,9 @@ def read_gesfincas(gesfincas_file: str) -> tuple:
 
         df1, tipo1 = process_df(df, 1, empty_row, finca)
         df2, tipo2 = process_df(df, empty_row + 1, None, finca)
+        if provenance:
+            df1, df2 = (None if df_tipo is None else add_provenance(df_tipo, id_file, sheet, _SKIP_ROWS + 1)
+                        for df_tipo in (df1, df2))
         for df, tipo in (df1, tipo1), (df2, tipo2):
             if tipo:
                 if tipo == "DETALLE DE INGRESOS (COBRO)":
@@ -63,14 +119,94 @@ def read_gesfincas(gesfincas_file: str) -> tuple:
     return df_expenses, df_incomes
 
 
-def main(in_file: str, out_file:str):
+def is_bundle(filename: str) -> bool:
+    """True if filename is a bundle written by write_bundle (judging by its extension)"""
+    return str(filename).lower().endswith(BUNDLE_EXTENSION)
+
+
+def _parquet_compatible(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns a copy of df that parquet can store: object columns mixing types (e.g. numbers and texts, as in
+    columns of cells typed by hand) are converted to texts, and column names to str"""
+    df = df.infer_objects()
+    for column in df.columns:
+        if df[column].dtype == object and df[column].dropna().map(type).nunique() > 1:
+            df[column] = df[column].map(lambda value: value if pd.isna(value) else str(value))
+    df.columns = [str(column) for column in df.columns]
+    return df
+
+
+def write_bundle(df_expenses: pd.DataFrame, df_incomes: pd.DataFrame, filename: str, source_file: str = None):
+    """
+    Writes expenses and incomes (as returned by read_gesfincas) to a single parquet file (needs pyarrow), that
+    read_gesfincas reads much faster than the original Excel file. Rows of both are stored in the same table, and the
+    columns of each one and the name and sha256 of the source file are kept in the metadata of the file
+    Args:
+        df_expenses: expenses
+        df_incomes: incomes
+        filename: name of the output file. Its extension should be BUNDLE_EXTENSION
+        source_file: optional name of the gesfincas file the data were read from
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dfs = {_DATA_EXPENSES: df_expenses, _DATA_INCOMES: df_incomes}
+    metadata = dict(version=1, columns={data: [str(column) for column in df.columns] for data, df in dfs.items()})
+    if source_file:
+        metadata.update(source=os.path.basename(source_file), sha256=file_hash(source_file))
+    df = pd.concat([df.assign(**{_COL_DATA: data}) for data, df in dfs.items()], ignore_index=True)
+    table = pa.Table.from_pandas(_parquet_compatible(df), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or dict()),
+                                           _BUNDLE_KEY: json.dumps(metadata, ensure_ascii=False).encode()})
+    pq.write_table(table, filename)
+
+
+def read_bundle_metadata(filename: str) -> dict:
+    """Returns the metadata of a bundle written by write_bundle: columns of each kind of data and, if available,
+    source (name of the gesfincas file) and sha256 (of the gesfincas file)"""
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(filename).metadata or dict()
+    if _BUNDLE_KEY not in metadata:
+        raise ValueError(f"{filename} is not a bundle of gesfincas data")
+    return json.loads(metadata[_BUNDLE_KEY])
+
+
+def read_bundle(filename: str, provenance: bool = False) -> tuple:
+    """
+    Reads a bundle written by write_bundle
+    Args:
+        filename: name of the bundle
+        provenance: True to keep the provenance columns (see add_provenance), if the bundle has them. They refer to
+        the original gesfincas file
+
+    Returns:
+        a tuple with df_expenses, df_incomes (as read_gesfincas)
+    """
+    metadata = read_bundle_metadata(filename)
+    df = pd.read_parquet(filename)
+    retval = []
+    for data in _DATA_EXPENSES, _DATA_INCOMES:
+        columns = [column for column in metadata["columns"][data]
+                   if provenance or column not in PROVENANCE_DTYPES]
+        df_data = df.loc[df[_COL_DATA] == data, columns].reset_index(drop=True)
+        retval.append(df_data.astype({column: dtype for column, dtype in PROVENANCE_DTYPES.items()
+                                      if column in df_data.columns}))
+    return tuple(retval)
+
+
+def main(in_file: str, out_file:str, bundle_file: str = None):
     """
     Processes a gesfincas settlement file to merge into a single file
     :param in_file: name (or full path) of the file (xlsx)
     :param out_file: name (or full path) of the output file (xlsx)
+    :param bundle_file: optional name (or full path) of a bundle (parquet) file, with the same data plus the file,
+    sheet and row of each one in in_file (see write_bundle). It can be loaded instead of in_file to conciliate
     :return:
     """
-    df_gastos, df_ingresos = read_gesfincas(in_file)
+    df_gastos, df_ingresos = read_gesfincas(in_file, provenance=bundle_file is not None)
+    if bundle_file is not None:
+        write_bundle(df_gastos, df_ingresos, bundle_file, in_file)
+        df_gastos, df_ingresos = (df.drop(columns=list(PROVENANCE_DTYPES)) for df in (df_gastos, df_ingresos))
     out_xls = pd.ExcelWriter(out_file)
     df_gastos.to_excel(out_xls, sheet_name="gastos", index=False)
     df_ingresos.to_excel(out_xls, sheet_name="ingresos", index=False)
@@ -1,9 +1,8 @@
+from importlib.util import find_spec
 from tkinter import *
 from tkinter import filedialog
 from tkinter import messagebox as msg
 
-from ong_gesfincas.liquidaciones_cmd import main as main_liquidaciones
-
 
 class LiquidacionesApp:
 
@@ -62,9 +61,17 @@ class LiquidacionesApp:
         last_dot = self.file_name.rfind(".")
         out_filename = self.file_name[:last_dot] + "_" + "procesado" + self.file_name[last_dot:]
         try:
-            main_liquidaciones(self.file_name, out_filename)
+            # Imported here so the window is shown without waiting for pandas to load
+            from ong_gesfincas.liquidaciones_cmd import BUNDLE_EXTENSION, main as main_liquidaciones
+
+            # If pyarrow is installed, a bundle that the punteo loads much faster is written too
+            bundle_filename = (self.file_name[:last_dot] + "_" + "procesado" + BUNDLE_EXTENSION
+                               if find_spec("pyarrow") else None)
+            main_liquidaciones(self.file_name, out_filename, bundle_filename)
+            created = (f"los ficheros '{out_filename}' y '{bundle_filename}'" if bundle_filename
+                       else f"el fichero '{out_filename}'")
             msg.showinfo('Finalizado', f"Procesado el fichero '{self.file_name}' "
-                                       f"y creado el fichero '{out_filename}'")
+                                       f"y creado {created}")
         except Exception as e:
             msg.showerror("Error interno", f"Error {e} procesando el fcihero {self.file_name}")
 
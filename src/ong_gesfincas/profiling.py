@@ -0,0 +1,171 @@
+"""
+Optional instrumentation of the conciliation operations: for each operation, counts calls and measures time, rows
+processed and (optionally) peak memory. Disabled by default, so instrumented functions just check a flag.
+
+Use profiler.timed as a decorator or profiler.measure as a context manager, then profiler.report() or
+profiler.dump_json(filename) to get results. It can be enabled setting ONG_GESFINCAS_PROFILE environment
+variable (ONG_GESFINCAS_PROFILE=memory to measure memory too) or calling profiler.enable()
+"""
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Measure:
+    """Measure of a single execution of an operation. rows can be set within a profiler.measure block"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.start_memory = 0
+        self.peak_memory = 0
+
+
+class Profiler:
+
+    def __init__(self, enabled: bool = False, memory: bool = False):
+        self.enabled = enabled
+        self.memory = memory
+        self.records = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()  # Stack of measures, to track peak memory of nested operations
+
+    def enable(self, memory: bool = False):
+        """Enables measures. If memory is True, peak memory is measured too (it makes code much slower)"""
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.memory = False
+
+    def clear(self):
+        """Deletes all measures"""
+        with self._lock:
+            self.records.clear()
+
+    @property
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _start_memory(self, measure: Measure):
+        stack = self._stack
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:  # Keep the peak reached so far by the outer operation before resetting it
+            stack[-1].peak_memory = max(stack[-1].peak_memory, peak)
+        tracemalloc.reset_peak()
+        measure.start_memory = measure.peak_memory = current
+        stack.append(measure)
+
+    def _stop_memory(self, measure: Measure) -> int:
+        stack = self._stack
+        stack.pop()
+        peak = max(measure.peak_memory, tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1].peak_memory = max(stack[-1].peak_memory, peak)
+        return peak - measure.start_memory
+
+    def _record(self, name: str, seconds: float, rows: int, peak_memory: int = None):
+        with self._lock:
+            record = self.records.setdefault(name, dict(calls=0, seconds=0.0, max_seconds=0.0, last_seconds=0.0,
+                                                        rows=0, peak_memory=None))
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["max_seconds"] = max(record["max_seconds"], seconds)
+            record["last_seconds"] = seconds
+            record["rows"] += rows or 0
+            if peak_memory is not None:
+                record["peak_memory"] = max(record["peak_memory"] or 0, peak_memory)
+
+    @contextmanager
+    def measure(self, name: str):
+        """
+        Context manager that measures the code inside the block. Does nothing if profiler is disabled
+        Args:
+            name: name of the operation
+
+        Returns:
+            yields a Measure, whose rows attribute can be set to inform the number of rows processed
+        """
+        if not self.enabled:
+            yield Measure(name)
+            return
+        measure = Measure(name)
+        memory = self.memory and tracemalloc.is_tracing()
+        if memory:
+            self._start_memory(measure)
+        start = time.perf_counter()
+        try:
+            yield measure
+        finally:
+            seconds = time.perf_counter() - start
+            self._record(name, seconds, measure.rows, self._stop_memory(measure) if memory else None)
+
+    def timed(self, name: str = None, rows=None):
+        """
+        Decorator that measures each call of the decorated function
+        Args:
+            name: name of the operation. Defaults to the qualified name of the function
+            rows: an optional function that receives the result and the arguments of the decorated function and
+            returns the number of rows processed
+
+        Returns:
+            the decorator
+        """
+
+        def decorator(f):
+            operation = name or f.__qualname__
+
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with self.measure(operation) as measure:
+                    result = f(*args, **kwargs)
+                    if rows is not None:
+                        measure.rows = rows(result, *args, **kwargs)
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def report(self) -> dict:
+        """Returns a dict indexed by operation name with calls, times (in seconds), rows and peak memory (bytes)"""
+        with self._lock:
+            report = {name: dict(record) for name, record in self.records.items()}
+        for record in report.values():
+            record["mean_seconds"] = record["seconds"] / record["calls"]
+            record["rows_per_second"] = record["rows"] / record["seconds"] if record["seconds"] else None
+        return report
+
+    def report_text(self) -> str:
+        """Returns the report as a text table"""
+        lines = [f"{'Operación':<45}{'Llamadas':>9}{'Total s':>10}{'Media s':>10}{'Máx s':>10}{'Filas':>11}"
+                 f"{'Filas/s':>12}{'Mem. MB':>9}"]
+        for name, record in self.report().items():
+            memory = f"{record['peak_memory'] / 2 ** 20:.1f}" if record["peak_memory"] is not None else "-"
+            rows_per_second = f"{record['rows_per_second']:,.0f}" if record["rows_per_second"] is not None else "-"
+            lines.append(f"{name:<45}{record['calls']:>9}{record['seconds']:>10.3f}{record['mean_seconds']:>10.3f}"
+                         f"{record['max_seconds']:>10.3f}{record['rows']:>11,}{rows_per_second:>12}{memory:>9}")
+        return "\n".join(lines)
+
+    def dump_json(self, filename: str):
+        """Writes report to a json file"""
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+profiler = Profiler()
+if os.environ.get("ONG_GESFINCAS_PROFILE"):
+    profiler.enable(memory=os.environ["ONG_GESFINCAS_PROFILE"].lower() == "memory")
@@ -0,0 +1,159 @@
+"""
+Benchmarks of the conciliation hot paths using synthetic data (see tests/generate_synthetic_data.py).
+Needs pytest-benchmark (pip install "ong_gesfincas[benchmark]"), otherwise they are skipped.
+
+The number of rows of the synthetic data defaults to 1000 and can be changed with BENCHMARK_ROWS environment variable.
+Results can be saved (in .benchmarks folder) to compare them with previous versions, e.g.:
+    BENCHMARK_ROWS=1000,10000,100000,1000000 pytest tests/benchmarks --benchmark-autosave
+    BENCHMARK_ROWS=1000,10000,100000,1000000 pytest tests/benchmarks --benchmark-compare
+As automatic matching is slow for big files, matching steps are skipped for files with more rows than
+BENCHMARK_MAX_MATCH_ROWS environment variable (defaults to 10000)
+"""
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_model import Conciliation
+from ong_gesfincas.conciliation_partition import automatic_bucket_by_finca
+from tests.generate_synthetic_data import generate_dfs, write_conciliation_excel, write_bank_excel, \
+    write_gesfincas_excel
+
+pytest.importorskip("pytest_benchmark")
+
+SIZES = [int(rows) for rows in os.environ.get("BENCHMARK_ROWS", "1000").split(",")]
+MAX_MATCH_ROWS = int(os.environ.get("BENCHMARK_MAX_MATCH_ROWS", 10000))
+ROUNDS = 3
+
+
+def copy_dfs(dfs: dict) -> dict:
+    return {key: df.copy() for key, df in dfs.items()}
+
+
+def new_conciliation(dfs: dict, read_buckets: bool = False) -> Conciliation:
+    """Returns a new Conciliation with a copy of the given data"""
+    conciliation = Conciliation()
+    conciliation.set_dfs(copy_dfs(dfs), read_buckets=read_buckets)
+    return conciliation
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda rows: f"{rows}rows")
+def synthetic(request, tmp_path_factory):
+    """Synthetic data and files for the benchmarks"""
+    rows = request.param
+    path = tmp_path_factory.mktemp(f"synthetic_{rows}")
+    dfs = generate_dfs(rows)
+    data = SimpleNamespace(rows=rows, dfs=dfs, path=path, complete=str(path / "completo.xlsx"),
+                           bank=str(path / "banco.xlsx"), gesfincas=str(path / "gesfincas.xlsx"))
+    write_conciliation_excel(dfs, data.complete)
+    write_bank_excel(dfs[DataType.BNK], data.bank)
+    write_gesfincas_excel(dfs[DataType.EXP], dfs[DataType.INC], data.gesfincas)
+    return data
+
+
+@pytest.fixture(scope="module")
+def bucketed(synthetic) -> dict:
+    """Data of the synthetic fixture already bucketed (if they are not too big for automatic matching)"""
+    conciliation = new_conciliation(synthetic.dfs)
+    if synthetic.rows <= MAX_MATCH_ROWS:
+        conciliation.automatic_bucket_expenses()
+    return conciliation.backup_dfs()
+
+
+def skip_big(synthetic):
+    if synthetic.rows > MAX_MATCH_ROWS:
+        pytest.skip(f"Matching is too slow for {synthetic.rows} rows")
+
+
+@pytest.mark.benchmark(group="read")
+def test_read_dfs(benchmark, synthetic):
+    benchmark.pedantic(Conciliation().read_dfs, args=(synthetic.complete,), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="read")
+def test_read_bank(benchmark, synthetic):
+    benchmark.pedantic(Conciliation().read_bank, args=(synthetic.bank,), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="read")
+def test_read_gesfincas(benchmark, synthetic):
+    benchmark.pedantic(Conciliation().read_gesfincas, args=(synthetic.gesfincas,), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="model")
+def test_set_dfs(benchmark, synthetic):
+    benchmark.pedantic(lambda dfs: Conciliation().set_dfs(dfs, read_buckets=False),
+                       setup=lambda: ((copy_dfs(synthetic.dfs),), {}), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="matching")
+def test_bucket_exact_match(benchmark, synthetic):
+    skip_big(synthetic)
+    benchmark.pedantic(Conciliation.bucket_exact_match,
+                       setup=lambda: ((new_conciliation(synthetic.dfs),), {}), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="matching")
+def test_bucket_approximate_match(benchmark, synthetic):
+    skip_big(synthetic)
+
+    def setup():
+        conciliation = new_conciliation(synthetic.dfs)
+        conciliation.bucket_exact_match()
+        return (conciliation,), {}
+
+    benchmark.pedantic(Conciliation.bucket_approximate_match, setup=setup, rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="matching")
+def test_bucket_consecutive_expenses(benchmark, synthetic):
+    skip_big(synthetic)
+
+    def setup():
+        conciliation = new_conciliation(synthetic.dfs)
+        conciliation.bucket_exact_match()
+        conciliation.bucket_approximate_match()
+        return (conciliation,), {}
+
+    benchmark.pedantic(Conciliation.bucket_consecutive_expenses, setup=setup, rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="matching")
+def test_automatic_bucket_expenses(benchmark, synthetic):
+    skip_big(synthetic)
+    benchmark.pedantic(Conciliation.automatic_bucket_expenses,
+                       setup=lambda: ((new_conciliation(synthetic.dfs),), {}), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="matching")
+def test_automatic_bucket_by_finca(benchmark, synthetic):
+    skip_big(synthetic)
+    benchmark.pedantic(automatic_bucket_by_finca,
+                       setup=lambda: ((new_conciliation(synthetic.dfs),), {}), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="suggest")
+def test_suggest(benchmark, synthetic):
+    conciliation = new_conciliation(synthetic.dfs)
+    conciliation.suggest(DataType.BNK, [0])  # Build indexes
+    benchmark.pedantic(conciliation.suggest, args=(DataType.BNK, [1, 2]), rounds=ROUNDS * 10)
+
+
+@pytest.mark.benchmark(group="model")
+def test_update_dfs(benchmark, synthetic, bucketed):
+    benchmark.pedantic(Conciliation.update_dfs,
+                       setup=lambda: ((new_conciliation(bucketed, read_buckets=True), copy_dfs(synthetic.dfs)), {}),
+                       rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="model")
+def test_check_buckets(benchmark, bucketed):
+    conciliation = new_conciliation(bucketed, read_buckets=True)
+    benchmark.pedantic(conciliation.check_buckets, rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="write")
+def test_save_as(benchmark, synthetic, bucketed):
+    conciliation = new_conciliation(bucketed, read_buckets=True)
+    benchmark.pedantic(conciliation.save_as, args=(str(synthetic.path / "punteado.xlsx"),), rounds=ROUNDS)
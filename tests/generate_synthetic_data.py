@@ -0,0 +1,165 @@
+"""
+Generates synthetic (random but reproducible) bank, expenses and incomes data, e.g. for benchmarks. Data try to look
+like real data:
+    - Incomes are rents from tenants of several fincas, so the same amounts are repeated many times
+    - Expenses are payments to recurring payees (with the same amounts every month) plus random payments
+    - Bank rows come from incomes and expenses with noise in the texts, some with a difference of 1 cent, some
+    expenses paid together in a single bank row and some rows with no counterpart. Their dates are a few days later
+Data can be written to Excel files with the formats of the bank extract, the gesfincas file and the complete file
+"""
+import numpy as np
+import pandas as pd
+
+from ong_gesfincas import DataType
+
+STREETS = ["CALLE MAYOR", "AVDA DE LA PAZ", "CALLE ALCALA", "PASEO DEL PRADO", "CALLE SERRANO", "CALLE TOLEDO",
+           "PLAZA ESPAÑA", "CALLE ARGUMOSA", "CALLE GOYA", "CALLE VELAZQUEZ"]
+PAYEES = ["IBERDROLA CLIENTES", "CANAL DE ISABEL II", "LIMPIEZAS EL SOL", "MAPFRE SEGUROS", "ASCENSORES OTIS",
+          "MANTENIMIENTOS GARCIA", "JARDINERIA VERDE", "ADMINISTRACION FINCAS", "TELEFONICA", "GAS NATURAL"]
+NAMES = ["GARCIA", "MARTINEZ", "LOPEZ", "SANCHEZ", "PEREZ", "GOMEZ", "MARTIN", "JIMENEZ", "RUIZ", "HERNANDEZ",
+         "DIAZ", "MORENO", "ALVAREZ", "MUÑOZ", "ROMERO"]
+
+
+def finca_names(n_fincas: int) -> np.ndarray:
+    """Returns n_fincas different names of fincas"""
+    return np.array([f"{STREETS[i % len(STREETS)]} {i // len(STREETS) + 1}" for i in range(n_fincas)])
+
+
+def add_text_noise(texts: np.ndarray, rng: np.random.Generator, ratio: float = 0.3) -> np.ndarray:
+    """Changes randomly a ratio of the texts: lowercase, extra spaces, abbreviations and swapped characters"""
+    texts = texts.astype(object)
+    noise = rng.integers(0, 4, len(texts))
+    noisy = rng.random(len(texts)) < ratio
+    for i in np.flatnonzero(noisy):
+        text = texts[i]
+        if noise[i] == 0:
+            text = text.lower()
+        elif noise[i] == 1:
+            text = text.replace(" ", "  ")
+        elif noise[i] == 2:
+            text = text.replace("CALLE", "C/").replace("AVDA DE LA", "AV")
+        elif len(text) > 3:
+            pos = rng.integers(0, len(text) - 2)
+            text = text[:pos] + text[pos + 1] + text[pos] + text[pos + 2:]
+        texts[i] = text
+    return texts
+
+
+def generate_dfs(n_rows: int, n_fincas: int = None, seed: int = 0) -> dict:
+    """
+    Generates synthetic data
+    Args:
+        n_rows: approximate number of rows of the bank. Incomes and expenses have a similar number of rows
+        n_fincas: number of fincas. Defaults to a finca every 200 rows
+        seed: seed for the random generator, so the same data are generated every time
+
+    Returns:
+        a dict of DataFrames indexed by DataType, as Conciliation.read_dfs
+    """
+    rng = np.random.default_rng(seed)
+    n_fincas = n_fincas or max(1, n_rows // 200)
+    fincas = finca_names(n_fincas)
+    n_incomes = n_rows // 2
+    n_expenses = n_rows - n_incomes
+
+    # Incomes: rents of the tenants, only a few different amounts for each finca
+    inc_finca = np.sort(rng.integers(0, n_fincas, n_incomes))
+    rents = rng.choice(np.arange(300, 1500, 25), size=(n_fincas, 4)) + rng.choice([0, 0.5, 0.25], size=(n_fincas, 4))
+    inc_amount = rents[inc_finca, rng.integers(0, 4, n_incomes)]
+    tenants = np.char.add(np.char.add(rng.choice(NAMES, n_incomes), " "), rng.choice(NAMES, n_incomes))
+    start = pd.Timestamp("2024-01-01")
+    inc_date = start + pd.to_timedelta(rng.integers(0, 365, n_incomes), unit="D")
+    df_incomes = pd.DataFrame({
+        "Piso/Local": np.char.add(rng.integers(1, 10, n_incomes).astype(str), rng.choice(list("ABCD"), n_incomes)),
+        "Inquilino": tenants,
+        "Fecha": inc_date,
+        "Cobrado": inc_amount,
+        "Pendiente": 0.0,
+        "finca": fincas[inc_finca],
+    })
+
+    # Expenses: recurring payees with fixed amounts per finca and random payments
+    exp_finca = np.sort(rng.integers(0, n_fincas, n_expenses))
+    payee = rng.integers(0, len(PAYEES), n_expenses)
+    recurring = rng.random(n_expenses) < 0.6
+    fixed_amounts = np.round(rng.uniform(20, 900, size=(n_fincas, len(PAYEES))), 2)
+    exp_amount = np.where(recurring, fixed_amounts[exp_finca, payee], np.round(rng.uniform(5, 3000, n_expenses), 2))
+    exp_date = start + pd.to_timedelta(rng.integers(0, 365, n_expenses), unit="D")
+    df_expenses = pd.DataFrame({
+        "Fecha": exp_date,
+        "CONCEPTO": np.char.add(np.char.add(np.array(PAYEES)[payee], " "), fincas[exp_finca]),
+        "Pagos": exp_amount,
+        "Abonos": 0.0,
+        "finca": fincas[exp_finca],
+    })
+
+    # Bank: most incomes and expenses, with noise
+    inc_in_bank = np.flatnonzero(rng.random(n_incomes) < 0.85)
+    exp_in_bank = np.flatnonzero(rng.random(n_expenses) < 0.85)
+    bnk_exp_amount = -exp_amount[exp_in_bank]
+    # Some expenses are paid together with the next one (of the same finca) in the same bank row
+    paired = np.flatnonzero((rng.random(len(exp_in_bank) - 1) < 0.03) &
+                            (np.diff(exp_in_bank) == 1) &
+                            (exp_finca[exp_in_bank[:-1]] == exp_finca[exp_in_bank[1:]]))
+    paired = paired[np.diff(paired, prepend=-2) > 1]  # A row can only be paired once
+    bnk_exp_amount[paired] -= exp_amount[exp_in_bank[paired + 1]]
+    keep = np.ones(len(exp_in_bank), dtype=bool)
+    keep[paired + 1] = False
+    exp_in_bank, bnk_exp_amount = exp_in_bank[keep], bnk_exp_amount[keep]
+    # Some expenses differ in one cent
+    bnk_exp_amount += np.where(rng.random(len(bnk_exp_amount)) < 0.02, rng.choice([-0.01, 0.01]), 0)
+    n_only_bank = max(1, n_rows // 20)
+    concepts = np.concatenate([
+        np.char.add("TRANSFERENCIA DE ", tenants[inc_in_bank].astype(str)),
+        np.char.add("RECIBO ", df_expenses["CONCEPTO"].values[exp_in_bank].astype(str)),
+        np.char.add("COMISION ", rng.choice(PAYEES, n_only_bank)),
+    ])
+    amounts = np.concatenate([inc_amount[inc_in_bank], bnk_exp_amount,
+                              -np.round(rng.uniform(1, 100, n_only_bank), 2)])
+    dates = np.concatenate([inc_date[inc_in_bank], exp_date[exp_in_bank],
+                            start + pd.to_timedelta(rng.integers(0, 365, n_only_bank), unit="D")])
+    dates = dates + pd.to_timedelta(rng.integers(0, 6, len(dates)), unit="D")
+    order = rng.permutation(len(amounts))
+    df_bank = pd.DataFrame({"Fecha": dates[order], "Concepto": add_text_noise(concepts[order], rng),
+                            "Importe": np.round(amounts[order], 2)})
+    return {DataType.BNK: df_bank, DataType.EXP: df_expenses, DataType.INC: df_incomes}
+
+
+def write_conciliation_excel(dfs: dict, filename: str):
+    """Writes data in the format of a complete Excel file (one sheet for bank, incomes and expenses)"""
+    with pd.ExcelWriter(filename) as writer:
+        for data_type in DataType:
+            dfs[data_type].to_excel(writer, sheet_name=data_type.value, index=False)
+
+
+def write_bank_excel(df_bank: pd.DataFrame, filename: str):
+    """Writes bank data as a bank extract"""
+    df_bank.to_excel(filename, index=False)
+
+
+def write_gesfincas_excel(df_expenses: pd.DataFrame, df_incomes: pd.DataFrame, filename: str):
+    """Writes expenses and incomes in the format of a gesfincas file: a sheet for each finca plus a summary sheet"""
+
+    def block(title: str, df: pd.DataFrame) -> list:
+        df = df.drop(columns="finca")
+        return [[title], list(df.columns)] + df.values.tolist() + [["TOTAL"]]
+
+    with pd.ExcelWriter(filename) as writer:
+        fincas = pd.unique(pd.concat([df_incomes["finca"], df_expenses["finca"]]))
+        for number, finca in enumerate(fincas):
+            rows = [[None]] * 7 + [[f"Finca: {finca}"]]
+            rows += block("DETALLE DE INGRESOS (COBRO)", df_incomes[df_incomes["finca"] == finca])
+            rows += [[None]]
+            rows += block("DETALLE DE GASTOS (PAGOS)", df_expenses[df_expenses["finca"] == finca])
+            pd.DataFrame(rows).to_excel(writer, sheet_name=f"finca {number}", header=False, index=False)
+        pd.DataFrame([["Resumen"]]).to_excel(writer, sheet_name="resumen", header=False, index=False)
+
+
+if __name__ == '__main__':
+    import sys
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    synthetic = generate_dfs(rows)
+    write_conciliation_excel(synthetic, f"synthetic_{rows}.xlsx")
+    write_bank_excel(synthetic[DataType.BNK], f"synthetic_{rows}_banco.xlsx")
+    write_gesfincas_excel(synthetic[DataType.EXP], synthetic[DataType.INC], f"synthetic_{rows}_gesfincas.xlsx")
@@ -0,0 +1,131 @@
+"""
+Tests for the command line (headless) conciliation
+"""
+import json
+import os
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from unittest import TestCase, main
+
+import pandas as pd
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_cmd import (conciliate, conciliate_all, _conciliate_or_error, main as main_batch,
+                                            main_diff, unique_output_names)
+from ong_gesfincas.conciliation_model import Conciliation
+from tests.generate_synthetic_data import generate_dfs, write_bank_excel, write_gesfincas_excel
+
+
+class TestConciliationCmd(TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.output_dir = os.path.join(self.directory, "salida")
+
+    def write_community(self, folder: str, seed: int = 0) -> tuple:
+        """Writes the bank and gesfincas files of a community in a folder, returns their names"""
+        os.makedirs(os.path.join(self.directory, folder), exist_ok=True)
+        dfs = generate_dfs(60, seed=seed)
+        bank_file = os.path.join(self.directory, folder, "banco.xlsx")
+        gesfincas_file = os.path.join(self.directory, folder, "gesfincas.xlsx")
+        write_bank_excel(dfs[DataType.BNK], bank_file)
+        write_gesfincas_excel(dfs[DataType.EXP], dfs[DataType.INC], gesfincas_file)
+        return bank_file, gesfincas_file
+
+    def test_unique_output_names(self):
+        """Repeated names get a number that is not the name of another file"""
+        names = unique_output_names(["a/banco.xlsx", "b/banco.xlsx", "banco_2.xlsx", "c/banco.xlsx",
+                                     ["d/otro.xlsx", "d/banco.xlsx"]])
+        self.assertEqual(names, ["banco", "banco_3", "banco_2", "banco_4", "otro"])
+
+    def test_conciliate(self):
+        """Output files are written and the summary counts rows, bucketed rows and totals"""
+        bank_file, gesfincas_file = self.write_community("comunidad")
+        os.makedirs(self.output_dir)
+        summary = conciliate(bank_file, gesfincas_file, self.output_dir, parquet=True)
+        self.assertNotIn("error", summary)
+        self.assertEqual(summary["name"], "banco")
+        self.assertEqual(sorted(os.path.basename(file) for file in summary["files"]),
+                         ["banco_banco.parquet", "banco_gastos.parquet", "banco_ingresos.parquet",
+                          "banco_punteado.xlsx"])
+        for file in summary["files"]:
+            self.assertTrue(os.path.isfile(file))
+        self.assertGreater(summary["bucketed_rows"][DataType.BNK.value], 0)
+        self.assertLessEqual(summary["bucketed_rows"][DataType.BNK.value], summary["rows"][DataType.BNK.value])
+        with open(os.path.join(self.output_dir, "banco_resumen.json")) as f:
+            self.assertEqual(json.load(f)["bucketed_rows"], summary["bucketed_rows"])
+
+    def test_conciliate_errors(self):
+        """Files without data or that can't be read give a summary with the error"""
+        bank_file, _ = self.write_community("comunidad")
+        os.makedirs(self.output_dir)
+        summary = conciliate(bank_file, bank_file, self.output_dir)
+        self.assertTrue(summary["error"].startswith("Missing data"))
+        missing = os.path.join(self.directory, "no_existe.xlsx")
+        summary = _conciliate_or_error(missing, missing, self.output_dir, name="otro")
+        self.assertEqual(summary["name"], "otro")
+        self.assertIn("error", summary)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_conciliate_all(self):
+        """Communities with bank files of the same name don't overwrite each other, errors are counted"""
+        communities = [self.write_community(folder, seed) for seed, folder in enumerate(["norte", "sur"])]
+        bank_files, gesfincas_files = map(list, zip(*communities))
+        bank_files.append(os.path.join(self.directory, "no_existe.xlsx"))
+        gesfincas_files.append(gesfincas_files[0])
+        with self.assertRaises(ValueError):
+            conciliate_all(bank_files, gesfincas_files[:1], self.output_dir, workers=1)
+        result = conciliate_all(bank_files, gesfincas_files, self.output_dir, workers=1)
+        self.assertEqual([summary["name"] for summary in result["results"]], ["banco", "banco_2", "no_existe"])
+        self.assertEqual((result["files"], result["errors"]), (3, 1))
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ["banco_2_punteado.xlsx", "banco_2_resumen.json", "banco_punteado.xlsx", "banco_resumen.json",
+                          "resumen.json"])
+        with open(os.path.join(self.output_dir, "banco_2_resumen.json")) as f:
+            self.assertEqual(json.load(f)["bank_file"], bank_files[1])
+
+    def test_main(self):
+        """Exit code is 0 if all communities are conciliated, 1 if any fails and 2 for wrong arguments"""
+        bank_file, gesfincas_file = self.write_community("comunidad")
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(main_batch(["-b", bank_file, "-g", gesfincas_file, "-o", self.output_dir, "-w", "1"]), 0)
+        self.assertIn("banco:", output.getvalue())
+        self.assertTrue(os.path.isfile(os.path.join(self.output_dir, "banco_punteado.xlsx")))
+        missing = os.path.join(self.directory, "no_existe.xlsx")
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(main_batch(["-b", bank_file, "-g", gesfincas_file, "-b", missing, "-g", gesfincas_file,
+                                         "-o", self.output_dir, "-w", "1"]), 1)
+        self.assertIn("no_existe: ERROR", output.getvalue())
+        with redirect_stderr(StringIO()), self.assertRaises(SystemExit) as exit_error:
+            main_batch(["-b", bank_file, "-b", bank_file, "-g", gesfincas_file])
+        self.assertEqual(exit_error.exception.code, 2)
+
+    def test_main_diff(self):
+        """Exit code is 1 if versions differ (and the differences are saved by data type), 0 if they are the same"""
+        conciliation = Conciliation()
+        conciliation.set_dfs(generate_dfs(60), read_buckets=False)
+        conciliation.automatic_bucket_expenses()
+        old_file, new_file = (os.path.join(self.directory, name) for name in ("anterior.xlsx", "nuevo.xlsx"))
+        output_file = os.path.join(self.directory, "diferencias.xlsx")
+        conciliation.save_as(old_file)
+        conciliation.save_as(new_file)
+        with redirect_stdout(StringIO()) as output:
+            self.assertEqual(main_diff([old_file, new_file, "-w", "1"]), 0)
+        self.assertIn("Sin cambios", output.getvalue())
+
+        bucket = conciliation.df_bank[conciliation.col_bucket].dropna().iloc[0]
+        conciliation.unbucket([bucket])
+        conciliation.save_as(new_file)
+        with redirect_stdout(StringIO()):
+            self.assertEqual(main_diff([old_file, new_file, "-o", output_file, "-w", "1"]), 1)
+        sheets = pd.ExcelFile(output_file).sheet_names
+        self.assertEqual(sheets[0], "totales")
+        self.assertIn(f"cambios_{DataType.BNK.value}", sheets)
+        self.assertFalse(any(sheet.startswith(("añadidas", "borradas")) for sheet in sheets))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Tests for the indexes used to find matching candidates
+"""
+from unittest import TestCase, main
+
+import pandas as pd
+
+from ong_gesfincas.conciliation_index import (AmountDateIndex, AmountIndex, BucketIndex, FincaIndex, SearchIndex,
+                                             TextIndex, normalize_text, to_days)
+
+
+class TestFincaIndex(TestCase):
+
+    def setUp(self) -> None:
+        self.index = FincaIndex(["C/ Mayor 12", "Avda. de la Constitución 3", "Plaza Mayor 5", None, "C/ Mayor 12"])
+        self.index.add("Ana García Pérez", "Plaza Mayor 5")
+
+    def test_normalize_text(self):
+        self.assertEqual(normalize_text("Avda. de la Constitución, 3"), "AVDA DE LA CONSTITUCION 3")
+        self.assertEqual(normalize_text(None), "")
+
+    def test_candidates(self):
+        self.assertEqual(self.index.candidates("RECIBO LIMPIEZA CONSTITUCION 3"), ["Avda. de la Constitución 3"])
+        self.assertEqual(self.index.candidates("RECIBO AGUA MAYOR 12"), ["C/ Mayor 12"])
+        # Tie between two fincas
+        self.assertEqual(sorted(self.index.candidates("RECIBO MAYOR")), ["C/ Mayor 12", "Plaza Mayor 5"])
+        # Just numbers or generic words are not enough
+        self.assertEqual(self.index.candidates("COMISION 12 DE LA CALLE"), [])
+
+    def test_tenant(self):
+        self.assertEqual(self.index.candidates("TRANSFERENCIA DE GARCIA PEREZ ANA"), ["Plaza Mayor 5"])
+
+
+class TestAmountDateIndex(TestCase):
+
+    def setUp(self) -> None:
+        self.cents = [1000, 1000, 1000, 1000, 2000]
+        self.dates = pd.to_datetime(["2024-01-05", "2024-02-05", "2024-03-05", None, "2024-01-06"])
+        self.index = AmountDateIndex(self.cents, self.dates, window_days=10)
+
+    def test_to_days(self):
+        days = to_days(["2024-01-01", "31/01/2024", None, "nonsense"])
+        self.assertEqual(days[1] - days[0], 30)
+        self.assertTrue(pd.isna(days[2:]).all())
+
+    def test_candidates(self):
+        day = to_days(["2024-02-01"])[0]
+        # Rows without date are always candidates
+        self.assertEqual(self.index.candidates(1000, day).tolist(), [1, 3])
+        self.assertEqual(self.index.candidates(1000).tolist(), [0, 1, 2, 3])
+        self.assertEqual(self.index.candidates(3000, day).tolist(), [])
+        self.index.remove([1])
+        self.assertEqual(self.index.candidates(1000, day).tolist(), [3])
+        self.assertEqual(self.index.candidates_between(999, 2000, to_days(["2024-01-01"])[0]).tolist(), [0, 3, 4])
+
+    def test_no_window(self):
+        index = AmountDateIndex(self.cents, self.dates, window_days=None)
+        self.assertEqual(index.candidates(1000, to_days(["2024-02-01"])[0]).tolist(), [0, 1, 2, 3])
+
+
+class TestAmountIndex(TestCase):
+
+    def test_between(self):
+        index = AmountIndex([500, -100, 1000, 500, 499])
+        self.assertEqual(index.equal(500).tolist(), [0, 3])
+        self.assertEqual(index.between(498.5, 1000).tolist(), [0, 2, 3, 4])
+        self.assertEqual(index.between(-200, 0).tolist(), [1])
+        self.assertEqual(index.equal(2000).tolist(), [])
+
+
+class TestTextIndex(TestCase):
+
+    def test_search(self):
+        index = TextIndex(["IBERDROLA CLIENTES CALLE MAYOR 1", "LIMPIEZAS EL SOL CALLE MAYOR 1", None,
+                           "IBERDROLA CLIENTES CALLE GOYA 2"])
+        found = index.search("Recibo Iberdrola Mayor 1").tolist()
+        self.assertEqual(found[0], 0)
+        self.assertEqual(sorted(found), [0, 1, 3])
+        self.assertEqual(index.search("Recibo Iberdrola Mayor 1", limit=1).tolist(), [0])
+        self.assertEqual(index.search("NADA").tolist(), [])
+        similarity = index.similarity("IBERDROLA CLIENTES CALLE MAYOR 1", [0, 2])
+        self.assertEqual(similarity.tolist(), [1, 0])
+
+
+class TestBucketIndex(TestCase):
+
+    def test_assign(self):
+        index = BucketIndex([1, None, 2, 1, float("nan")])
+        self.assertEqual(index.positions([1]).tolist(), [0, 3])
+        self.assertEqual(index.unassigned.tolist(), [1, 4])
+        # Moving a row to another bucket removes it from the old one
+        index.assign([4, 3], 2)
+        self.assertEqual(index.positions([1]).tolist(), [0])
+        self.assertEqual(index.positions([2, None]).tolist(), [2, 3, 4])
+        self.assertEqual(index.unassign([2]).tolist(), [2, 3, 4])
+        self.assertEqual(index.assigned.tolist(), [0])
+        self.assertEqual(index.assigned_mask.tolist(), [True, False, False, False, False])
+
+    def test_totals(self):
+        index = BucketIndex([1, None, 2, 1], cents=[100, 200, 300, 400])
+        self.assertEqual(index.totals, {1: 500, 2: 300})
+        index.assign([3, 1], 2)
+        self.assertEqual(index.totals, {1: 100, 2: 900})
+        index.assign([0], 3)
+        index.unassign([2])
+        self.assertEqual(index.totals, {3: 100})
+
+
+class TestSearchIndex(TestCase):
+
+    def test_search(self):
+        index = SearchIndex(["IBERDROLA CLIENTES CALLE MAYOR 1", "Limpiezas el Sol, calle Mayor 1", None,
+                             "Iberdrola clientes Goya 2"])
+        # Words of the rows must contain every word of the query, in any order
+        self.assertEqual(index.search("mayo iberd").tolist(), [0])
+        self.assertEqual(index.search("Calle").tolist(), [0, 1])
+        self.assertEqual(index.search("2").tolist(), [3])
+        self.assertEqual(index.search("calle goya").tolist(), [])
+        self.assertEqual(index.search("").tolist(), [0, 1, 2, 3])
+        index.add(["Mayorga 3"])
+        self.assertEqual(index.search("mayor").tolist(), [0, 1, 4])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,15 @@
 Some test for conciliations
 """
 import os
+import tempfile
 from unittest import TestCase, main
 
+import numpy as np
+import pandas as pd
+
 from ong_gesfincas import DataType, get_data_path
-from ong_gesfincas.conciliation_model import Conciliation
+from ong_gesfincas.conciliation_model import Conciliation, InvalidAmountError, to_cents
+from tests.generate_synthetic_data import generate_dfs, write_bank_excel, write_gesfincas_excel
 
 
 class TestConciliationUpdate(TestCase):
@@ -111,5 +116,310 @@ class TestConciliationUpdate(TestCase):
         self.__test_update(bad_buckets)
 
 
+class TestConciliationSuggest(TestCase):
+
+    def setUp(self) -> None:
+        self.conciliation = Conciliation()
+        self.conciliation.set_dfs({
+            DataType.BNK: pd.DataFrame({"Concepto": ["RECIBO IBERDROLA MAYOR 1", "TRANSFERENCIA GARCIA LOPEZ",
+                                                     "RECIBO LIMPIEZAS Y AGUA"],
+                                        "Importe": [-100.0, 500.0, -80.5]}),
+            DataType.EXP: pd.DataFrame({"CONCEPTO": ["LIMPIEZAS EL SOL", "IBERDROLA CLIENTES", "AGUA MAYOR",
+                                                     "IBERDROLA CLIENTES"],
+                                        "Pagos": [100.0, 100.0, 30.5, 50.0], "Abonos": 0.0,
+                                        "finca": ["MAYOR 1", "MAYOR 1", "MAYOR 1", "MAYOR 1"]}),
+            DataType.INC: pd.DataFrame({"Piso/Local": ["1A"], "Inquilino": ["GARCIA LOPEZ"], "Fecha": [None],
+                                        "Cobrado": [500.0], "Pendiente": [0.0], "finca": ["MAYOR 1"]}),
+        })
+
+    def test_suggest(self):
+        """Same amount and similar text go first. Pairs of consecutive rows of the same finca are suggested"""
+        suggestions = self.conciliation.suggest(DataType.BNK, [0], k=3)
+        self.assertEqual(suggestions.loc[0, "data_type"], DataType.EXP)
+        self.assertEqual(suggestions.loc[0, "positions"], (1,))
+        self.assertEqual(suggestions.loc[1, "positions"], (0,))
+        self.assertEqual(self.conciliation.suggest(DataType.BNK, [2], k=1).loc[0, "positions"], (2, 3))
+        self.assertEqual(self.conciliation.suggest(DataType.BNK, [1], k=1).loc[0, "data_type"], DataType.INC)
+        self.assertEqual(self.conciliation.suggest(DataType.INC, [0], k=1).loc[0, "index"], (1,))
+        # Assigned rows are not suggested
+        self.conciliation.bucket([0], idx_expenses=[1])
+        self.assertNotIn((1,), self.conciliation.suggest(DataType.BNK, [0], k=5)["positions"].tolist())
+
+
+class TestConciliationCents(TestCase):
+
+    def test_to_cents(self):
+        self.assertEqual(to_cents(pd.Series([0.29, -20.05, None, 10000000.01])).tolist(), [29, -2005, 0, 1000000001])
+        self.assertEqual(to_cents(pd.Series(["1.234,56", "-0,05", "3", None], dtype=object)).tolist(),
+                         [123456, -5, 300, 0])
+        with self.assertRaises(InvalidAmountError) as error:
+            to_cents(pd.Series([1.0, 10.005, "abc"], dtype=object))
+        self.assertEqual(error.exception.missing, [1, 2])
+
+    def test_string_amounts(self):
+        """Amounts typed as strings are loaded (and expenses change sign) as numbers"""
+        dfs = TestConciliationPeriods.month(["2024-01-05", "2024-01-06"], ["LUZ", "AGUA"], [-10.0, -1234.56],
+                                            ["LUZ", "AGUA"])
+        dfs[DataType.EXP] = dfs[DataType.EXP].assign(Pagos=pd.Series(["10,00", "1.234,56"], dtype=object))
+        dfs[DataType.BNK] = dfs[DataType.BNK].assign(Importe=pd.Series(["-10,00", "-1.234,56"], dtype=object))
+        conciliation = Conciliation()
+        conciliation.set_dfs(dfs, read_buckets=False)
+        self.assertEqual(conciliation.df_expenses[Conciliation.col_cents].tolist(), [-1000, -123456])
+        self.assertEqual(conciliation.df_expenses["Pagos"].tolist(), [-10.0, -1234.56])
+        self.assertEqual(conciliation.df_bank["Importe"].tolist(), [-10.0, -1234.56])
+        conciliation.automatic_bucket_expenses()
+        self.assertEqual(conciliation.df_bank[Conciliation.col_bucket].notna().sum(), 2)
+
+    def test_invalid_amounts(self):
+        """Data with fractions of cent is not loaded and current data is kept"""
+        dfs = TestConciliationPeriods.month(["2024-01-05"], ["LUZ"], [-10.0], ["LUZ"])
+        conciliation = Conciliation()
+        conciliation.set_dfs(dfs, read_buckets=False)
+        bank = conciliation.df_bank
+        with self.assertRaises(InvalidAmountError):
+            conciliation.set_dfs({DataType.EXP: dfs[DataType.EXP].assign(Pagos=[10.001]),
+                                  DataType.BNK: bank.drop(columns=[Conciliation.col_cents, Conciliation.col_bucket])})
+        self.assertIs(conciliation.df_bank, bank)
+        self.assertEqual(conciliation.df_expenses[Conciliation.col_cents].tolist(), [-1000])
+
+
+class TestConciliationPeriods(TestCase):
+
+    @staticmethod
+    def month(dates: list, concepts: list, amounts: list, expenses: list) -> dict:
+        return {
+            DataType.BNK: pd.DataFrame({"Fecha": dates, "Concepto": concepts, "Importe": amounts}),
+            DataType.EXP: pd.DataFrame({"CONCEPTO": expenses, "Pagos": [-amount for amount in amounts],
+                                        "Abonos": 0.0, "finca": "MAYOR 1"}),
+            DataType.INC: pd.DataFrame({"Piso/Local": ["1A"], "Inquilino": ["GARCIA"], "Fecha": [None],
+                                        "Cobrado": [0.0], "Pendiente": [500.0], "finca": ["MAYOR 1"]}),
+        }
+
+    def test_append_period(self):
+        """New periods are appended with new indexes, buckets of previous periods are frozen and rows pending from
+        previous periods can be matched with the new ones"""
+        conciliation = Conciliation()
+        january = self.month(["2024-01-05", "2024-01-20"], ["LUZ", "AGUA"], [-10.0, -20.0], ["LUZ ENERO", "AGUA"])
+        self.assertEqual(conciliation.append_period(january, "2024-01"),
+                         {DataType.BNK: 2, DataType.EXP: 2, DataType.INC: 1})
+        conciliation.bucket([0], idx_expenses=[0])
+        self.assertEqual(conciliation.search(DataType.EXP, "luz").tolist(), [0])
+        # Pending income appears again in the new file, so it is not appended
+        appended = conciliation.append_period(self.month(["2024-02-05"], ["LUZ"], [-10.0], ["LUZ FEBRERO"]), "2024-02")
+        # Search index is extended with the new rows
+        self.assertEqual(conciliation.search(DataType.EXP, "luz").tolist(), [0, 2])
+        self.assertEqual(conciliation.search(DataType.EXP, "feb luz").tolist(), [2])
+        self.assertEqual(appended, {DataType.BNK: 1, DataType.EXP: 1, DataType.INC: 0})
+        self.assertEqual(conciliation.df_bank.index.tolist(), [0, 1, 2])
+        self.assertEqual(conciliation.df_bank[Conciliation.col_period].tolist(), ["2024-01", "2024-01", "2024-02"])
+        self.assertEqual(conciliation.frozen_buckets, {0})
+        conciliation.unbucket([0])
+        self.assertEqual(conciliation.df_bank.loc[0, Conciliation.col_bucket], 0)
+        conciliation.automatic_bucket_expenses()
+        self.assertEqual(conciliation.df_bank[Conciliation.col_bucket].notna().tolist(), [True, True, True])
+        self.assertEqual(conciliation.df_expenses.loc[2, Conciliation.col_bucket],
+                         conciliation.df_bank.loc[2, Conciliation.col_bucket])
+
+
+class TestConciliationValidate(TestCase):
+
+    def test_validate_buckets(self):
+        """All problems of all buckets are found at once, and orphan buckets can be cleared"""
+        dfs = TestConciliationPeriods.month(["2024-01-05", "2024-01-20", "2024-01-21"], ["LUZ", "AGUA", "GAS"],
+                                            [-10.0, -20.0, -5.0], ["LUZ", "AGUA", "GAS"])
+        conciliation = Conciliation()
+        conciliation.set_dfs(dfs, read_buckets=False)
+        conciliation.bucket([0], idx_expenses=[0])
+        conciliation.bucket([1], idx_expenses=[1, 2])
+        conciliation.df_incomes.loc[0, Conciliation.col_bucket] = 2
+        problems = conciliation.validate_buckets()
+        self.assertEqual(problems[[Conciliation.col_bucket, "problema"]].values.tolist(),
+                         [[1, Conciliation.PROBLEM_UNBALANCED], [2, Conciliation.PROBLEM_ORPHAN]])
+        self.assertEqual(problems["diferencia"].tolist(), [500, 0])
+        self.assertEqual(conciliation.clear_orphan_buckets(), [2])
+        self.assertEqual(conciliation.validate_buckets(tolerance_cents=500).shape[0], 0)
+
+
+class TestConciliationDiff(TestCase):
+
+    def test_diff(self):
+        """Rows are matched by value (no matter their order or bucket numbers) and rebucketed rows are reported"""
+        dfs = TestConciliationPeriods.month(["2024-01-05", "2024-01-20", "2024-01-21"], ["LUZ", "AGUA", "AGUA"],
+                                            [-10.0, -20.0, -20.0], ["LUZ", "AGUA", "AGUA"])
+        old = Conciliation()
+        old.set_dfs({key: df.copy() for key, df in dfs.items()}, read_buckets=False)
+        old.bucket([0], idx_expenses=[0])
+        old.bucket([1], idx_expenses=[1])
+        # New version: bank rows in other order plus a new one, an expense removed and the first AGUA unassigned
+        dfs[DataType.BNK] = pd.concat([dfs[DataType.BNK].iloc[[2, 1, 0]], pd.DataFrame(
+            {"Fecha": ["2024-01-30"], "Concepto": ["GAS"], "Importe": [-5.0]})], ignore_index=True)
+        dfs[DataType.EXP] = dfs[DataType.EXP].iloc[:2]
+        new = Conciliation()
+        new.set_dfs(dfs, read_buckets=False)
+        new.bucket([2], idx_expenses=[0])
+        new.bucket([0], idx_expenses=[1])
+        diff = old.diff(new)
+        self.assertEqual(diff["added"][DataType.BNK]["Concepto"].tolist(), ["GAS"])
+        self.assertEqual(diff["removed"][DataType.EXP].index.tolist(), [2])
+        self.assertEqual(diff["rebucketed"][DataType.BNK]["Cambio"].tolist(), ["punteada", "despunteada"])
+        self.assertEqual(diff["rebucketed"][DataType.EXP]["Cambio"].tolist(), ["cambio de punteo"])
+        self.assertEqual(diff["totals"].loc["banco", "importe después"], -55)
+        self.assertEqual(old.diff(old)["totals"]["cambios de punteo"].sum(), 0)
+
+
+class TestConciliationAccounts(TestCase):
+
+    def test_read_banks(self):
+        """Extracts of many accounts are read in a single bank df and totals are reported by account"""
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = []
+            for account, amounts in ("caixa", [-10.0, -25.0]), ("santander", [-20.0]):
+                filenames.append(os.path.join(directory, f"{account}.xlsx"))
+                pd.DataFrame({"Fecha": "2024-01-05", "Concepto": "RECIBO", "Importe": amounts}).to_excel(
+                    filenames[-1], index=False)
+            conciliation = Conciliation()
+            df_dict = conciliation.read_banks(filenames, workers=1)
+        self.assertEqual(df_dict[DataType.BNK][Conciliation.col_account].tolist(), ["caixa", "caixa", "santander"])
+        self.assertEqual(df_dict[DataType.BNK].index.tolist(), [0, 1, 2])
+        df_dict[DataType.EXP] = pd.DataFrame({"CONCEPTO": ["LUZ", "AGUA"], "Pagos": [10.0, 20.0], "Abonos": 0.0,
+                                              "finca": "MAYOR 1"})
+        df_dict[DataType.INC] = pd.DataFrame(columns=["Piso/Local", "Inquilino", "Fecha", "Cobrado", "Pendiente",
+                                                      "finca"])
+        conciliation.set_dfs(df_dict, read_buckets=False)
+        conciliation.automatic_bucket_expenses()
+        self.assertEqual(conciliation.accounts, ["caixa", "santander"])
+        by_account = conciliation.check_buckets_by_account()
+        self.assertEqual(by_account.loc["caixa", "banco solo"], -25)
+        self.assertEqual(by_account.loc["caixa", "gastos"], -10)
+        self.assertEqual(by_account.loc["santander", "banco gastos"], -20)
+
+
+class TestConciliationProvenance(TestCase):
+
+    def test_update_same_files(self):
+        """Rows read again from the same files keep their buckets, even if they have exactly the same values"""
+        bank = pd.DataFrame({"Fecha": pd.Timestamp("2024-01-05"), "Concepto": ["RECIBO", "RECIBO", "OTRO"],
+                             "Importe": [-10.0, -10.0, -5.0]})
+        expenses = pd.DataFrame({"CONCEPTO": ["LUZ", "LUZ"], "Pagos": 10.0, "Abonos": 0.0, "finca": "MAYOR 1"})
+        incomes = pd.DataFrame({"Piso/Local": ["1A"], "Inquilino": ["PEREZ"], "Fecha": pd.Timestamp("2024-01-05"),
+                                "Cobrado": [5.0], "Pendiente": [0.0], "finca": "MAYOR 1"})
+        with tempfile.TemporaryDirectory() as directory:
+            bank_file = os.path.join(directory, "banco.xlsx")
+            gesfincas_file = os.path.join(directory, "gesfincas.xlsx")
+            write_bank_excel(bank, bank_file)
+            write_gesfincas_excel(expenses, incomes, gesfincas_file)
+            conciliation = Conciliation()
+
+            def read() -> dict:
+                return {**conciliation.read_bank(bank_file), **conciliation.read_gesfincas(gesfincas_file)}
+
+            def pairs() -> list:
+                """Rows of expenses matched with each bucketed bank row (buckets are renumbered by update_dfs)"""
+                col_bucket = Conciliation.col_bucket
+                return [conciliation.df_expenses.index[conciliation.df_expenses[col_bucket] == bucket].tolist()
+                        for bucket in conciliation.df_bank[col_bucket].dropna()]
+
+            conciliation.set_dfs(read(), read_buckets=False)
+            self.assertEqual(conciliation.df_bank["fila"].tolist(), [2, 3, 4])
+            self.assertEqual(conciliation.df_bank["fila"].dtype, pd.Int32Dtype())
+            conciliation.bucket([1], idx_expenses=[0])
+            conciliation.bucket([0], idx_expenses=[1])
+            self.assertEqual(pairs(), [[1], [0]])
+            conciliation.update_dfs(read())
+            self.assertEqual(pairs(), [[1], [0]])
+
+
+class TestConciliationProgress(TestCase):
+
+    def setUp(self) -> None:
+        self.dfs = generate_dfs(1200)
+
+    def conciliation(self) -> Conciliation:
+        conciliation = Conciliation()
+        conciliation.set_dfs({key: df.copy() for key, df in self.dfs.items()}, read_buckets=False)
+        return conciliation
+
+    def test_progress(self):
+        """Reporting progress (so buckets are assigned in batches) does not change results, and buckets of each
+        batch can be copied to another conciliation"""
+        expected = self.conciliation()
+        expected.automatic_bucket_expenses()
+        conciliation = self.conciliation()
+        copy = self.conciliation()
+        steps = []
+
+        def progress(step: str, done: int, total: int) -> bool:
+            steps.append(step)
+            copy.bucket_many(conciliation.bucket_list(copy.get_next_bucket()))
+            return False
+
+        self.assertFalse(conciliation.automatic_bucket_expenses(progress=progress))
+        self.assertIn("Importe aproximado con gastos", steps)
+        for key, df in expected.dfs.items():
+            self.assertEqual(df[Conciliation.col_bucket].tolist(),
+                             conciliation.dfs[key][Conciliation.col_bucket].tolist())
+            self.assertEqual(df[Conciliation.col_bucket].notna().tolist(),
+                             copy.dfs[key][Conciliation.col_bucket].notna().tolist())
+
+    def test_stop(self):
+        """Matching stops when progress returns True, keeping the buckets found"""
+        conciliation = self.conciliation()
+        self.assertTrue(conciliation.automatic_bucket_expenses(progress=lambda step, done, total: done > 0))
+        assigned = conciliation.df_bank[Conciliation.col_bucket].notna().sum()
+        self.assertGreater(assigned, 0)
+        self.assertLess(assigned, 600)
+
+    def test_bucket_index(self):
+        """Bucket indexes built before matching are kept up to date with the buckets of the dfs"""
+        conciliation = self.conciliation()
+        for data_type in DataType:
+            conciliation.bucket_index(data_type)
+        conciliation.automatic_bucket_expenses()
+        conciliation.unbucket(conciliation.df_bank[Conciliation.col_bucket].dropna().unique()[::3])
+        for data_type, df in conciliation.dfs.items():
+            buckets = df[Conciliation.col_bucket]
+            self.assertEqual(conciliation.unassigned_positions(data_type).tolist(),
+                             np.flatnonzero(buckets.isna().values).tolist())
+            bucket = buckets.dropna().iloc[0]
+            self.assertEqual(conciliation.bucket_positions(data_type, [bucket]).tolist(),
+                             np.flatnonzero((buckets == bucket).values).tolist())
+            # Balances kept up to date as rows are assigned and unassigned
+            expected = df[Conciliation.col_cents].groupby(buckets.dropna().astype(int)).sum()
+            balances = conciliation.bucket_balances()[f"céntimos {data_type.value}"]
+            self.assertEqual(balances[balances.index.isin(expected.index)].to_dict(), expected.to_dict())
+
+    def test_indexes_reordered_frames(self):
+        """Indexes are built again if a df is reordered in place or replaced by another one of the same length"""
+        conciliation = self.conciliation()
+        conciliation.automatic_bucket_expenses()
+        for data_type in DataType:
+            conciliation.bucket_index(data_type)
+            conciliation.amount_index(data_type)
+            conciliation.search_index(data_type)
+        conciliation.df_bank.sort_values(Conciliation.col_cents, inplace=True)
+        conciliation.dfs[DataType.EXP] = conciliation.df_expenses = conciliation.df_expenses.iloc[::-1].copy()
+        for data_type, df in conciliation.dfs.items():
+            self.assertEqual(conciliation.assigned_positions(data_type).tolist(),
+                             np.flatnonzero(df[Conciliation.col_bucket].notna().values).tolist())
+            cents = int(df[Conciliation.col_cents].iloc[0])
+            self.assertIn(0, conciliation.find_amount(cents, data_types=[data_type])[data_type].tolist())
+            concept = str(df.iloc[0][Conciliation._COLS_TEXT[data_type][0]])
+            self.assertIn(0, conciliation.search(data_type, concept).tolist())
+
+    def test_version(self):
+        """Version changes when buckets change, and not when they are just read"""
+        conciliation = self.conciliation()
+        version = conciliation.version
+        conciliation.check_buckets()
+        conciliation.validate_buckets()
+        self.assertEqual(conciliation.version, version)
+        for change in (conciliation.automatic_bucket_expenses,
+                       lambda: conciliation.unbucket(conciliation.df_bank[Conciliation.col_bucket].dropna()[:1]),
+                       lambda: conciliation.update_dfs(conciliation.backup_dfs())):
+            change()
+            self.assertGreater(conciliation.version, version)
+            version = conciliation.version
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,79 @@
+"""
+Tests for the table model of the GUI, that shows views of the dfs of a Conciliation without copying them
+"""
+from tkinter import TclError, Tk
+from unittest import TestCase, main
+from unittest.mock import PropertyMock, patch
+
+import pandas as pd
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_model import Conciliation
+from ong_gesfincas.conciliation_pandastable import ConciliationTable, ConciliationTableModel
+from tests.generate_synthetic_data import generate_dfs
+
+
+class TestConciliationTableModel(TestCase):
+
+    def test_sort(self):
+        """Sorting a view reorders the rows drawn, and neither the source nor model.df are changed in place"""
+        dfs = generate_dfs(20)
+        dfs[DataType.BNK] = pd.DataFrame({"Concepto": ["c", "b", "a"], "Importe": [-10.0, -20.0, -30.0]})
+        conciliation = Conciliation()
+        conciliation.set_dfs(dfs, read_buckets=False)
+        bank = conciliation.backup_dfs()[DataType.BNK]
+        for positions, expected in (None, ["a", "b", "c"]), ([0, 1], ["b", "c"]):
+            with self.subTest(positions=positions):
+                model = ConciliationTableModel(conciliation.df_bank, positions)
+                self.assertIsNot(model.df, conciliation.df_bank)
+                model.sort(["Concepto"])
+                drawn = model.get_rows(range(model.getRowCount()))
+                self.assertEqual(drawn["Concepto"].tolist(), expected)
+                self.assertEqual(model.df["Concepto"].tolist(), expected)
+                pd.testing.assert_frame_equal(conciliation.dfs[DataType.BNK], bank)
+                model.sort(["Concepto"], ascending=0)
+                self.assertEqual(model.get_rows(range(model.getRowCount()))["Concepto"].tolist(), expected[::-1])
+                model.sort(index=True)
+                self.assertEqual(model.get_index().tolist(), sorted(model.get_index()))
+
+    def test_no_df(self):
+        """Reading what a redraw reads (sizes, column names, headers, visible rows) never materializes model.df"""
+        conciliation = Conciliation()
+        conciliation.set_dfs(generate_dfs(200), read_buckets=False)
+        source = conciliation.df_bank
+        model = ConciliationTableModel(source)
+        with patch.object(ConciliationTableModel, "df", new_callable=PropertyMock) as df:
+            for positions in None, list(range(0, len(source), 3)):
+                model.set_view(source, positions)
+                rows = range(min(10, model.getRowCount()))
+                self.assertEqual(model.getColumnCount(), len(source.columns))
+                self.assertEqual([model.getColumnName(col) for col in range(model.getColumnCount())],
+                                 list(source.columns))
+                pd.testing.assert_index_equal(model.header_df.columns, source.columns)
+                self.assertEqual(len(model.header_df), 0)
+                self.assertEqual(len(model.get_rows(rows)), len(rows))
+                self.assertGreater(model.getlongestEntry(0), 0)
+            df.assert_not_called()
+
+    def test_redraw_no_df(self):
+        """Redrawing a table after changing its view never materializes model.df"""
+        try:
+            root = Tk()
+        except TclError:
+            self.skipTest("No display")
+        self.addCleanup(root.destroy)
+        conciliation = Conciliation()
+        conciliation.set_dfs(generate_dfs(200), read_buckets=False)
+        source = conciliation.df_bank
+        table = ConciliationTable(root, dataframe=source)
+        table.show()
+        with patch.object(ConciliationTableModel, "df", new_callable=PropertyMock) as df:
+            for positions in list(range(0, len(source), 3)), None:
+                table.set_view_redraw(source, positions)
+                table.autoResizeColumns()
+            df.assert_not_called()
+        self.assertEqual(table.rows, len(source))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Tests for the automatic bucketing partitioned by finca
+"""
+from unittest import TestCase, main
+
+import pandas as pd
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_model import Conciliation
+from ong_gesfincas.conciliation_partition import automatic_bucket_by_finca, bank_fincas
+
+
+def new_conciliation() -> Conciliation:
+    """Two fincas with the same amounts, so matching across fincas would pick the wrong rows, and a bank row without
+    finca"""
+    date = pd.Timestamp("2024-01-05")
+    conciliation = Conciliation()
+    conciliation.set_dfs({
+        DataType.BNK: pd.DataFrame({"Fecha": date,
+                                    "Concepto": ["RECIBO LUZ MAYOR 1", "RECIBO LUZ SOL 5", "RECIBO AGUA",
+                                                 "TRANSF ANA LOPEZ"],
+                                    "Importe": [-50.0, -50.0, -30.0, 500.0]}),
+        DataType.EXP: pd.DataFrame({"Fecha": date, "CONCEPTO": ["LUZ", "LUZ", "AGUA"], "Pagos": [50.0, 50.0, 30.0],
+                                    "Abonos": 0.0, "finca": ["SOL 5", "MAYOR 1", "SOL 5"]}),
+        DataType.INC: pd.DataFrame({"Piso/Local": ["1A", "2B"], "Inquilino": ["JUAN PEREZ", "ANA LOPEZ"],
+                                    "Fecha": date, "Cobrado": [500.0, 500.0], "Pendiente": 0.0,
+                                    "finca": ["MAYOR 1", "SOL 5"]}),
+    }, read_buckets=False)
+    return conciliation
+
+
+class TestAutomaticBucketByFinca(TestCase):
+
+    def test_bank_fincas(self):
+        """Fincas are found by their name or by the name of a tenant"""
+        fincas = bank_fincas(new_conciliation())
+        self.assertEqual(fincas.isna().tolist(), [False, False, True, False])
+        self.assertEqual(fincas.dropna().tolist(), ["MAYOR 1", "SOL 5", "SOL 5"])
+
+    def test_by_finca(self):
+        """Rows are matched only with rows of their finca, and rows without finca in a final pass with the rest"""
+        conciliation = new_conciliation()
+        result = automatic_bucket_by_finca(conciliation, workers=1)
+        self.assertEqual(result, {"MAYOR 1": 1, "SOL 5": 2, None: 1})
+        col_bucket = conciliation.col_bucket
+        buckets = conciliation.df_bank[col_bucket]
+        self.assertTrue(buckets.notna().all())
+        self.assertEqual(buckets.nunique(), len(buckets))
+        # Bank row (position) matched with each expense and income
+        bank_rows = {bucket: row for row, bucket in enumerate(buckets)}
+        self.assertEqual([bank_rows[bucket] for bucket in conciliation.df_expenses[col_bucket]], [1, 0, 2])
+        self.assertEqual([bank_rows.get(bucket) for bucket in conciliation.df_incomes[col_bucket]], [None, 3])
+
+    def test_existing_buckets(self):
+        """New buckets of the fincas and of the final pass don't reuse the ids of existing buckets"""
+        conciliation = new_conciliation()
+        conciliation.bucket([3], idx_incomes=[1])
+        existing = conciliation.df_bank[conciliation.col_bucket].iloc[3]
+        self.assertEqual(automatic_bucket_by_finca(conciliation, workers=1), {"MAYOR 1": 1, "SOL 5": 1, None: 1})
+        buckets = conciliation.df_bank[conciliation.col_bucket]
+        self.assertEqual(buckets.nunique(), len(buckets))
+        self.assertEqual(buckets.iloc[3], existing)
+        self.assertEqual(conciliation.df_incomes[conciliation.col_bucket].iloc[1], existing)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Tests for the matching rules learnt from previous conciliations
+"""
+import os
+import tempfile
+from unittest import TestCase, main
+
+import pandas as pd
+
+from ong_gesfincas import DataType
+from ong_gesfincas.conciliation_model import Conciliation
+from ong_gesfincas.conciliation_rules import MatchingRules, concept_pattern, target_pattern
+
+
+def new_conciliation() -> Conciliation:
+    """A conciliation with a recurring expense paid every month and a rent"""
+    conciliation = Conciliation()
+    conciliation.set_dfs({
+        DataType.BNK: pd.DataFrame({"Fecha": pd.to_datetime(["2024-01-03", "2024-02-03", "2024-02-10"]),
+                                    "Concepto": ["RECIBO LIMPIEZAS 0124 REF 99812", "RECIBO LIMPIEZAS 0224 REF 10021",
+                                                 "TRANSF. ANA LOPEZ"],
+                                    "Importe": [-80.0, -80.0, 500.0]}),
+        DataType.EXP: pd.DataFrame({"Fecha": pd.to_datetime(["2024-01-01", "2024-02-01"]),
+                                    "CONCEPTO": ["Limpiezas El Sol", "Limpiezas El Sol"], "Pagos": [80.0, 80.0],
+                                    "Abonos": 0.0, "finca": ["MAYOR 1", "MAYOR 1"]}),
+        DataType.INC: pd.DataFrame({"Piso/Local": ["1A"], "Inquilino": ["ANA LOPEZ"], "Fecha": [None],
+                                    "Cobrado": [500.0], "Pendiente": [0.0], "finca": ["MAYOR 1"]}),
+    })
+    return conciliation
+
+
+class TestMatchingRules(TestCase):
+
+    def test_invalid_file(self):
+        """Files that cannot be read are ignored with a warning"""
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "reglas.json")
+            for content in "{not json", '{"version": 1}', '{"rules": {"RECIBO": [["gastos", "LUZ"]]}}', "[]":
+                with self.subTest(content=content):
+                    with open(filename, "w", encoding="utf-8") as f:
+                        f.write(content)
+                    with self.assertLogs("ong_gesfincas.conciliation_rules", level="WARNING"):
+                        rules = MatchingRules(filename)
+                    self.assertEqual(len(rules), 0)
+
+    def test_concept_pattern(self):
+        self.assertEqual(concept_pattern("Recibo Limpiezas 01/2024 ref. A1234"), "RECIBO LIMPIEZAS REF")
+        self.assertEqual(target_pattern("FRA 2024/031 Limpiezas"), "FRA LIMPIEZAS")
+        self.assertEqual(target_pattern("2024/031"), "2024 031")
+
+    def test_learn_apply(self):
+        """Rules learnt from a month are applied to the next, choosing the closest date"""
+        learnt = new_conciliation()
+        learnt.bucket([0], idx_expenses=[0])
+        learnt.bucket([2], idx_incomes=[0])
+        rules = MatchingRules()
+        self.assertEqual(rules.learn(learnt), 2)
+        self.assertEqual(len(rules), 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "rules", "rules.json")
+            rules.save(filename)
+            rules = MatchingRules(filename)
+        self.assertEqual(len(rules), 2)
+
+        conciliation = new_conciliation()
+        self.assertEqual(conciliation.bucket_by_rules(rules), 3)
+        buckets = conciliation.df_bank[conciliation.col_bucket].tolist()
+        self.assertEqual(conciliation.df_expenses[conciliation.col_bucket].tolist(), buckets[:2])
+        self.assertEqual(conciliation.df_incomes[conciliation.col_bucket].tolist(), buckets[2:])
+
+        # Without dates, the recurring expense is ambiguous
+        conciliation = new_conciliation()
+        conciliation.date_window_days = None
+        self.assertEqual(conciliation.bucket_by_rules(rules), 1)
+
+    def test_next_period(self):
+        """Rules learnt from a month match expenses of the next month with other invoice numbers and dates"""
+        learnt = new_conciliation()
+        learnt.df_expenses["CONCEPTO"] = ["FRA 2024/031 LIMPIEZAS 01/24", "FRA 2024/045 LIMPIEZAS 02/24"]
+        learnt.bucket([0], idx_expenses=[0])
+        rules = MatchingRules()
+        self.assertEqual(rules.learn(learnt), 1)
+
+        conciliation = new_conciliation()
+        conciliation.df_expenses["CONCEPTO"] = ["FRA 2024/058 LIMPIEZAS 03/24", "FRA 2024/071 LIMPIEZAS 04/24"]
+        self.assertEqual(conciliation.bucket_by_rules(rules), 2)
+        self.assertEqual(conciliation.df_expenses[conciliation.col_bucket].tolist(),
+                         conciliation.df_bank[conciliation.col_bucket].tolist()[:2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Tests for the background tasks of the GUI, using a fake widget instead of tk main loop
+"""
+import threading
+import time
+from unittest import TestCase, main
+
+from ong_gesfincas.conciliation_tasks import BackgroundTask
+
+
+class FakeWidget:
+    """Runs the functions scheduled with after when run is called, as tk main loop would do"""
+
+    def __init__(self):
+        self.jobs = dict()
+        self.last_job = 0
+
+    def after(self, ms: int, function):
+        self.last_job += 1
+        self.jobs[self.last_job] = function
+        return self.last_job
+
+    def after_cancel(self, job):
+        self.jobs.pop(job, None)
+
+    def run(self, timeout: float = 5):
+        end = time.monotonic() + timeout
+        while self.jobs and time.monotonic() < end:
+            self.jobs.pop(min(self.jobs))()
+            time.sleep(0.001)
+
+
+class TestBackgroundTask(TestCase):
+
+    def setUp(self) -> None:
+        self.widget = FakeWidget()
+        self.results = []
+        self.progress = []
+        self.errors = []
+
+    def task(self) -> BackgroundTask:
+        return BackgroundTask(self.widget, on_done=self.results.append, on_error=self.errors.append,
+                              on_progress=lambda *args: self.progress.append(args), poll_ms=1)
+
+    def test_done(self):
+        """Results are returned in order and progress is reported in the main thread"""
+        task = self.task()
+
+        def work(n: int) -> int:
+            task.report(n)
+            return n * 2
+
+        task.run_thread(work, 1)
+        task.run_thread(work, 2)
+        task.start()
+        self.widget.run()
+        self.assertEqual(self.results, [[2, 4]])
+        self.assertEqual(sorted(self.progress), [(1,), (2,)])
+        self.assertFalse(task.running)
+
+    def test_error(self):
+        task = self.task()
+        task.run_thread(lambda: 1 / 0)
+        task.start()
+        self.widget.run()
+        self.assertEqual(self.results, [])
+        self.assertIsInstance(self.errors[0], ZeroDivisionError)
+
+    def test_stop_and_cancel(self):
+        """A stopped task keeps what workers return, a cancelled one discards it"""
+        for cancel, expected in (False, [["stopped"]]), (True, []):
+            self.results.clear()
+            started = threading.Event()
+            task = self.task()
+
+            def work() -> str:
+                started.set()
+                while not task.stopped:
+                    time.sleep(0.001)
+                return "stopped"
+
+            task.run_thread(work)
+            task.start()
+            started.wait()
+            task.cancel() if cancel else task.stop()
+            self.widget.run()
+            self.assertEqual(self.results, expected)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,11 @@
 Tests that console_scripts defined in pyproject.toml work properly
 [project.scripts]
 liquidaciones = "ong_gesfincas.liquidaciones_gui:main"
-punteo = "ong_gesfincas.conciliation_gui:main"
+punteo = "ong_gesfincas.launcher:punteo"
 """
 from unittest import TestCase, main
 
-from ong_gesfincas.conciliation_gui import main as punteo
+from ong_gesfincas.launcher import punteo
 from ong_gesfincas.liquidaciones_gui import main as liquidaciones
 
 
@@ -1,7 +1,14 @@
-from unittest import TestCase
+import os
+import tempfile
+from importlib.util import find_spec
+from unittest import TestCase, skipIf
 
-from ong_gesfincas import get_data_path
-from ong_gesfincas.liquidaciones_cmd import read_gesfincas
+import openpyxl
+
+from ong_gesfincas import get_data_path, DataType
+from ong_gesfincas.liquidaciones_cmd import (COL_FILE, COL_ROW, COL_SHEET, PROVENANCE_DTYPES, file_id, main,
+                                             read_bundle_metadata, read_gesfincas)
+from tests.generate_synthetic_data import generate_dfs, write_gesfincas_excel
 
 
 class Test(TestCase):
@@ -15,3 +22,25 @@ class Test(TestCase):
         self.assertFalse(self.df_incomes.iloc[1:, :2].isna().all(axis=1).any(),
                         "There are incomes not properly filled")
 
+
+@skipIf(find_spec("pyarrow") is None, "pyarrow is not installed")
+class TestBundle(TestCase):
+
+    def test_bundle(self):
+        """A bundle has the same data as the gesfincas file, plus the sheet and row of each row"""
+        dfs = generate_dfs(100)
+        with tempfile.TemporaryDirectory() as folder:
+            gesfincas_file = os.path.join(folder, "gesfincas.xlsx")
+            bundle_file = os.path.join(folder, "gesfincas_procesado.parquet")
+            write_gesfincas_excel(dfs[DataType.EXP], dfs[DataType.INC], gesfincas_file)
+            main(gesfincas_file, os.path.join(folder, "gesfincas_procesado.xlsx"), bundle_file)
+            self.assertEqual(read_bundle_metadata(bundle_file)["source"], "gesfincas.xlsx")
+            for df_excel, df_bundle in zip(read_gesfincas(gesfincas_file), read_gesfincas(bundle_file)):
+                self.assertEqual(list(df_excel.columns), list(df_bundle.columns))
+                # Second column is the concept (expenses) or the tenant (incomes)
+                self.assertEqual(df_excel.iloc[:, 1].tolist(), df_bundle.iloc[:, 1].tolist())
+            df_expenses, _ = read_gesfincas(bundle_file, provenance=True)
+            self.assertEqual(df_expenses[COL_ROW].dtype, PROVENANCE_DTYPES[COL_ROW])
+            self.assertEqual(df_expenses[COL_FILE].unique().tolist(), [file_id(gesfincas_file)])
+            sheet = openpyxl.load_workbook(gesfincas_file).worksheets[df_expenses[COL_SHEET].iloc[-1] - 1]
+            self.assertEqual(sheet.cell(int(df_expenses[COL_ROW].iloc[-1]), 2).value, df_expenses["CONCEPTO"].iloc[-1])
@@ -0,0 +1,73 @@
+"""
+Tests for the optional instrumentation of operations
+"""
+import json
+import os
+import tempfile
+from unittest import TestCase, main
+
+from ong_gesfincas.profiling import Profiler
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self) -> None:
+        self.profiler = Profiler()
+
+        @self.profiler.timed(name="inner", rows=lambda result, n: n)
+        def inner(n: int) -> list:
+            return list(range(n))
+
+        @self.profiler.timed(name="outer")
+        def outer(n: int) -> list:
+            return inner(n) + inner(n)
+
+        self.inner = inner
+        self.outer = outer
+
+    def test_disabled(self):
+        """Nothing is recorded if profiler is disabled"""
+        self.assertEqual(self.outer(10), list(range(10)) * 2)
+        self.assertEqual(self.profiler.report(), dict())
+
+    def test_enabled(self):
+        """Calls and rows are recorded for every operation, also nested ones"""
+        self.profiler.enable()
+        self.outer(10)
+        self.inner(5)
+        report = self.profiler.report()
+        self.assertEqual(report["inner"]["calls"], 3)
+        self.assertEqual(report["inner"]["rows"], 25)
+        self.assertEqual(report["outer"]["calls"], 1)
+        self.assertGreaterEqual(report["outer"]["seconds"], report["outer"]["max_seconds"])
+        self.assertIsNone(report["outer"]["peak_memory"])
+        self.profiler.clear()
+        self.assertEqual(self.profiler.report(), dict())
+
+    def test_memory(self):
+        """Peak memory of outer operation includes the memory of the nested ones"""
+        self.profiler.enable(memory=True)
+        try:
+            with self.profiler.measure("block") as measure:
+                self.inner(100_000)
+                measure.rows = 1
+        finally:
+            self.profiler.disable()
+        report = self.profiler.report()
+        self.assertGreater(report["inner"]["peak_memory"], 0)
+        self.assertGreaterEqual(report["block"]["peak_memory"], report["inner"]["peak_memory"])
+        self.assertEqual(report["block"]["rows"], 1)
+
+    def test_dump_json(self):
+        self.profiler.enable()
+        self.outer(3)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "report.json")
+            self.profiler.dump_json(filename)
+            with open(filename) as f:
+                self.assertEqual(set(json.load(f)), {"inner", "outer"})
+        self.assertIn("outer", self.profiler.report_text())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Tests that the entry points of the graphical applications start fast: they must not import the heavy dependencies
+(pandas, numpy, pandastable) before showing the window
+"""
+import os
+import subprocess
+import sys
+from unittest import TestCase, main
+
+# Maximum seconds to import an entry point module, in a new python process
+IMPORT_BUDGET_SECONDS = 0.5
+_HEAVY_MODULES = ("pandas", "numpy", "pandastable")
+
+
+class TestStartup(TestCase):
+
+    def import_time(self, module: str) -> float:
+        """Imports module in a new python process and returns the seconds it took"""
+        code = (f"import sys, time\n"
+                f"start = time.perf_counter()\n"
+                f"import {module}\n"
+                f"elapsed = time.perf_counter() - start\n"
+                f"heavy = [name for name in {_HEAVY_MODULES!r} if name in sys.modules]\n"
+                f"assert not heavy, heavy\n"
+                f"print(elapsed)\n")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, f"{module}: {result.stderr}")
+        return float(result.stdout)
+
+    def test_import_budget(self):
+        for module in "ong_gesfincas", "ong_gesfincas.launcher", "ong_gesfincas.liquidaciones_gui":
+            with self.subTest(module=module):
+                self.assertLess(self.import_time(module), IMPORT_BUDGET_SECONDS)
+
+
+if __name__ == '__main__':
+    main()